@@ -0,0 +1,261 @@
+import argparse
+import csv
+import datetime
+import json
+import math
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import capapi
+
+'''
+Offline benchmarks for building law.db and querying it.
+
+Generates a synthetic corpus (no CAP API, Wikipedia or prebuilt law.db needed),
+builds a database from it with create_db(), and times the ingest and each query
+helper, for one or more corpus sizes. Each size runs in its own process, so its
+peak memory can be reported too, and the timings for the different sizes make
+a scaling curve.
+
+The corpus is meant to look like the real one where it matters for speed:
+  - courts: the 94 district and territorial courts, in the same shape as
+    get_courts_data()'s, built from state_table.csv, plus a share of cases
+    from appellate and other courts that aren't district courts
+  - cases per court: skewed, in proportion to each court's number of judges
+  - dates: mostly weekdays, spread over a year
+  - text: log-normally distributed lengths, with words drawn from a Zipf
+    distribution over a vocabulary that includes the words the queries use
+
+usage: python benchmark.py [--sizes 1000 10000 ...] [--save results.json]
+                           [--baseline results.json [--tolerance 1.5]]
+
+With --baseline, the exit status is 1 if any timing got more than tolerance
+times slower than in the baseline, so it can gate a change.
+'''
+
+SIZES = [1000, 10000]
+SEED = 1
+MEDIAN_WORDS = 1200 # words per case (the real median is around this; the longest are 10x it)
+WORDS_SIGMA = 0.9
+MAX_WORDS = 20000
+START_DATE = "2016-01-01"
+DAYS = 365
+OTHER_COURTS_SHARE = 0.3 # cases from courts that aren't district courts
+QUERY_WORD = "woman"
+FREQ_WORDS = ["the", "women", "gender"]
+MIN_GATED_SECONDS = 0.05 # timings shorter than this are too noisy to compare against a baseline
+
+# states with more than one district court, and how many
+DISTRICTS = {'AL': 3, 'AR': 2, 'CA': 4, 'FL': 3, 'GA': 3, 'IL': 3, 'IN': 2, 'IA': 2, 'KY': 2, 'LA': 3,
+    'MI': 2, 'MS': 2, 'MO': 2, 'NY': 4, 'NC': 3, 'OH': 2, 'OK': 3, 'PA': 3, 'TN': 3, 'TX': 4, 'VA': 2,
+    'WA': 2, 'WV': 2, 'WI': 2}
+DIRECTIONS = {2: ['Eastern', 'Western'], 3: ['Northern', 'Middle', 'Southern'], 4: ['Northern', 'Southern', 'Eastern', 'Western']}
+OTHER_COURTS = ["U.S.", "1st Cir.", "2d Cir.", "5th Cir.", "9th Cir.", "D.C. Cir.", "Fed. Cl.", "B.A.P. 9th Cir."]
+
+COMMON_WORDS = ("the of to and a in that is for court was on not as by it be with or district motion his her "
+    "claim at he she this state united states law case order judgment evidence which from an defendants "
+    "plaintiffs under any federal rule counsel trial plaintiff defendant v. woman man women men gender "
+    "discrimination employment contract damages jury appeal section statute dismiss summary complaint").split()
+RARE_WORDS = 5000
+SURNAMES = ["Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller", "Davis", "Rodriguez",
+    "Martinez", "Hernandez", "Lopez", "Wilson", "Anderson", "Thomas", "Taylor", "Moore", "Jackson"]
+
+def ordinal(n):
+    if n.isdigit():
+        if n[-2:] in ('11', '12', '13'):
+            return n + 'th'
+        return n + {'1': 'st', '2': 'nd', '3': 'rd'}.get(n[-1], 'th')
+    return n
+
+def make_courts(rng, states_csv):
+    # synthetic court tuples, like get_courts_data()'s: (state, name, cite, appeals, estd, judges)
+    list_of_courts = []
+    with open(states_csv, encoding='utf-8') as states_data:
+        rows = list(csv.reader(states_data))[1:]
+
+    for row in rows:
+        name, abbr, kind, ap, circuit = row[1], row[2], row[4], row[10], row[16]
+        if not circuit:
+            continue # American Samoa has no federal court
+        if abbr == 'DC':
+            name = "District of Columbia" # how the court list names it (see create_db)
+            cites = [("District of Columbia", "D.D.C.")]
+        elif abbr in DISTRICTS:
+            cites = [("{} District of {}".format(direction, name), "{}.D. {}".format(direction[0], ap))
+                for direction in DIRECTIONS[DISTRICTS[abbr]]]
+        else:
+            cites = [("District of {}".format(name), "D. {}".format(ap))]
+
+        for court_name, cite in cites:
+            judges = max(1, int(rng.lognormvariate(1.3, 0.7)))
+            estd = rng.randint(1789, 1970)
+            list_of_courts.append((name, court_name, cite, ordinal(circuit), str(estd), str(judges)))
+
+    return list_of_courts
+
+def make_vocabulary():
+    words = COMMON_WORDS + ["w{}".format(i) for i in range(RARE_WORDS)]
+    cum_weights = []
+    total = 0
+    for rank in range(len(words)):
+        total += 1 / (rank + 1) ** 1.1
+        cum_weights.append(total)
+    return (words, cum_weights)
+
+def iter_cases(n, courts, rng, median_words=MEDIAN_WORDS):
+    # n synthetic case tuples, like iter_cap_data()'s: (name, name_abbr, date, court, text, cap_id)
+    words, cum_weights = make_vocabulary()
+    cites = [court[2] for court in courts] + OTHER_COURTS
+    # district courts get cases in proportion to their judges; the other courts share the rest
+    judges = sum(int(court[5]) for court in courts)
+    other_weight = judges * OTHER_COURTS_SHARE / (1 - OTHER_COURTS_SHARE) / len(OTHER_COURTS)
+    court_weights = [int(court[5]) for court in courts] + [other_weight] * len(OTHER_COURTS)
+
+    start = datetime.date.fromisoformat(START_DATE)
+    dates = [start + datetime.timedelta(days=i) for i in range(DAYS)]
+    date_weights = [1 if date.weekday() < 5 else 0.05 for date in dates]
+
+    for cap_id in range(1, n + 1):
+        plaintiff, defendant = rng.choice(SURNAMES), rng.choice(SURNAMES)
+        name = "{} v. {} {}".format(plaintiff, defendant, cap_id)
+        name_abbr = "{} v. {}".format(plaintiff, defendant)
+        date = rng.choices(dates, date_weights)[0].isoformat()
+        court = rng.choices(cites, court_weights)[0]
+        length = min(MAX_WORDS, max(20, int(rng.lognormvariate(math.log(median_words), WORDS_SIGMA))))
+        text = " ".join(rng.choices(words, cum_weights=cum_weights, k=length))
+        yield (name, name_abbr, date, court, text, cap_id)
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+def run_one(n, seed=SEED, median_words=MEDIAN_WORDS, fts=capapi.BUILD_FTS_INDEX, directory=None):
+    # Builds a database of n synthetic cases in directory (a temporary one by default) and returns
+    # {metric: value}: seconds for the ingest and for each query, cold (empty query cache) and warm.
+    rng = random.Random(seed)
+    states_csv = os.path.join(os.path.dirname(os.path.abspath(__file__)), capapi.STATESCSV)
+    courts = make_courts(rng, states_csv)
+
+    saved = (capapi.DBNAME, capapi.STATESCSV)
+    with tempfile.TemporaryDirectory(dir=directory) as tmpdir:
+        capapi.DBNAME = os.path.join(tmpdir, "bench.db")
+        capapi.STATESCSV = states_csv
+        try:
+            # generating the text isn't part of the ingest, so its time is taken out
+            generating = [0.0]
+            def generate():
+                cases = iter_cases(n, courts, rng, median_words)
+                while True:
+                    start = time.perf_counter()
+                    case = next(cases, None)
+                    generating[0] += time.perf_counter() - start
+                    if case is None:
+                        return
+                    yield case
+
+            results = {'cases': n}
+            results['ingest'] = timed(capapi.create_db, capapi.BULK_LOAD_PRAGMAS, fts, capapi.BUILD_TERM_INDEX,
+                generate(), courts) - generating[0]
+            results['generate'] = generating[0]
+            results['db_mb'] = sum(os.path.getsize(os.path.join(tmpdir, fname)) for fname in os.listdir(tmpdir)) / 1e6
+
+            queries = [
+                ('get_cases_by_state', capapi.get_cases_by_state, ()),
+                ('get_percent_by_state_containing', capapi.get_percent_by_state_containing, (QUERY_WORD,)),
+                ('get_list_of_cases_containing', capapi.get_list_of_cases_containing, (QUERY_WORD,)),
+                ('get_freq_by_time_for', capapi.get_freq_by_time_for, (FREQ_WORDS,)),
+            ]
+            for name, func, args in queries:
+                capapi.QUERY_CACHE.clear()
+                results[name] = timed(func, *args)
+                results[name + ' (cached)'] = timed(func, *args)
+        finally:
+            capapi.DBNAME, capapi.STATESCSV = saved
+            capapi.QUERY_CACHE.clear()
+
+    # peak resident memory of this process (KiB on Linux, bytes on macOS)
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results['peak_mb'] = maxrss / (1e6 if sys.platform == 'darwin' else 1e3)
+    return results
+
+def run_all(sizes=SIZES, seed=SEED, median_words=MEDIAN_WORDS, fts=True):
+    # each size in a fresh process, so peak memory and caches don't carry over from one to the next
+    all_results = []
+    for n in sizes:
+        args = [sys.executable, os.path.abspath(__file__), "--one", str(n), "--seed", str(seed),
+            "--median-words", str(median_words)]
+        if not fts:
+            args.append("--no-fts")
+        output = subprocess.run(args, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        all_results.append(json.loads(output.splitlines()[-1]))
+        print("... {} cases done".format(n), file=sys.stderr)
+    return all_results
+
+def report(all_results):
+    metrics = [key for key in all_results[0] if key != 'cases']
+    print("{:<42}".format("cases") + "".join("{:>12}".format(results['cases']) for results in all_results)
+        + "{:>10}".format("scaling"))
+    for metric in metrics:
+        values = [results[metric] for results in all_results]
+        line = "{:<42}".format(metric) + "".join("{:>12.4f}".format(value) for value in values)
+        # the exponent k in time ~ cases^k, between the smallest and largest sizes (1 is linear)
+        first, last = all_results[0], all_results[-1]
+        if len(all_results) > 1 and values[0] > 0 and values[-1] > 0:
+            k = math.log(values[-1] / values[0]) / math.log(last['cases'] / first['cases'])
+            line += "{:>10.2f}".format(k)
+        print(line)
+
+def check_baseline(all_results, baseline, tolerance):
+    # returns a list of (cases, metric, baseline value, new value) for the timings that got slower
+    baseline_by_size = {results['cases']: results for results in baseline}
+    regressions = []
+    for results in all_results:
+        old = baseline_by_size.get(results['cases'])
+        if old is None:
+            continue
+        for metric in results:
+            if metric in ('cases', 'generate', 'db_mb', 'peak_mb') or metric not in old:
+                continue
+            if old[metric] >= MIN_GATED_SECONDS and results[metric] > old[metric] * tolerance:
+                regressions.append((results['cases'], metric, old[metric], results[metric]))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for law.db")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="numbers of cases")
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--median-words", type=int, default=MEDIAN_WORDS, help="median words per case")
+    parser.add_argument("--no-fts", action="store_true", help="build without the full-text index")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against results saved earlier with --save")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="how many times slower counts as a regression")
+    parser.add_argument("--one", type=int, help=argparse.SUPPRESS) # used by run_all
+    args = parser.parse_args()
+
+    if args.one:
+        print(json.dumps(run_one(args.one, args.seed, args.median_words, not args.no_fts)))
+        return 0
+
+    all_results = run_all(args.sizes, args.seed, args.median_words, not args.no_fts)
+    report(all_results)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(all_results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = check_baseline(all_results, json.load(f), args.tolerance)
+        for cases, metric, old, new in regressions:
+            print("REGRESSION: {} at {} cases took {:.4f}s (baseline {:.4f}s)".format(metric, cases, new, old))
+        if regressions:
+            return 1
+    return 0
+
+if __name__=="__main__":
+    sys.exit(main())
@@ -0,0 +1,124 @@
+import json
+import os
+import pickle
+import sqlite3 as sqlite
+import sys
+import threading
+import zlib
+
+'''
+A keyed on-disk cache for API responses and scraped pages.
+
+The old cache was a single JSON file that had to be read in full at startup and
+rewritten in full after every page fetch. This store keeps one SQLite row per
+request URL instead, so reads only touch the key that is asked for and each
+write is a small, atomic insert (a crash mid-write can't corrupt older entries).
+Values are JSON-serialized (or pickled, for Python objects JSON can't round-trip,
+like tuples) and, optionally, zlib-compressed.
+'''
+
+class CacheStore:
+
+    def __init__(self, fname, compress=True, serializer='json'):
+        self.fname = fname
+        self.compress = compress
+        self.serializer = serializer # 'json' or 'pickle'
+        self.lock = threading.Lock()
+
+        # isolation_level=None puts the connection in autocommit mode, so every
+        # write is its own (tiny) transaction
+        self.conn = sqlite.connect(fname, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        statement = '''
+        CREATE TABLE IF NOT EXISTS Cache (
+        Key TEXT PRIMARY KEY,
+        Value BLOB,
+        Compressed INTEGER
+        );
+        '''
+        self.conn.execute(statement)
+
+    def _encode(self, value):
+        if self.serializer == 'pickle':
+            data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        else:
+            data = json.dumps(value).encode('utf-8')
+        if self.compress:
+            return (zlib.compress(data), 1)
+        return (data, 0)
+
+    def _decode(self, data, compressed):
+        if compressed:
+            data = zlib.decompress(data)
+        if self.serializer == 'pickle':
+            return pickle.loads(data)
+        return json.loads(data.decode('utf-8'))
+
+    def __contains__(self, key):
+        with self.lock:
+            result = self.conn.execute("SELECT 1 FROM Cache WHERE Key = ?", (key,)).fetchone()
+        return result is not None
+
+    def __getitem__(self, key):
+        with self.lock:
+            result = self.conn.execute("SELECT Value, Compressed FROM Cache WHERE Key = ?", (key,)).fetchone()
+        if result is None:
+            raise KeyError(key)
+        return self._decode(result[0], result[1])
+
+    def __setitem__(self, key, value):
+        data, compressed = self._encode(value)
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO Cache (Key, Value, Compressed) VALUES (?, ?, ?)", (key, data, compressed))
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM Cache").fetchone()[0]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT Key FROM Cache")]
+
+    def is_empty(self):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM Cache LIMIT 1").fetchone() is None
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+''' Migration from the old cache.json format '''
+
+def import_json_cache(json_fname, store):
+    with open(json_fname, 'r') as f:
+        old_cache = json.load(f)
+
+    rows = []
+    for key in old_cache:
+        data, compressed = store._encode(old_cache[key])
+        rows.append((key, data, compressed))
+
+    # one transaction for the whole import
+    with store.lock:
+        store.conn.execute("BEGIN")
+        store.conn.executemany("INSERT OR REPLACE INTO Cache (Key, Value, Compressed) VALUES (?, ?, ?)", rows)
+        store.conn.execute("COMMIT")
+
+    return len(rows)
+
+if __name__=="__main__":
+    # usage: python cachestore.py [cache.json] [cache.db]
+    json_fname = sys.argv[1] if len(sys.argv) > 1 else "cache.json"
+    db_fname = sys.argv[2] if len(sys.argv) > 2 else "cache.db"
+    if not os.path.exists(json_fname):
+        print("Can't find {}".format(json_fname))
+    else:
+        n = import_json_cache(json_fname, CacheStore(db_fname))
+        print("Imported {} entries from {} into {}".format(n, json_fname, db_fname))
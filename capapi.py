@@ -1,116 +1,218 @@
-import requests
-from bs4 import BeautifulSoup
 import json
 import csv
+import collections
+import datetime
+import os
+import random
 import sqlite3 as sqlite
-from secrets import *
-import plotly
-import plotly.plotly as py
-import plotly.graph_objs as go
-
-plotly.tools.set_credentials_file(username=PLOTLY_USERNAME, api_key=PLOTLY_API_KEY)
+import sys
+import uuid
+import importlib.util
+import subprocess
+import time
+import cProfile
+import pstats
+from cachestore import CacheStore, import_json_cache
+from crawler import Crawler, make_windows
+from courts import STATE_ALIASES, load_courts
+from compression import compress_body, latest_dict_key, train_dict, compression_report
+from database import connect, enable_wal, get_connection, get_meta, set_meta
+from dates import (GRANULARITIES, check_granularity, date_to_day, day_to_date, day_condition, day_sql, period_sql,
+    period_start, split_day_range)
+from querycache import QueryCache, copy_result, make_key
+from rendering import FigureCache
+from profiling import Timers, SQL_TRACE
+from jobs import JobRunner
+from tokenizer import tokenize, normalize_phrase, match_condition, check_tokenizer
+from scanengine import (run_scan, count_words_in_rows, merge_token_counts, count_states_in_rows,
+    merge_state_counts, find_cases_in_rows, merge_matching_cases)
 
 DBNAME = 'law.db'
 STATESCSV = 'state_table.csv'
-CACHE_FNAME = "cache.json"
-
-try:
-    f = open(CACHE_FNAME, 'r')
-    f_contents = f.read()
-    f.close()
-    CACHE_DICTION = json.loads(f_contents)
-except:
-    CACHE_DICTION = {}
+CACHE_FNAME = "cache.json" # old single-file cache, only read to migrate it
+CACHE_DBNAME = "cache.db"
+SECRETS_FNAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), "secrets.py") # see secrets_example.py
+
+COURTS_URL = "https://en.wikipedia.org/wiki/List_of_United_States_district_and_territorial_courts"
+CAPAPI_URL = os.environ.get("CAPAPI_URL", "https://api.case.law/v1/cases/") # e.g. a mockcap.py server
+CAP_JURISDICTION = "us"
+CAP_DATE_MIN = "2016-01-01"
+CAP_MAX_PAGES = 25
+CAP_RATE_LIMIT = 5.0 # requests per second, shared by all crawler threads
+CAP_WORKERS = 8
+CAP_BACKOFF = 1.0 # seconds before the first retry of a failed request, doubled on each one after that
+
+# settings for create_db(): rows per executemany() batch, and PRAGMAs for the bulk load
+# (a rebuild starts from scratch anyway, so there's no point paying for a journal or fsyncs)
+INSERT_BATCH_SIZE = 1000
+MAX_SQL_VARIABLES = 999 # the most ?s SQLite before 3.32 takes in one statement
+BULK_LOAD_PRAGMAS = {
+    'journal_mode': 'OFF',
+    'synchronous': 'OFF',
+    'cache_size': -200000, # negative means KiB, so ~200MB
+    'temp_store': 'MEMORY',
+}
+BUILD_FTS_INDEX = True # full-text index for cases_matching and map_matching (see create_fts_index)
+# FTS5's tokenizer: unicode61, but keeping apostrophes (quoted and doubled, '''') inside words, like tokenizer.py does
+FTS_TOKENIZE = "unicode61 tokenchars ''''"
+BUILD_TERM_INDEX = True # per-date token counts for time_plot (see create_term_tables)
+TOKENIZER = 'words' # how new indexes split text: 'words', 'words+stem' or 'split' (see tokenizer.py)
+CASEBODY_COMPRESSION = None # None, 'zlib' or 'zstd' (see compression.py and compress_db)
+
+# processes used by queries that have to scan every case (see scanengine.py)
+SCAN_WORKERS = os.cpu_count() or 1
+
+# query results kept in memory (and, if QUERY_CACHE_DBNAME is set, on disk between sessions)
+QUERY_CACHE_SIZE = 128
+QUERY_CACHE_DBNAME = None # e.g. "query_cache.db"
+
+# how figures are shown: 'offline' writes them to local files (no plot.ly account or network
+# needed), 'cloud' uploads them to plot.ly as before
+PLOT_MODE = 'offline'
+PLOT_FORMAT = 'html' # or 'png', 'svg', 'pdf', ... (static images need plotly's orca)
+FIGURES_DIR = "figures"
+FIGURE_CACHE_SIZE = 200 # figure files kept in FIGURES_DIR
+
+PROFILE_FNAME = "capapi.prof" # where --profile saves its cProfile data
+SQL_TRACE_ON = False # time every SQL statement and save query plans (or use 'trace on' at the prompt)
+
+SNAPSHOT_DIR = "snapshot" # where 'python capapi.py snapshot' writes the numpy snapshot (see snapshot.py)
+
+# the prompt runs the commands that query the database (JOB_COMMANDS) on a worker thread, so it can
+# take more commands (which are queued), show their progress, and cancel them (see jobs.py)
+BACKGROUND_COMMANDS = True # False waits for each command to finish before the next prompt, as before
+PROGRESS_INTERVAL = 0.5 # seconds between progress updates while waiting for a command
+
+# 'python capapi.py serve': JSON query endpoints on localhost (see service.py)
+SERVE_PORT = 8080
+SERVE_WORKERS = 8 # threads running queries, each with its own read-only connection
+SERVE_TIMEOUT = 30.0 # seconds before a request gets a 504 and its query is cancelled
+
+CASES_PAGE_SIZE = 25 # rows in each page of the cases_matching table
+ESTIMATE_SAMPLE_SIZE = 500 # cases checked to estimate the # of matches when there's no FTS index
+
+# Importing this module doesn't read or open anything: the cache, secrets.py, and heavy libraries
+# (requests, plotly) are all loaded the first time they're needed.
+CACHE = None # see get_cache()
+SECRETS = None # see get_secret()
+
+QUERY_CACHE = QueryCache(QUERY_CACHE_SIZE, QUERY_CACHE_DBNAME)
+FIGURE_CACHE = FigureCache(FIGURES_DIR, FIGURE_CACHE_SIZE)
+TIMERS = Timers() # per-command and per-phase latencies, shown by the 'stats' command
+JOBS = JobRunner(on_finish=lambda job: report_job(job)) # the prompt's background commands
+JOB_PROFILER = None # while profile_main() is running, the cProfile.Profile for the commands JOBS runs
+SQL_TRACE.enabled = SQL_TRACE_ON
+
+def get_cache():
+    # the API/page cache, opened (and, the first time, migrated from cache.json) on first use
+    global CACHE
+    if CACHE is None:
+        CACHE = CacheStore(CACHE_DBNAME)
+        if CACHE.is_empty() and os.path.exists(CACHE_FNAME):
+            import_json_cache(CACHE_FNAME, CACHE)
+    return CACHE
+
+def get_secret(name):
+    # A value from secrets.py, or "" if there's no such file or it doesn't set name. The file is
+    # loaded by path: 'import secrets' would quietly find the standard library's secrets module
+    # whenever there's no secrets.py.
+    global SECRETS
+    if SECRETS is None:
+        SECRETS = {}
+        if os.path.exists(SECRETS_FNAME):
+            spec = importlib.util.spec_from_file_location("capapi_secrets", SECRETS_FNAME)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            SECRETS = vars(module)
+    return SECRETS.get(name, "")
 
 ''' Functions that get data from the internet '''
 
 def get_courts_data():
-    list_of_courts = []
-
-    url = 'https://en.wikipedia.org/wiki/List_of_United_States_district_and_territorial_courts'
-
-    if url in CACHE_DICTION:
+    # (state, name, cite, appeals, estd, judges) for each district court, from Wikipedia's list; the
+    # page is only parsed when it's changed since the last time (see courts.py)
+    cache = get_cache()
+    if COURTS_URL in cache:
         # print("Getting cached data")
-        html = CACHE_DICTION[url]
+        html = cache[COURTS_URL]
     else:
         # print("Getting new data")
-        html = requests.get(url).text
-        CACHE_DICTION[url] = html
-        f = open(CACHE_FNAME, 'w')
-        f.write(json.dumps(CACHE_DICTION))
-        f.close
-
-    soup = BeautifulSoup(html, 'html.parser')
-    table = soup.find("table", class_="wikitable sortable")
-    row_set = table.find_all("tr")
-
-    for row in row_set[1:]:
-        td_set = row.find_all("td")
-
-        name_list = td_set[0].text.split()
-        if name_list[-1] == "Columbia":
-            state = "District of Columbia"
-        elif name_list[-2] != "of":
-            state = "{} {}".format(name_list[-2], name_list[-1])
-        else:
-            state = name_list[-1]
-
-        name = td_set[0].text.strip()
-        cite = td_set[1].text.strip()
-        appeals = td_set[2].text.strip()
-        estd = td_set[3].text.strip()
-        judges = td_set[4].text.strip()
-
-        tup = (state,name,cite,appeals,estd,judges)
-        list_of_courts.append(tup)
-
-    return list_of_courts
-
-def get_cap_data():
+        import requests
+        html = requests.get(COURTS_URL).text
+        cache[COURTS_URL] = html
 
-    url = "https://api.case.law/v1/cases/?full_case=true&jurisdiction=us&decision_date_min=2016-01-01"
-    page = 0
-    list_of_case_tups = []
-
-    while page < 25: # I want the first 25 pages (2,500 cases)
-        if url in CACHE_DICTION:
-            # print("Getting cached data")
-            resp_dict = CACHE_DICTION[url]
-        else:
-            print("Getting new data")
-            resp = requests.get(url, headers = {'Authorization': "Token " + CAPAPI_KEY})
-            resp_dict = json.loads(resp.text)
-            CACHE_DICTION[url] = resp_dict
-            f = open(CACHE_FNAME, 'w')
-            f.write(json.dumps(CACHE_DICTION))
-            f.close
-
-        url = resp_dict['next']
-        page += 1
+    return load_courts(cache, html, get_state_names())
 
+def get_state_names():
+    # lowercased names of the states (and territories) in STATESCSV
+    with open(STATESCSV, encoding = 'utf-8') as states_data:
+        return {row[1].lower() for row in list(csv.reader(states_data))[1:]}
+
+def get_cap_urls(jurisdiction=CAP_JURISDICTION, date_min=CAP_DATE_MIN, date_max=None, window_days=None):
+    base_url = CAPAPI_URL + "?full_case=true&jurisdiction={}".format(jurisdiction)
+
+    if window_days is None:
+        url = base_url + "&decision_date_min={}".format(date_min)
+        if date_max:
+            url += "&decision_date_max={}".format(date_max)
+        return [url]
+
+    if date_max is None:
+        date_max = datetime.date.today().isoformat()
+    urls = []
+    for window in make_windows(date_min, date_max, window_days):
+        urls.append(base_url + "&decision_date_min={}&decision_date_max={}".format(window[0], window[1]))
+    return urls
+
+def case_to_tuple(case):
+    name = case['name']
+    name_abbr = case['name_abbreviation']
+    date = case['decision_date']
+    court = case['court']['name_abbreviation']
+    text = ""
+    for opinion in case['casebody']['data']['opinions']:
+        text += opinion['text']
+
+    cap_id = case['id']
+
+    return (name, name_abbr, date, court, text, cap_id)
+
+def iter_cap_data(jurisdiction=CAP_JURISDICTION, date_min=CAP_DATE_MIN, date_max=None, window_days=None, max_pages=CAP_MAX_PAGES,
+        cursors=None):
+    # By default this asks for the first 25 pages (2,500 cases) of a single query, like it always has.
+    # With window_days, the date range is split into windows that are crawled concurrently,
+    # and max_pages applies to each window (None means follow every window to the end).
+    # Cases are yielded as their pages arrive, so the whole corpus is never held in memory.
+    # If cursors (a dict) is given, it's kept up to date with each window's start url -> the url of
+    # its next page, which is None once the window has been crawled to the end.
+    urls = get_cap_urls(jurisdiction, date_min, date_max, window_days)
+    crawler = Crawler(get_cache(), get_secret('CAPAPI_KEY'), rate=CAP_RATE_LIMIT, workers=CAP_WORKERS, backoff=CAP_BACKOFF)
+
+    for start_url, resp_dict in crawler.iter_pages(urls, max_pages):
+        if cursors is not None:
+            cursors[start_url] = resp_dict['next']
         for case in resp_dict['results']: # there are 100 in a page
-            name = case['name']
-            name_abbr = case['name_abbreviation']
-            date = case['decision_date']
-            court = case['court']['name_abbreviation']
-            text = ""
-            for opinion in case['casebody']['data']['opinions']:
-                text += opinion['text']
-
-            case_tup = (name, name_abbr, date, court, text)
-            list_of_case_tups.append(case_tup)
+            yield case_to_tuple(case)
 
-    return list_of_case_tups
+def get_cap_data(jurisdiction=CAP_JURISDICTION, date_min=CAP_DATE_MIN, date_max=None, window_days=None, max_pages=CAP_MAX_PAGES):
+    return list(iter_cap_data(jurisdiction, date_min, date_max, window_days, max_pages))
 
 ''' Create database '''
 
-def create_db():
+def create_db(pragmas=BULK_LOAD_PRAGMAS, fts=BUILD_FTS_INDEX, term_index=BUILD_TERM_INDEX, cases=None, courts=None):
+    # cases (an iterable of case tuples, like iter_cap_data's) and courts (a list of court tuples,
+    # like get_courts_data's) default to the CAP API and Wikipedia; benchmark.py passes in synthetic ones
 
-    conn = sqlite.connect(DBNAME)
+    conn = connect(DBNAME)
     cur = conn.cursor()
 
+    for pragma in pragmas:
+        cur.execute("PRAGMA {} = {}".format(pragma, pragmas[pragma]))
+
     ''' Drop existing tables '''
 
+    statement = "DROP TABLE IF EXISTS CasesFts"
+    cur.execute(statement)
     statement = "DROP TABLE IF EXISTS Cases"
     cur.execute(statement)
     statement = "DROP TABLE IF EXISTS DistrictCourts"
@@ -119,6 +221,16 @@ def create_db():
     # cur.execute(statement)
     statement = "DROP TABLE IF EXISTS States"
     cur.execute(statement)
+    statement = "DROP TABLE IF EXISTS TermCounts"
+    cur.execute(statement)
+    statement = "DROP TABLE IF EXISTS DateTotals"
+    cur.execute(statement)
+    statement = "DROP TABLE IF EXISTS TermBuckets"
+    cur.execute(statement)
+    statement = "DROP TABLE IF EXISTS TotalBuckets"
+    cur.execute(statement)
+    statement = "DROP TABLE IF EXISTS Meta"
+    cur.execute(statement)
 
     conn.commit()
 
@@ -160,11 +272,25 @@ def create_db():
     NameAbbr TEXT,
     DecisionDate INTEGER,
     CourtId INTEGER REFERENCES DistrictCourts(Id),
-    CaseBody TEXT
+    CaseBody TEXT,
+    CapId INTEGER
     );
     '''
     cur.execute(statement)
 
+    statement = "CREATE UNIQUE INDEX CasesCapId ON Cases (CapId)"
+    cur.execute(statement)
+
+    # DecisionDate holds day numbers (see dates.py), so date ranges are index range scans
+    statement = "CREATE INDEX CasesDecisionDate ON Cases (DecisionDate)"
+    cur.execute(statement)
+
+    create_meta_table(cur)
+    set_meta(cur, 'tokenizer', TOKENIZER)
+
+    if term_index:
+        create_term_tables(cur)
+
     conn.commit()
 
     ''' Load data into tables '''
@@ -184,111 +310,681 @@ def create_db():
             tup = (name,abbr,ap,region,division,circuit)
             list_of_tuples.append(tup)
 
-        for tup in list_of_tuples[1:]:
-            statement = '''
-            INSERT INTO States (Name, Abbr, AssocPress, CensusRegionName, CensusDivisionName, CircuitCourt)
-            VALUES (?,?,?,?,?,?)
-            '''
-            cur.execute(statement, tup)
-            conn.commit()
+        statement = '''
+        INSERT INTO States (Name, Abbr, AssocPress, CensusRegionName, CensusDivisionName, CircuitCourt)
+        VALUES (?,?,?,?,?,?)
+        '''
+        cur.executemany(statement, list_of_tuples[1:])
+
+    # state names -> ids (lowercased, like the case-insensitive LIKE match this used to do), including
+    # the names the court list uses for some of them
+    state_ids = {}
+    for row in cur.execute("SELECT Id, Name FROM States"):
+        state_ids.setdefault(row[1].lower(), row[0])
+    for alias, name in STATE_ALIASES.items():
+        if name.lower() in state_ids:
+            state_ids.setdefault(alias.lower(), state_ids[name.lower()])
 
     # DistrictCourts table
-    courts_list = get_courts_data() # list of tuples
+    courts_list = courts if courts is not None else get_courts_data() # list of tuples: (state, name, cite, appeals, estd, judges)
+    list_of_tuples = []
     for court in courts_list:
-        # Get State ID -- court[0]
-        statement = '''
-        SELECT Id
-        FROM States
-        WHERE Name LIKE \"{}\"
-        '''.format(court[0])
-        cur.execute(statement)
-        result = cur.fetchone()
-        try:
-            id = result[0]
-        except:
-            id = None
-        # print("{} {}".format(id, court[1]))
-        court_l = list(court)
-        court_l.append(id)
-        court_l.remove(court_l[0]) # get rid of state name
-        circuit = court_l[2].strip("abcdefghijklmnopqrstuvwxyz")
-        court_l.remove(court_l[2])
-        court_l.append(circuit)
-        new_tup = tuple(court_l)
-        # print(new_tup)
+        id = state_ids.get(court[0].lower())
+        circuit = court[3].strip("abcdefghijklmnopqrstuvwxyz")
+        list_of_tuples.append((court[1], court[2], court[4], court[5], id, circuit))
 
-        statement = '''
-        INSERT INTO DistrictCourts (CourtName, Citation, Established, NumJudges, StateId, CircuitCourt)
-        VALUES (?, ?, ?, ?, ?, ?)
-        '''
-        cur.execute(statement, new_tup)
+    statement = '''
+    INSERT INTO DistrictCourts (CourtName, Citation, Established, NumJudges, StateId, CircuitCourt)
+    VALUES (?, ?, ?, ?, ?, ?)
+    '''
+    cur.executemany(statement, list_of_tuples)
+
+    court_ids = get_court_ids(cur)
+
+    conn.commit()
+
+    # Cases table - streamed from the crawler into batched inserts, committed once at the end
+    cursors = {}
+    if cases is None:
+        cases = iter_cap_data(cursors=cursors)
+    batch = []
+    for case in cases: # (name, name_abbr, date, court, text, cap_id)
+        batch.append(case)
+        if len(batch) >= INSERT_BATCH_SIZE:
+            upsert_cases(cur, batch, court_ids, term_index)
+            batch = []
+    upsert_cases(cur, batch, court_ids, term_index)
+
+    # The high-water mark is only set if the crawl got to the end: a crawl stopped at CAP_MAX_PAGES
+    # hasn't necessarily seen every case up to the latest date it has, so instead its cursors are
+    # saved, and sync_db() carries on from them (its start url is the same when there's no mark).
+    unfinished = {url: cursor for url, cursor in cursors.items() if cursor}
+    if unfinished:
+        for url in unfinished:
+            set_meta(cur, 'cursor:' + url, unfinished[url])
+    else:
+        statement = "SELECT MAX(DecisionDate) FROM Cases"
+        set_meta(cur, 'high_water_mark', day_to_date(cur.execute(statement).fetchone()[0]))
+    bump_generation(cur)
+
+    conn.commit()
+
+    create_rollups(conn)
+
+    if fts:
+        create_fts_index(conn)
+
+    enable_wal(conn)
+    conn.close()
+
+def sync_db(date_min=None, date_max=None, window_days=None, max_pages=None, term_index=BUILD_TERM_INDEX):
+    # Brings an existing database up to date without rebuilding it. Crawls from the high-water mark
+    # (the latest decision date already stored) unless told otherwise, and upserts what comes back.
+    # Each page is committed together with the cursor for the next one, so if the sync is
+    # interrupted, running it again picks up where it left off.
+    conn = connect(DBNAME)
+    cur = conn.cursor()
+
+    if not has_table(cur, 'Cases'):
+        conn.close()
+        print("There's no database to sync yet, so building it from scratch...")
+        create_db()
+        return
+
+    enable_wal(conn)
+    create_meta_table(cur)
+    legacy = migrate_cases_table(cur)
+    migrate_dates(conn)
+    if not has_table(cur, 'StateCounts'):
+        create_rollups(conn)
+    if term_index and not has_table(cur, 'TermCounts'):
+        term_index = False
+
+    if date_min is None:
+        date_min = get_meta(cur, 'high_water_mark', CAP_DATE_MIN)
+    urls = get_cap_urls(CAP_JURISDICTION, date_min, date_max, window_days)
+
+    resume = {}
+    for url in urls:
+        cursor = get_meta(cur, 'cursor:' + url)
+        if cursor:
+            resume[url] = cursor
+    for url in resume:
+        print("Resuming an interrupted crawl from {}".format(resume[url]))
+
+    court_ids = get_court_ids(cur)
+    cursors = {} # start url -> the url of the next page (None once the window is done)
+    n_written = 0
+
+    conn.commit()
+
+    # refresh: the cached pages for these urls are from the last sync, from before any new cases
+    crawler = Crawler(get_cache(), get_secret('CAPAPI_KEY'), rate=CAP_RATE_LIMIT, workers=CAP_WORKERS, backoff=CAP_BACKOFF,
+        refresh=True)
+    for start_url, resp_dict in crawler.iter_pages(urls, max_pages, resume):
+        list_of_case_tups = [case_to_tuple(case) for case in resp_dict['results']]
+        if legacy:
+            adopt_legacy_cases(cur, list_of_case_tups)
+        n_written += upsert_cases(cur, list_of_case_tups, court_ids, term_index)
+
+        cursors[start_url] = resp_dict['next']
+        set_meta(cur, 'cursor:' + start_url, resp_dict['next'])
         conn.commit()
 
+    finished = not any(cursors.values())
+    if finished:
+        # The crawl got to the end, so move the high-water mark (only now, so that an interrupted or
+        # max_pages-limited crawl is carried on with the same start urls) and forget the cursors.
+        # (every case from the start date on has been seen, so the latest stored date is the mark)
+        statement = "SELECT MAX(DecisionDate) FROM Cases"
+        set_meta(cur, 'high_water_mark', day_to_date(cur.execute(statement).fetchone()[0]))
+        for url in urls:
+            set_meta(cur, 'cursor:' + url, None)
+    if n_written > 0:
+        bump_generation(cur)
+    conn.commit()
+    conn.close()
+
+    if finished:
+        print("Sync finished: {} new or changed cases".format(n_written))
+    else:
+        print("Sync stopped after {} pages per window: {} new or changed cases (sync again to continue)".format(max_pages, n_written))
+    return n_written
+
+def migrate_cases_table(cur):
+    # Adds the CapId column to a Cases table built before it existed. Returns True if there are
+    # rows without a CAP id, which sync_db() then tries to match up as it sees them again.
+    columns = [row[1] for row in cur.execute("PRAGMA table_info(Cases)")]
+    if 'CapId' not in columns:
+        cur.execute("ALTER TABLE Cases ADD COLUMN CapId INTEGER")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS CasesCapId ON Cases (CapId)")
+
+    statement = "SELECT 1 FROM Cases WHERE CapId IS NULL LIMIT 1"
+    return cur.execute(statement).fetchone() is not None
+
+def adopt_legacy_cases(cur, list_of_case_tups):
+    # gives rows from an old database (no CapId) the CAP id of the matching case, so they get updated
+    # instead of duplicated
     statement = '''
-    UPDATE DistrictCourts
-    SET StateId = 51
-    WHERE CourtName LIKE "District of Columbia"
+    UPDATE Cases
+    SET CapId = ?
+    WHERE Id = (SELECT Id FROM Cases WHERE CapId IS NULL AND Name = ? AND DecisionDate = ? LIMIT 1)
+    AND NOT EXISTS (SELECT 1 FROM Cases WHERE CapId = ?)
     '''
-    cur.execute(statement)
+    cur.executemany(statement, [(case[5], case[0], date_to_day(case[2]), case[5]) for case in list_of_case_tups])
+
+def migrate_dates(conn):
+    # Converts the ISO date strings in a database built before decision dates were stored as day
+    # numbers, adds the date index, and rebuilds whatever is derived from the dates. Returns True
+    # if there was anything to convert. (Text sorts after numbers, so MAX() finds any left.)
+    cur = conn.cursor()
+    statement = "SELECT typeof(MAX(DecisionDate)) FROM Cases"
+    if cur.execute(statement).fetchone()[0] != 'text':
+        return False
+
+    # create_rollups() rebuilds the rollups from scratch, so their triggers can go for now
+    for trigger in ['RollupsInsert', 'RollupsDelete', 'RollupsUpdate']:
+        cur.execute("DROP TRIGGER IF EXISTS {}".format(trigger))
+    statement = "UPDATE Cases SET DecisionDate = {} WHERE typeof(DecisionDate) = 'text'"
+    cur.execute(statement.format(day_sql('DecisionDate')))
+    cur.execute("CREATE INDEX IF NOT EXISTS CasesDecisionDate ON Cases (DecisionDate)")
+
+    if has_table(cur, 'TermCounts'):
+        for table in ['TermCounts', 'DateTotals']:
+            statement = "UPDATE {} SET DecisionDate = {} WHERE typeof(DecisionDate) = 'text'"
+            cur.execute(statement.format(table, day_sql('DecisionDate')))
+        cur.execute("DROP TABLE IF EXISTS TermBuckets")
+        cur.execute("DROP TABLE IF EXISTS TotalBuckets")
+        create_term_tables(cur)
+        fill_term_buckets(cur)
+
+    rollups = has_table(cur, 'StateCounts')
+    bump_generation(cur)
     conn.commit()
+    if rollups:
+        create_rollups(conn)
+    return True
+
+def upgrade_db():
+    # brings a law.db built by an older version up to date, before anything queries it
+    if not os.path.exists(DBNAME):
+        return
+    conn = connect(DBNAME)
+    if has_table(conn.cursor(), 'Cases'):
+        if migrate_dates(conn):
+            print("Converted the decision dates in {} to day numbers.".format(DBNAME))
+        if not has_table(conn.cursor(), 'Meta'):
+            # (databases from before it existed, which used str.split(), see get_tokenizer_name)
+            create_meta_table(conn.cursor())
+            set_meta(conn.cursor(), 'tokenizer', 'split')
+            conn.commit()
+        if has_fts_index(conn.cursor()) and not has_fts_tokenize(conn.cursor()):
+            # (indexes from before FTS_TOKENIZE split "o'connor" into "o" and "connor")
+            print("Rebuilding the full-text index in {}...".format(DBNAME))
+            create_fts_index(conn)
+            conn.commit()
+    conn.close()
 
-    # Cases table
-    cases_list = get_cap_data()
-    for case in cases_list:
-        # Get Court ID - (name, name_abbr, date, court, text) - case[3]
-        statement = '''
-        SELECT Id
-        FROM DistrictCourts
-        WHERE Citation LIKE \"{}\"
-        '''.format(case[3])
-        cur.execute(statement)
-        result = cur.fetchone()
-        try:
-            id = result[0]
-        except:
-            id = None
-        case_l = list(case)
-        case_l.append(id)
-        case_l.remove(case_l[3])
-        new_tup = tuple(case_l)
+def create_meta_table(cur):
+    # Key/value bookkeeping for sync_db(): the high-water mark and any unfinished crawl cursors
+    statement = '''
+    CREATE TABLE IF NOT EXISTS Meta (
+    Key TEXT PRIMARY KEY,
+    Value TEXT
+    );
+    '''
+    cur.execute(statement)
 
+def bump_generation(cur):
+    # marks the data as changed, so results cached by QUERY_CACHE for the old data aren't used
+    create_meta_table(cur)
+    set_meta(cur, 'generation', uuid.uuid4().hex)
+
+def get_tokenizer_name(cur):
+    # the tokenizer this database's indexes were built with (databases from before there was a
+    # choice used str.split(), see tokenizer.py)
+    if not has_table(cur, 'Meta'):
+        return 'split'
+    return get_meta(cur, 'tokenizer', 'split')
+
+def get_court_ids(cur):
+    # court citations -> ids (lowercased, like the case-insensitive LIKE match this used to do)
+    court_ids = {}
+    for row in cur.execute("SELECT Id, Citation FROM DistrictCourts"):
+        court_ids.setdefault(row[1].lower(), row[0])
+    return court_ids
+
+def upsert_cases(cur, list_of_case_tups, court_ids, term_index=True):
+    # Inserts new cases and updates the ones (matched by CAP id) whose data has changed,
+    # keeping TermCounts/DateTotals in step. Returns the number of rows written.
+    rows = {}
+    for case in list_of_case_tups: # (name, name_abbr, date, court, text, cap_id)
+        rows[case[5]] = (case[5], case[0], case[1], date_to_day(case[2]), court_ids.get(case[3].lower()), case[4])
+    if not rows:
+        return 0
+
+    # looked up MAX_SQL_VARIABLES ids at a time, since a batch can have more
+    existing = {}
+    cap_ids = list(rows.keys())
+    for i in range(0, len(cap_ids), MAX_SQL_VARIABLES):
+        chunk = cap_ids[i:i + MAX_SQL_VARIABLES]
         statement = '''
-        INSERT INTO Cases (Name, NameAbbr, DecisionDate, CaseBody, CourtId)
-        VALUES (?, ?, ?, ?, ?)
-        '''
-        cur.execute(statement, new_tup)
-        conn.commit()
+        SELECT CapId, Name, NameAbbr, DecisionDate, CourtId, body_text(CaseBody)
+        FROM Cases
+        WHERE CapId IN ({})
+        '''.format(",".join("?" * len(chunk)))
+        for row in cur.execute(statement, chunk):
+            existing[row[0]] = row
 
-''' Functions that access and process data from the database '''
+    changed = [row for row in rows.values() if existing.get(row[0]) != row]
+    replaced = [existing[row[0]] for row in changed if row[0] in existing]
+
+    statement = '''
+    INSERT INTO Cases (CapId, Name, NameAbbr, DecisionDate, CourtId, CaseBody)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (CapId) DO UPDATE SET
+        Name = excluded.Name,
+        NameAbbr = excluded.NameAbbr,
+        DecisionDate = excluded.DecisionDate,
+        CourtId = excluded.CourtId,
+        CaseBody = excluded.CaseBody
+    '''
+    conn = cur.connection
+    key = latest_dict_key(conn) if CASEBODY_COMPRESSION == 'zstd' else None # once for the batch
+    cur.executemany(statement, [row[:5] + (compress_body(row[5], CASEBODY_COMPRESSION, conn, key),) for row in changed])
+
+    if term_index:
+        add_term_counts(cur, [(row[3], row[5]) for row in replaced], sign=-1)
+        add_term_counts(cur, [(row[3], row[5]) for row in changed])
 
-def get_cases_by_state():
-    conn = sqlite.connect(DBNAME)
+    return len(changed)
+
+def create_rollups(conn):
+    # (Re)builds the materialized number of district court cases per state from the Cases table
+    # (for all_cases and map_matching, see get_state_totals), and adds triggers that keep it
+    # current as cases are inserted, updated and deleted.
     cur = conn.cursor()
 
-    # Get total # of cases in all states
+    # (the other tables are rollups earlier versions kept but nothing read: dropped here so they
+    # go from existing databases too)
+    for table in ['CourtCounts', 'StateCounts', 'CircuitCounts', 'MonthCounts', 'PeriodCounts']:
+        cur.execute("DROP TABLE IF EXISTS {}".format(table))
+    for trigger in ['RollupsInsert', 'RollupsDelete', 'RollupsUpdate']:
+        cur.execute("DROP TRIGGER IF EXISTS {}".format(trigger))
+
+    cur.execute("CREATE TABLE StateCounts (StateId INTEGER PRIMARY KEY, Count INTEGER)")
+
     statement = '''
-    SELECT COUNT(*)
+    INSERT INTO StateCounts (StateId, Count)
+    SELECT DistrictCourts.StateId, COUNT(*)
     FROM Cases
     JOIN DistrictCourts
     ON Cases.CourtId = DistrictCourts.Id
-    JOIN States
-    ON DistrictCourts.StateId = States.Id
+    WHERE DistrictCourts.StateId IS NOT NULL
+    GROUP BY DistrictCourts.StateId
+    '''
+    cur.execute(statement)
+
+    # the same update, for one case being added (+1, new.*) or taken away (-1, old.*)
+    def rollup_updates(row, sign):
+        return '''
+        INSERT INTO StateCounts (StateId, Count)
+        SELECT StateId, {sign} FROM DistrictCourts WHERE Id = {row}.CourtId AND StateId IS NOT NULL
+        ON CONFLICT (StateId) DO UPDATE SET Count = Count + {sign};
+        '''.format(row=row, sign=sign)
+
+    statement = '''
+    CREATE TRIGGER IF NOT EXISTS RollupsInsert AFTER INSERT ON Cases BEGIN {}
+    END
+    '''.format(rollup_updates('new', 1))
+    cur.execute(statement)
+
+    statement = '''
+    CREATE TRIGGER IF NOT EXISTS RollupsDelete AFTER DELETE ON Cases BEGIN {}
+    END
+    '''.format(rollup_updates('old', -1))
+    cur.execute(statement)
+
+    statement = '''
+    CREATE TRIGGER IF NOT EXISTS RollupsUpdate AFTER UPDATE OF CourtId ON Cases BEGIN {} {}
+    END
+    '''.format(rollup_updates('old', -1), rollup_updates('new', 1))
+    cur.execute(statement)
+
+    conn.commit()
+
+def create_term_tables(cur):
+    # Token counts per decision date, and the total number of tokens per date, for time_plot.
+    # Tokens come from the database's tokenizer (see get_tokenizer_name), which queries use too.
+    # TermBuckets and TotalBuckets hold the same counts summed by week, month and year, so a long
+    # time_plot reads a few rows per period instead of one per day.
+    # upsert_cases() keeps these current when cases are added or changed. There's no trigger for
+    # deletes (tokenizing takes Python), and cases are never deleted (sync_db only adds and updates
+    # them), so a case deleted by hand stays counted until create_term_index() rebuilds the tables.
+    statement = '''
+    CREATE TABLE IF NOT EXISTS TermCounts (
+    Token TEXT,
+    DecisionDate INTEGER,
+    Count INTEGER,
+    PRIMARY KEY (Token, DecisionDate)
+    ) WITHOUT ROWID;
     '''
-    results = cur.execute(statement)
-    n_tup = results.fetchone()
-    n = n_tup[0] # n is an int representing the total # of district court cases in db
+    cur.execute(statement)
 
     statement = '''
-    SELECT States.Abbr, States.Name, COUNT(*)
+    CREATE TABLE IF NOT EXISTS DateTotals (
+    DecisionDate INTEGER PRIMARY KEY,
+    Total INTEGER
+    ) WITHOUT ROWID;
+    '''
+    cur.execute(statement)
+
+    statement = '''
+    CREATE TABLE IF NOT EXISTS TermBuckets (
+    Token TEXT,
+    Granularity TEXT,
+    Period INTEGER,
+    Count INTEGER,
+    PRIMARY KEY (Token, Granularity, Period)
+    ) WITHOUT ROWID;
+    '''
+    cur.execute(statement)
+
+    statement = '''
+    CREATE TABLE IF NOT EXISTS TotalBuckets (
+    Granularity TEXT,
+    Period INTEGER,
+    Total INTEGER,
+    PRIMARY KEY (Granularity, Period)
+    ) WITHOUT ROWID;
+    '''
+    cur.execute(statement)
+
+def add_term_counts(cur, list_of_cases, sign=1):
+    # Adds the tokens from a batch of (date, full text) tuples to TermCounts and DateTotals
+    # (or, with sign=-1, takes them away again, for cases that are being replaced).
+    # Counts are summed in memory first, so each (token, date) pair is one upsert per batch.
+    name = get_tokenizer_name(cur)
+    term_counts = {}
+    date_totals = {}
+    for date, text in list_of_cases:
+        tokens = tokenize(text, name)
+        date_totals[date] = date_totals.get(date, 0) + sign * len(tokens)
+        for token, count in collections.Counter(tokens).items():
+            key = (token, date)
+            term_counts[key] = term_counts.get(key, 0) + sign * count
+
+    # the same counts, summed into the week, month and year each date falls in
+    periods = {}
+    for date in date_totals:
+        periods[date] = [(granularity, period_start(date, granularity)) for granularity in GRANULARITIES[1:]]
+    bucket_counts = {}
+    bucket_totals = {}
+    for date in date_totals:
+        for key in periods[date]:
+            bucket_totals[key] = bucket_totals.get(key, 0) + date_totals[date]
+    for (token, date), count in term_counts.items():
+        for granularity, period in periods[date]:
+            key = (token, granularity, period)
+            bucket_counts[key] = bucket_counts.get(key, 0) + count
+
+    statement = '''
+    INSERT INTO TermCounts (Token, DecisionDate, Count)
+    VALUES (?, ?, ?)
+    ON CONFLICT (Token, DecisionDate) DO UPDATE SET Count = Count + excluded.Count
+    '''
+    cur.executemany(statement, [(key[0], key[1], term_counts[key]) for key in term_counts])
+
+    statement = '''
+    INSERT INTO DateTotals (DecisionDate, Total)
+    VALUES (?, ?)
+    ON CONFLICT (DecisionDate) DO UPDATE SET Total = Total + excluded.Total
+    '''
+    cur.executemany(statement, list(date_totals.items()))
+
+    statement = '''
+    INSERT INTO TermBuckets (Token, Granularity, Period, Count)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT (Token, Granularity, Period) DO UPDATE SET Count = Count + excluded.Count
+    '''
+    cur.executemany(statement, [key + (bucket_counts[key],) for key in bucket_counts])
+
+    statement = '''
+    INSERT INTO TotalBuckets (Granularity, Period, Total)
+    VALUES (?, ?, ?)
+    ON CONFLICT (Granularity, Period) DO UPDATE SET Total = Total + excluded.Total
+    '''
+    cur.executemany(statement, [key + (bucket_totals[key],) for key in bucket_totals])
+
+    if sign < 0:
+        statement = "DELETE FROM TermCounts WHERE Token = ? AND DecisionDate = ? AND Count <= 0"
+        cur.executemany(statement, list(term_counts.keys()))
+        statement = "DELETE FROM TermBuckets WHERE Token = ? AND Granularity = ? AND Period = ? AND Count <= 0"
+        cur.executemany(statement, list(bucket_counts.keys()))
+
+def fill_term_buckets(cur):
+    # fills TermBuckets and TotalBuckets from TermCounts and DateTotals (for migrate_dates())
+    for granularity in GRANULARITIES[1:]:
+        period = period_sql(granularity, 'DecisionDate')
+        statement = '''
+        INSERT INTO TermBuckets (Token, Granularity, Period, Count)
+        SELECT Token, ?, {0}, SUM(Count)
+        FROM TermCounts
+        GROUP BY Token, {0}
+        '''.format(period)
+        cur.execute(statement, (granularity,))
+
+        statement = '''
+        INSERT INTO TotalBuckets (Granularity, Period, Total)
+        SELECT ?, {0}, SUM(Total)
+        FROM DateTotals
+        GROUP BY {0}
+        '''.format(period)
+        cur.execute(statement, (granularity,))
+
+def create_term_index(conn, tokenizer=TOKENIZER):
+    # (Re)builds TermCounts and DateTotals (and their buckets) from the cases already in the
+    # database, e.g. to add them to a law.db that was built before they existed, or to switch it
+    # to another tokenizer (the full-text index is then rebuilt with that tokenizer too)
+    check_tokenizer(tokenizer)
+    cur = conn.cursor()
+    create_meta_table(cur)
+    retokenize = get_tokenizer_name(cur) != tokenizer
+    set_meta(cur, 'tokenizer', tokenizer)
+    for table in ['TermCounts', 'DateTotals', 'TermBuckets', 'TotalBuckets']:
+        cur.execute("DROP TABLE IF EXISTS {}".format(table))
+    create_term_tables(cur)
+
+    statement = '''
+    SELECT DecisionDate, body_text(CaseBody)
     FROM Cases
-    JOIN DistrictCourts
-    ON Cases.CourtId = DistrictCourts.Id
-    JOIN States
-    ON DistrictCourts.StateId = States.Id
-    GROUP BY States.Abbr
     '''
-    results = cur.execute(statement)
-    result_list = results.fetchall() # list of tuples
+    results = conn.execute(statement)
+    while True:
+        batch = results.fetchmany(INSERT_BATCH_SIZE)
+        if not batch:
+            break
+        add_term_counts(cur, batch)
+
+    bump_generation(cur)
+    conn.commit()
+
+    if retokenize and has_fts_index(cur):
+        create_fts_index(conn)
+
+def create_fts_index(conn):
+    # FTS5 full-text index over Cases.CaseBody (stored as an "external content" table, so the text
+    # isn't duplicated), plus triggers that keep it in sync when Cases changes. It's filled from
+    # body_text() rather than with FTS5's 'rebuild', since CaseBody may be compressed, and through
+    # index_text(), so it holds the same tokens as the term index. FTS5 then splits that text
+    # again, with FTS_TOKENIZE, which has to keep the apostrophes tokenize() leaves in words.
+    # This can also be run by hand to add the index to an existing database.
+    cur = conn.cursor()
+    text = "index_text(body_text({{}}.CaseBody), '{}')".format(get_tokenizer_name(cur))
+
+    statement = "DROP TABLE IF EXISTS CasesFts"
+    cur.execute(statement)
+    for trigger in ['CasesFtsInsert', 'CasesFtsDelete', 'CasesFtsUpdate']:
+        cur.execute("DROP TRIGGER IF EXISTS {}".format(trigger))
+
+    statement = '''
+    CREATE VIRTUAL TABLE CasesFts
+    USING fts5(CaseBody, content='Cases', content_rowid='Id', tokenize="{}")
+    '''.format(FTS_TOKENIZE)
+    try:
+        cur.execute(statement)
+    except sqlite.OperationalError:
+        print("This version of SQLite doesn't support FTS5, so word searches will scan every case.")
+        return
+
+    statement = "INSERT INTO CasesFts(rowid, CaseBody) SELECT Id, {} FROM Cases".format(text.format('Cases'))
+    cur.execute(statement)
+
+    statement = '''
+    CREATE TRIGGER IF NOT EXISTS CasesFtsInsert AFTER INSERT ON Cases BEGIN
+        INSERT INTO CasesFts(rowid, CaseBody) VALUES (new.Id, {new});
+    END
+    '''.format(new=text.format('new'))
+    cur.execute(statement)
+
+    statement = '''
+    CREATE TRIGGER IF NOT EXISTS CasesFtsDelete AFTER DELETE ON Cases BEGIN
+        INSERT INTO CasesFts(CasesFts, rowid, CaseBody) VALUES ('delete', old.Id, {old});
+    END
+    '''.format(old=text.format('old'))
+    cur.execute(statement)
+
+    statement = '''
+    CREATE TRIGGER IF NOT EXISTS CasesFtsUpdate AFTER UPDATE OF CaseBody ON Cases
+    WHEN body_text(old.CaseBody) IS NOT body_text(new.CaseBody) BEGIN
+        INSERT INTO CasesFts(CasesFts, rowid, CaseBody) VALUES ('delete', old.Id, {old});
+        INSERT INTO CasesFts(rowid, CaseBody) VALUES (new.Id, {new});
+    END
+    '''.format(old=text.format('old'), new=text.format('new'))
+    cur.execute(statement)
+
+    bump_generation(cur)
+    conn.commit()
+
+def compress_db(codec='zlib', dict_samples=2000):
+    # Rewrites every CaseBody in an existing database in the given format (None decompresses them
+    # all again), then VACUUMs to give the space back. For 'zstd', a dictionary is trained on a
+    # sample of the cases first. New cases use CASEBODY_COMPRESSION, so set that to match.
+    conn = connect(DBNAME)
+    cur = conn.cursor()
+
+    if codec == 'zstd':
+        statement = "SELECT body_text(CaseBody) FROM Cases ORDER BY RANDOM() LIMIT ?"
+        samples = [row[0] for row in cur.execute(statement, (dict_samples,)) if row[0]]
+        train_dict(conn, samples)
+    key = latest_dict_key(conn) if codec == 'zstd' else None
+
+    # walk the table by Id, a batch at a time, so no cursor is open while rows are updated
+    statement = '''
+    SELECT Id, body_text(CaseBody)
+    FROM Cases
+    WHERE Id > ?
+    ORDER BY Id
+    LIMIT ?
+    '''
+    last_id = -1
+    while True:
+        batch = cur.execute(statement, (last_id, INSERT_BATCH_SIZE)).fetchall()
+        if not batch:
+            break
+        rows = [(compress_body(text, codec, conn, key), id) for id, text in batch]
+        cur.executemany("UPDATE Cases SET CaseBody = ? WHERE Id = ?", rows)
+        last_id = batch[-1][0]
+    conn.commit()
+
+    cur.execute("VACUUM")
+    conn.close()
+
+''' Functions that access and process data from the database '''
+
+def has_table(cur, name):
+    statement = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?"
+    return cur.execute(statement, (name,)).fetchone() is not None
+
+def has_fts_index(cur):
+    return has_table(cur, 'CasesFts')
+
+def has_fts_tokenize(cur):
+    # whether the CasesFts table was created with FTS_TOKENIZE
+    statement = "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'CasesFts'"
+    return FTS_TOKENIZE in cur.execute(statement).fetchone()[0]
+
+def word_condition(cur, word):
+    # Returns a WHERE condition (and its parameter) selecting the cases that contain word.
+    # With the FTS index this is a whole-token (or, for "several words", whole-phrase) match;
+    # without it, it falls back to tokenizing every CaseBody (see tokenizer.match_condition).
+    # Either way, word is normalized by the same tokenizer as the text was.
+    name = get_tokenizer_name(cur)
+    if has_fts_index(cur):
+        phrase = " ".join(normalize_phrase(word, name))
+        if not phrase:
+            return ("Cases.Id IS ?", None) # nothing left of it (just punctuation), so no matches
+        phrase = '"{}"'.format(phrase.replace('"', '""'))
+        return ("Cases.Id IN (SELECT rowid FROM CasesFts WHERE CasesFts MATCH ?)", phrase)
+    return match_condition(word, name)
+
+def data_stamp():
+    # identifies the database and the current version of its data, for QUERY_CACHE keys
+    cur = get_connection(DBNAME).cursor()
+    generation = None
+    if has_table(cur, 'Meta'):
+        generation = get_meta(cur, 'generation')
+    return [os.path.abspath(DBNAME), generation]
+
+def normalize_word(args):
+    # word searches ignore (ASCII) case, so 'Woman' and 'woman ' share a cache entry
+    word = args[0].strip()
+    if word.isascii():
+        word = word.lower()
+    return [word] + list(args[1:])
+
+def date_range_condition(date_min=None, date_max=None):
+    # WHERE condition (and its parameters) for the cases decided from date_min to date_max
+    # (ISO dates, either one optional)
+    return day_condition(date_to_day(date_min), date_to_day(date_max))
+
+def get_state_totals(cur, date_min=None, date_max=None):
+    # the number of district court cases in each state (decided from date_min to date_max), from
+    # the StateCounts rollup if there is one and the dates aren't limited
+    days, day_params = date_range_condition(date_min, date_max)
+    if has_table(cur, 'StateCounts') and not day_params:
+        statement = '''
+        SELECT States.Abbr, States.Name, SUM(StateCounts.Count)
+        FROM StateCounts
+        JOIN States
+        ON StateCounts.StateId = States.Id
+        WHERE StateCounts.Count > 0
+        GROUP BY States.Abbr
+        '''
+    else:
+        statement = '''
+        SELECT States.Abbr, States.Name, COUNT(*)
+        FROM Cases
+        JOIN DistrictCourts
+        ON Cases.CourtId = DistrictCourts.Id
+        JOIN States
+        ON DistrictCourts.StateId = States.Id
+        WHERE {}
+        GROUP BY States.Abbr
+        '''.format(days)
+    results = cur.execute(statement, day_params)
+    return results.fetchall() # list of tuples: (state_abbr, state_name, count)
+
+@TIMERS.timed('query')
+@QUERY_CACHE.cached(data_stamp)
+def get_cases_by_state(date_min=None, date_max=None):
+    conn = get_connection(DBNAME)
+    cur = conn.cursor()
+
+    result_list = get_state_totals(cur, date_min, date_max) # list of tuples
+
+    # Get total # of cases in all states
+    n = sum(result_tup[2] for result_tup in result_list) # n is an int representing the total # of district court cases in db
 
     return_list = []
 
@@ -302,122 +998,364 @@ def get_cases_by_state():
 
     return return_list # list of tuples: (state_abbr, state_name, count, percent)
 
-def get_percent_by_state_containing(word):
-    conn = sqlite.connect(DBNAME)
+def get_percent_by_state_containing(word, date_min=None, date_max=None):
+    return get_percent_by_state_containing_all([word], date_min, date_max)[0] # list of tuples: (abbr, percent)
+
+@TIMERS.timed('query')
+def get_percent_by_state_containing_all(list_of_words, date_min=None, date_max=None):
+    # Like get_percent_by_state_containing(), for several words at once: returns one list of
+    # (abbr, percent) tuples per word. Each word's result is cached on its own, and the words that
+    # aren't cached yet are counted together (see count_cases_by_state_containing).
+    conn = get_connection(DBNAME)
     cur = conn.cursor()
 
-    # get # of cases in each state
+    stamp = data_stamp()
+    results = {}
+    for word in list_of_words:
+        result = QUERY_CACHE.get(make_key(stamp, 'get_percent_by_state_containing', normalize_word([word, date_min, date_max])))
+        if result is not None:
+            results[word] = result
+
+    missing_words = [word for word in dict.fromkeys(list_of_words) if word not in results]
+    if missing_words:
+        # get # of cases in each state
+        state_list = get_state_totals(cur, date_min, date_max) # list of tuples
+        total_dict = {}
+        for state in state_list:
+            total_dict[state[0]] = state[2] # keys are state abbreviations, values are total # of cases
+
+        # get # of cases containing each word in each state
+        matching_dicts = count_cases_by_state_containing(cur, missing_words, SCAN_WORKERS, date_min, date_max)
+
+        for word in missing_words:
+            case_matching_dict = matching_dicts[word] # keys are state abbreviations, values are # of cases matching word
+
+            return_list = []
+            for state in list(total_dict.keys()):
+                if state in case_matching_dict:
+                    percent = case_matching_dict[state]/total_dict[state]
+                else:
+                    percent = 0
+                return_list.append((state, percent))
+
+            QUERY_CACHE.put(make_key(stamp, 'get_percent_by_state_containing', normalize_word([word, date_min, date_max])), return_list)
+            results[word] = return_list
+
+    return [copy_result(results[word]) for word in list_of_words]
+
+def count_cases_by_state_containing(cur, list_of_words, workers=SCAN_WORKERS, date_min=None, date_max=None):
+    # Returns {word: {state abbr: # of district court cases containing word}}. With the FTS index
+    # each word is its own indexed query; otherwise all of the words are looked for in the same
+    # scan of the case text, split across worker processes (see scanengine.py).
+    day_min, day_max = date_to_day(date_min), date_to_day(date_max)
+    if not has_fts_index(cur):
+        args = (list_of_words, get_tokenizer_name(cur), day_min, day_max)
+        return merge_state_counts(run_scan(DBNAME, count_states_in_rows, args, workers))
+
+    days, day_params = day_condition(day_min, day_max)
+    matching_dicts = {}
+    for word in list_of_words:
+        condition, param = word_condition(cur, word)
+        statement = '''
+        SELECT States.Abbr, COUNT(*)
+        FROM Cases
+        JOIN DistrictCourts
+        ON Cases.CourtId = DistrictCourts.Id
+        JOIN States
+        ON DistrictCourts.StateId = States.Id
+        WHERE {} AND {}
+        GROUP BY States.Abbr
+        '''.format(condition, days)
+        results = cur.execute(statement, (param,) + day_params)
+        matching_dicts[word] = dict(results.fetchall())
+    return matching_dicts
+
+@TIMERS.timed('query')
+@QUERY_CACHE.cached(data_stamp, normalize_word)
+def get_list_of_cases_containing(word, date_min=None, date_max=None):
+    conn = get_connection(DBNAME)
+    cur = conn.cursor()
+    day_min, day_max = date_to_day(date_min), date_to_day(date_max)
+    if not has_fts_index(cur):
+        # a scan of every case, split across worker processes
+        args = (word, get_tokenizer_name(cur), day_min, day_max)
+        return merge_matching_cases(run_scan(DBNAME, find_cases_in_rows, args, SCAN_WORKERS))
+
+    condition, param = word_condition(cur, word)
+    days, day_params = day_condition(day_min, day_max)
     statement = '''
-    SELECT States.Abbr, COUNT(*)
+    SELECT States.Abbr, States.Name, Cases.Name, Cases.NameAbbr, DistrictCourts.CourtName, DistrictCourts.Citation
     FROM Cases
     JOIN DistrictCourts
     ON Cases.CourtId = DistrictCourts.Id
     JOIN States
     ON DistrictCourts.StateId = States.Id
-    GROUP BY States.Abbr
-    '''
-    results = cur.execute(statement)
-    state_list = results.fetchall() # list of tuples
-    total_dict = {}
-    for state in state_list:
-        total_dict[state[0]] = state[1] # keys are state abbreviations, values are total # of cases
+    WHERE {} AND {}
+    ORDER BY States.Abbr
+    '''.format(condition, days)
 
-    # get # of cases containing word in each state
+    results = cur.execute(statement, (param,) + day_params)
+    result_list = results.fetchall()
+
+    return result_list # list of tuples: (state abbr, state name, case name, case abbr, court name, court abbr)
+
+@TIMERS.timed('query')
+def get_page_of_cases_containing(word, after=0, page_size=CASES_PAGE_SIZE, date_min=None, date_max=None):
+    # One page of the cases containing word, in Id order, starting after the case with Id after.
+    # Returns (list of tuples like get_list_of_cases_containing's, the after value for the next
+    # page or None if this is the last one). Keyset pagination: each page is a search that stops
+    # as soon as it has page_size rows, so nothing past the current page is read.
+    conn = get_connection(DBNAME)
+    cur = conn.cursor()
+    condition, param = word_condition(cur, word)
+    days, day_params = date_range_condition(date_min, date_max)
     statement = '''
-    SELECT States.Abbr, COUNT(*)
+    SELECT Cases.Id, States.Abbr, States.Name, Cases.Name, Cases.NameAbbr, DistrictCourts.CourtName, DistrictCourts.Citation
     FROM Cases
     JOIN DistrictCourts
     ON Cases.CourtId = DistrictCourts.Id
     JOIN States
     ON DistrictCourts.StateId = States.Id
-    WHERE Cases.CaseBody LIKE \"%{}%\"
-    GROUP BY States.Abbr
-    '''.format(word)
-    results = cur.execute(statement)
-    case_matching_list = results.fetchall()
-
-    case_matching_dict = {}
-    for case in case_matching_list:
-        case_matching_dict[case[0]] = case[1] # keys are state abbreviations, values are # of cases matching word
-
-    result_dict = {}
-    for state in list(total_dict.keys()):
-        if state in case_matching_dict:
-            result_dict[state] = case_matching_dict[state]/total_dict[state]
-        else:
-            result_dict[state] = 0
-
-    return_list = []
-    for state in list(result_dict.keys()):
-        abbr = state
-        percent = result_dict[state]
-        tup = (abbr, percent)
-        return_list.append(tup)
-
-    return return_list # list of tuples: (abbr, percent)
-
-def get_list_of_cases_containing(word):
-    conn = sqlite.connect(DBNAME)
+    WHERE Cases.Id > ? AND {} AND {}
+    ORDER BY Cases.Id
+    LIMIT ?
+    '''.format(condition, days)
+
+    # one extra row, to tell whether there is a next page
+    result_list = cur.execute(statement, (after, param) + day_params + (page_size + 1,)).fetchall()
+    next_after = None
+    if len(result_list) > page_size:
+        result_list = result_list[:page_size]
+        next_after = result_list[-1][0]
+
+    return ([case[1:] for case in result_list], next_after)
+
+def iter_cases_containing(word, batch_size=1000, date_min=None, date_max=None):
+    # every case containing word, fetched batch_size at a time
+    after = 0
+    while after is not None:
+        case_list, after = get_page_of_cases_containing(word, after, batch_size, date_min, date_max)
+        for case in case_list:
+            yield case
+
+@TIMERS.timed('query')
+@QUERY_CACHE.cached(data_stamp, normalize_word)
+def estimate_count_of_cases_containing(word, date_min=None, date_max=None):
+    # Returns (# of district court cases containing word, whether that's exact). With the FTS index
+    # the count is exact and cheap; without it, counting means reading every case, so it's estimated
+    # from a random sample of ESTIMATE_SAMPLE_SIZE cases instead (unless there are fewer than that).
+    conn = get_connection(DBNAME)
     cur = conn.cursor()
-    statement = '''
-    SELECT States.Abbr, States.Name, Cases.Name, Cases.NameAbbr, DistrictCourts.CourtName, DistrictCourts.Citation
+    condition, param = word_condition(cur, word)
+    days, day_params = date_range_condition(date_min, date_max)
+    # (the same joins as the page and list queries, and as the state totals it's scaled by)
+    count_statement = '''
+    SELECT COUNT(*)
     FROM Cases
     JOIN DistrictCourts
     ON Cases.CourtId = DistrictCourts.Id
     JOIN States
     ON DistrictCourts.StateId = States.Id
-    WHERE Cases.CaseBody LIKE \"%{}%\"
-    ORDER BY States.Abbr
-    '''.format(word)
-
-    results = cur.execute(statement)
-    result_list = results.fetchall()
-
-    return result_list # list of tuples: (state abbr, state name, case name, case abbr, court name, court abbr)
-
-def get_freq_by_time_for(list_of_words):
-    conn = sqlite.connect(DBNAME)
-    cur = conn.cursor()
-    statement = '''
-    SELECT DecisionDate, CaseBody
-    FROM Cases
-    '''
-    results = cur.execute(statement)
-    result_list = results.fetchall() # list of tuples representing every case: (date, full text)
-
-    date_dictionary = {} # date_dictionary will have dates as keys, list of words all words from that day as values
-    for result in result_list:
-        if result[0] not in date_dictionary:
-            date_dictionary[result[0]] = result[1].split()
+    WHERE {} AND ''' + days
+
+    total = sum([state[2] for state in get_state_totals(cur, date_min, date_max)])
+    if has_fts_index(cur) or total <= ESTIMATE_SAMPLE_SIZE:
+        return (cur.execute(count_statement.format(condition), (param,) + day_params).fetchone()[0], True)
+
+    first_id, last_id = cur.execute("SELECT MIN(Id), MAX(Id) FROM Cases").fetchone()
+    sample_ids = random.sample(range(first_id, last_id + 1), min(ESTIMATE_SAMPLE_SIZE, last_id - first_id + 1))
+    id_condition = "Cases.Id IN ({})".format(", ".join(["?"] * len(sample_ids)))
+    sampled = cur.execute(count_statement.format(id_condition), sample_ids + list(day_params)).fetchone()[0]
+    if sampled == 0:
+        return (0, False)
+    matched = cur.execute(count_statement.format(id_condition + " AND " + condition),
+        sample_ids + [param] + list(day_params)).fetchone()[0]
+    return (round(total * matched / sampled), False)
+
+def export_cases_containing(word, fname, date_min=None, date_max=None):
+    # Streams every case containing word to a CSV or (if fname ends in .jsonl) JSON Lines file,
+    # without holding them all in memory. Returns the number of cases written.
+    header_list = ["state_abbr", "state_name", "case_name", "case_abbr", "court_name", "court_abbr"]
+    count = 0
+    with open(fname, 'w', newline='', encoding='utf-8') as f:
+        if fname.endswith('.jsonl'):
+            for case in iter_cases_containing(word, date_min=date_min, date_max=date_max):
+                f.write(json.dumps(dict(zip(header_list, case))) + "\n")
+                count += 1
         else:
-            val = date_dictionary[result[0]]
-            val += result[1].split() # append all the new words
-            date_dictionary[result[0]] = val
+            writer = csv.writer(f)
+            writer.writerow(header_list)
+            for case in iter_cases_containing(word, date_min=date_min, date_max=date_max):
+                writer.writerow(case)
+                count += 1
+    return count
+
+@TIMERS.timed('query')
+def get_freq_by_time_for(list_of_words, workers=SCAN_WORKERS, granularity='day', date_min=None, date_max=None):
+    # Each word's {date: frequency} dict is cached on its own, so a command that overlaps an
+    # earlier one (e.g. 'time_plot women gender' after 'time_plot woman women') only works out
+    # the new words. With a granularity of 'week', 'month' or 'year', the dates are the first
+    # day of each period and the frequencies are for the whole period; date_min and date_max
+    # (ISO dates, either one optional) limit the cases counted. Words are normalized like the
+    # case text was (so 'Woman,' is 'woman'), and words that normalize alike share a cache entry.
+    check_granularity(granularity)
+    name = get_tokenizer_name(get_connection(DBNAME).cursor())
+    terms = [" ".join(normalize_phrase(word, name)) for word in list_of_words]
+
+    stamp = data_stamp()
+    term_dicts = {}
+    for term in terms:
+        term_dict = QUERY_CACHE.get(make_key(stamp, 'get_freq_by_time_for', term, granularity, date_min, date_max))
+        if term_dict is not None:
+            term_dicts[term] = term_dict
+
+    missing_terms = [term for term in dict.fromkeys(terms) if term not in term_dicts]
+    if missing_terms:
+        term_dict_list = get_freq_by_time_uncached(missing_terms, workers, granularity, date_to_day(date_min), date_to_day(date_max))
+        for term, term_dict in zip(missing_terms, term_dict_list):
+            QUERY_CACHE.put(make_key(stamp, 'get_freq_by_time_for', term, granularity, date_min, date_max), term_dict)
+            term_dicts[term] = term_dict
+
+    return [copy_result(term_dicts[term]) for term in terms]
+
+def get_freq_by_time_uncached(list_of_words, workers=SCAN_WORKERS, granularity='day', day_min=None, day_max=None):
+    # list_of_words are tokens, already normalized by the database's tokenizer
+    conn = get_connection(DBNAME)
+    cur = conn.cursor()
 
+    if has_table(cur, 'TermCounts'):
+        return get_freq_by_time_from_index(cur, list_of_words, granularity, day_min, day_max)
+
+    # No index, so scan every case. Only the per-date counts are kept in memory, and all of the
+    # words are counted in the same pass (split across worker processes, see scanengine.py).
+    words = set(list_of_words)
+    args = (words, get_tokenizer_name(cur), day_min, day_max)
+    date_totals, word_counts = merge_token_counts(run_scan(DBNAME, count_words_in_rows, args, workers))
+
+    period_totals = {}
+    for date in date_totals:
+        period = period_start(date, granularity)
+        period_totals[period] = period_totals.get(period, 0) + date_totals[date]
+    period_counts = {}
+    for (word, date), count in word_counts.items():
+        key = (word, period_start(date, granularity))
+        period_counts[key] = period_counts.get(key, 0) + count
+
+    return freq_dicts(list_of_words, period_totals, period_counts)
+
+def freq_dicts(list_of_words, period_totals, period_counts):
+    # {period: total # of tokens} and {(word, period): count} -> one {ISO date: frequency} dict per
+    # word, in date order
     list_of_dicts = []
 
     for word in list_of_words:
         word_dict = {}
-        for date in list(date_dictionary.keys()):
-            count = 0
-            for token in date_dictionary[date]:
-                if token == word:
-                    count += 1
-            word_dict[date] = count/len(date_dictionary[date])
+        for period in sorted(period_totals):
+            if period_totals[period] > 0:
+                word_dict[day_to_date(period)] = period_counts.get((word, period), 0)/period_totals[period]
+            else:
+                word_dict[day_to_date(period)] = 0
         list_of_dicts.append(word_dict)
 
     return list_of_dicts # list of dictionaries corresponding to each word where key is date and value is frequency of the word
 
+def get_freq_by_time_from_index(cur, list_of_words, granularity='day', day_min=None, day_max=None):
+    # Same result as the full scan in get_freq_by_time_uncached(), but answered from the term
+    # index: one indexed lookup per word, however many cases there are. Whole periods come from
+    # TermBuckets/TotalBuckets; only the part-periods at the ends of a date range are summed from
+    # the per-date TermCounts/DateTotals rows.
+    buckets, edges = split_day_range(day_min, day_max, granularity)
+    period_totals = {}
+    period_counts = {}
+
+    if buckets is not None:
+        condition, params = day_condition(buckets[0], buckets[1], "Period")
+        statement = '''
+        SELECT Period, Total
+        FROM TotalBuckets
+        WHERE Granularity = ? AND {}
+        '''.format(condition)
+        period_totals.update(cur.execute(statement, (granularity,) + params).fetchall())
+
+        statement = '''
+        SELECT Period, Count
+        FROM TermBuckets
+        WHERE Token = ? AND Granularity = ? AND {}
+        '''.format(condition)
+        for word in list_of_words:
+            for period, count in cur.execute(statement, (word, granularity) + params).fetchall():
+                period_counts[(word, period)] = count
+
+    for first, last in edges:
+        condition, params = day_condition(first, last, "DecisionDate")
+        statement = '''
+        SELECT DecisionDate, Total
+        FROM DateTotals
+        WHERE {}
+        '''.format(condition)
+        for date, total in cur.execute(statement, params).fetchall(): # list of tuples: (date, total # of tokens)
+            period = period_start(date, granularity)
+            period_totals[period] = period_totals.get(period, 0) + total
+
+        statement = '''
+        SELECT DecisionDate, Count
+        FROM TermCounts
+        WHERE Token = ? AND {}
+        '''.format(condition)
+        for word in list_of_words:
+            for date, count in cur.execute(statement, (word,) + params).fetchall():
+                key = (word, period_start(date, granularity))
+                period_counts[key] = period_counts.get(key, 0) + count
+
+    return freq_dicts(list_of_words, period_totals, period_counts)
+
 ''' Functions that display data '''
 
+plotly_credentials_set = False
+
+def show_figure(name, key_args, build):
+    # Shows the figure that build() returns. Offline, figures are cached by name, key_args (which
+    # should include everything the figure depends on besides the data) and the data's generation,
+    # so build() isn't even called if the same figure has been drawn before.
+    global plotly_credentials_set
+
+    def timed_build():
+        with TIMERS.timer("figure:" + name):
+            return build()
+
+    if PLOT_MODE == 'cloud':
+        import plotly
+        import plotly.plotly as py
+        if not plotly_credentials_set:
+            plotly.tools.set_credentials_file(username=get_secret('PLOTLY_USERNAME'), api_key=get_secret('PLOTLY_API_KEY'))
+            plotly_credentials_set = True
+        with TIMERS.timer("render:" + name):
+            py.plot(timed_build(), filename=name)
+        return None
+    with TIMERS.timer("render:" + name): # its self time is writing (or just reopening) the file
+        return FIGURE_CACHE.show(name, make_key(data_stamp(), name, key_args), timed_build, PLOT_FORMAT)
+
+def date_range_label(date_min=None, date_max=None):
+    # for figure titles: ' (from 2016-01-01 to 2016-12-31)', ' (since 2016-01-01)', ...
+    if date_min and date_max:
+        return " (from {} to {})".format(date_min, date_max)
+    if date_min:
+        return " (since {})".format(date_min)
+    if date_max:
+        return " (through {})".format(date_max)
+    return ""
+
 '''
 A choropleth map (https://www.plot.ly/python/choropleth-maps/) of the United States that presents the number of district/territorial court cases from each state (that is, the sum of the count of cases in each of the districts comprising the state).
 
 Helper function: get_cases_by_state() returns list of tuples: (state_abbr, state_name, count, percent)
 '''
-def make_map_of_cases(): # (state_abbr, state_name, count, percent)
+def make_map_of_cases(date_min=None, date_max=None):
+    show_figure('total-cases-by-state', [date_min, date_max], lambda: build_map_of_cases(date_min, date_max))
+
+def build_map_of_cases(date_min=None, date_max=None): # (state_abbr, state_name, count, percent)
 
-    list_of_cases_by_state = get_cases_by_state()
+    list_of_cases_by_state = get_cases_by_state(date_min, date_max)
 
     state_list = []
     z_list = []
@@ -446,7 +1384,7 @@ def make_map_of_cases(): # (state_abbr, state_name, count, percent)
         ) ]
 
     layout = dict(
-        title = 'Number of U.S. District Court Cases by State',
+        title = 'Number of U.S. District Court Cases by State' + date_range_label(date_min, date_max),
         geo = dict(
             scope='usa',
             projection=dict( type='albers usa' ),
@@ -455,7 +1393,7 @@ def make_map_of_cases(): # (state_abbr, state_name, count, percent)
              )
 
     fig = dict(data=data, layout=layout)
-    py.plot(fig, filename='total-cases-by-state')
+    return fig
 
 # make_map_of_cases()
 
@@ -464,9 +1402,12 @@ A choropleth map of the United States that presents the percentage of court case
 
 Helper function: get_percent_by_state_containing(word) returns list of tuples: (abbr, percent)
 '''
-def make_map_of_word(word):
+def make_map_of_word(word, date_min=None, date_max=None):
+    show_figure('word-by-state', normalize_word([word, date_min, date_max]), lambda: build_map_of_word(word, date_min, date_max))
+
+def build_map_of_word(word, date_min=None, date_max=None):
 
-    state_percent_list = get_percent_by_state_containing(word)
+    state_percent_list = get_percent_by_state_containing(word, date_min, date_max)
 
     state_list = []
     z_list = []
@@ -495,7 +1436,7 @@ def make_map_of_word(word):
         ) ]
 
     layout = dict(
-        title = 'Percentage of U.S. District Court Cases Containing \"{}\" by State'.format(word),
+        title = 'Percentage of U.S. District Court Cases Containing \"{}\" by State'.format(word) + date_range_label(date_min, date_max),
         geo = dict(
             scope='usa',
             projection=dict( type='albers usa' ),
@@ -504,18 +1445,112 @@ def make_map_of_word(word):
              )
 
     fig = dict(data=data, layout=layout)
-    py.plot(fig, filename='word-by-state')
+    return fig
 
 # make_map_of_word("woman")
 
+MAPS_PER_ROW = 3
+
+def make_maps_of_words(list_of_words, date_min=None, date_max=None):
+    key_args = [normalize_word([word]) for word in list_of_words] + [date_min, date_max]
+    show_figure('words-by-state', key_args, lambda: build_maps_of_words(list_of_words, date_min, date_max))
+
+def build_maps_of_words(list_of_words, date_min=None, date_max=None):
+    # Small multiples: one map per word, side by side on one page, all on the same color scale so
+    # the shading can be compared from map to map. The percentages for every word come from one
+    # pass over the cases (see get_percent_by_state_containing_all).
+    percent_lists = get_percent_by_state_containing_all(list_of_words, date_min, date_max)
+
+    scl = [[0.0, 'rgb(242,240,247)'],[0.2, 'rgb(218,218,235)'],[0.4, 'rgb(188,189,220)'],[0.6, 'rgb(158,154,200)'],[0.8, 'rgb(117,107,177)'],[1.0, 'rgb(84,39,143)']]
+    z_max = max([round(state[1],2) for percent_list in percent_lists for state in percent_list] + [0.01])
+
+    columns = min(MAPS_PER_ROW, len(list_of_words))
+    rows = (len(list_of_words) + columns - 1) // columns
+
+    data = []
+    layout = dict(
+        title = 'Percentage of U.S. District Court Cases Containing Each Word by State' + date_range_label(date_min, date_max),
+        annotations = [],
+        )
+
+    for i in range(len(list_of_words)):
+        geo = 'geo' if i == 0 else 'geo{}'.format(i + 1)
+        row = i // columns
+        column = i % columns
+        x_domain = [column / columns, (column + 1) / columns]
+        y_domain = [1 - (row + 1) / rows, 1 - row / rows - 0.05 / rows] # leaves room for the word
+
+        data.append(dict(
+            type='choropleth',
+            colorscale = scl,
+            autocolorscale = False,
+            locations = [state[0] for state in percent_lists[i]],
+            z = [round(state[1],2) for state in percent_lists[i]],
+            zmin = 0,
+            zmax = z_max,
+            locationmode = 'USA-states',
+            geo = geo,
+            showscale = (i == 0), # one colorbar for all of the maps
+            marker = dict(
+                line = dict (
+                    color = 'rgb(255,255,255)',
+                    width = 1
+                ) ),
+            colorbar = dict(
+                title = "Percentage of Cases")
+            ))
+
+        layout[geo] = dict(
+            scope='usa',
+            projection=dict( type='albers usa' ),
+            showlakes = True,
+            lakecolor = 'rgb(255, 255, 255)',
+            domain = dict(x = x_domain, y = y_domain))
+
+        layout['annotations'].append(dict(
+            text = '\"{}\"'.format(list_of_words[i]),
+            showarrow = False,
+            xref = 'paper',
+            yref = 'paper',
+            x = sum(x_domain) / 2,
+            y = y_domain[1] + 0.04 / rows,
+            xanchor = 'center',
+            yanchor = 'bottom'))
+
+    fig = dict(data=data, layout=layout)
+    return fig
+
+# make_maps_of_words(["woman", "man", "gender"])
+
 '''
 A table (https://www.plot.ly/python/table/) that displays all court cases containing a particular word or phrase (specified by the user).
 
 Helper function: get_list_of_cases_containing(word) returns list of tuples: (state abbr, state name, case name, case abbr, court name, court abbr)
 '''
 
-def make_table_with_word(word):
-    case_list = get_list_of_cases_containing(word)
+def make_table_with_word(word, after=0, page=1, date_min=None, date_max=None):
+    # Shows one page of the cases containing word (starting after the case with Id after) and
+    # returns the after value for the next page, or None if this is the last one. The page is only
+    # queried when the table has to be drawn: the next page's after value is kept in the query
+    # cache, so a figure-cache hit doesn't need the query at all.
+    key_args = [normalize_word([word]), after, page, CASES_PAGE_SIZE, date_min, date_max]
+    next_key = make_key(data_stamp(), 'case_table_next', key_args)
+
+    def build():
+        case_list, next_after = get_page_of_cases_containing(word, after, CASES_PAGE_SIZE, date_min, date_max)
+        QUERY_CACHE.put(next_key, next_after)
+        return build_table_of_cases(word, case_list, page, date_min, date_max)
+
+    show_figure('case_table', key_args, build)
+    missing = object()
+    next_after = QUERY_CACHE.get(next_key, missing)
+    if next_after is missing: # (a figure drawn before this session, without a persistent query cache)
+        next_after = get_page_of_cases_containing(word, after, CASES_PAGE_SIZE, date_min, date_max)[1]
+    return next_after
+
+def build_table_of_cases(word, case_list, page, date_min=None, date_max=None):
+    import plotly.graph_objs as go
+    total, exact = estimate_count_of_cases_containing(word, date_min, date_max)
 
     header_list = ["Case Name", "Case Abbreviation", "Court", "State"]
 
@@ -548,8 +1583,14 @@ def make_table_with_word(word):
                fill = dict(color='#EDFAFF'),
                align = ['left'] * 5))
 
+    first = (page - 1) * CASES_PAGE_SIZE + 1
+    layout = dict(
+        title = 'Cases Containing \"{}\"{} (page {}: cases {} to {} of {}{})'.format(word, date_range_label(date_min, date_max),
+            page, first, first + len(case_list) - 1, "" if exact else "about ", total))
+
     data = [trace]
-    py.plot(data, filename = 'case_table')
+    fig = dict(data=data, layout=layout)
+    return fig
 
 # make_table_with_word("woman")
 
@@ -557,11 +1598,17 @@ def make_table_with_word(word):
 Line chart (https://www.plot.ly/python/line-charts/) displaying the frequency of one or more particular words or phrases (specified by the user) in the full text of cases from all courts over a period of time.
 
 Helper function get_freq_by_time_for(list_of_words) returns list of dictionaries: keys are dates, values are freq.
+Given a granularity ('week', 'month' or 'year'), each point is a whole period instead of one day.
 '''
 
-def make_line_chart_for_list(list_of_words):
+def make_line_chart_for_list(list_of_words, granularity='day', date_min=None, date_max=None):
+    key_args = [list_of_words, granularity, date_min, date_max]
+    show_figure('line-plot', key_args, lambda: build_line_chart_for_list(list_of_words, granularity, date_min, date_max))
 
-    result_list = get_freq_by_time_for(list_of_words)
+def build_line_chart_for_list(list_of_words, granularity='day', date_min=None, date_max=None):
+    import plotly.graph_objs as go
+
+    result_list = get_freq_by_time_for(list_of_words, SCAN_WORKERS, granularity, date_min, date_max)
 
     dates_list = list(result_list[0].keys())
     # print(dates_list)
@@ -593,40 +1640,332 @@ def make_line_chart_for_list(list_of_words):
         trace_list.append(trace_obj)
 
     data = trace_list # list of trace objects
-    layout = dict(title = 'Frequency of Words in U.S. Case Law by Date',
-              xaxis = dict(title = 'Date'),
+    period = 'Date' if granularity == 'day' else granularity.capitalize()
+    layout = dict(title = 'Frequency of Words in U.S. Case Law by {}'.format(period) + date_range_label(date_min, date_max),
+              xaxis = dict(title = period),
               yaxis = dict(title = 'Frequency'),
               )
 
     fig = dict(data=data, layout=layout)
-    py.plot(fig, filename='line-plot')
+    return fig
 
 # make_line_chart_for_list(["woman","women"])
 
+''' Local query service '''
+
+STATE_COUNT_FIELDS = ["state_abbr", "state_name", "count", "percent"]
+CASE_FIELDS = ["state_abbr", "state_name", "case_name", "case_abbr", "court_name", "court_abbr"]
+
+def request_options(params):
+    # the 'from', 'to' and 'by' query parameters, checked the same way as the prompt's options
+    words = []
+    for name in ['from', 'to', 'by']:
+        if name in params:
+            words += ["--" + name, params[name][-1]]
+    return parse_options(words)[0]
+
+def request_words(params):
+    list_of_words = [word for word in params.get('word', []) if word.strip()]
+    if not list_of_words:
+        raise ValueError("Give one or more words with 'word' (e.g., ?word=woman&word=man).")
+    return list_of_words
+
+def serve_cases_by_state(params):
+    options = request_options(params)
+    return [dict(zip(STATE_COUNT_FIELDS, state)) for state in get_cases_by_state(options['date_min'], options['date_max'])]
+
+def serve_percent_by_state(params):
+    # {word: {state abbr: share of its cases containing word}}
+    options = request_options(params)
+    list_of_words = request_words(params)
+    results = get_percent_by_state_containing_all(list_of_words, options['date_min'], options['date_max'])
+    return {word: dict(result) for word, result in zip(list_of_words, results)}
+
+def serve_cases_containing(params):
+    options = request_options(params)
+    list_of_words = request_words(params)
+    if len(list_of_words) > 1:
+        raise ValueError("Give just one word (or phrase) for the list of cases.")
+    cases = get_list_of_cases_containing(list_of_words[0], options['date_min'], options['date_max'])
+    return [dict(zip(CASE_FIELDS, case)) for case in cases]
+
+def serve_freq_by_time(params):
+    # {word: {ISO date of each day or period: frequency}}
+    options = request_options(params)
+    list_of_words = request_words(params)
+    results = get_freq_by_time_for(list_of_words, granularity=options['granularity'], date_min=options['date_min'],
+        date_max=options['date_max'])
+    return dict(zip(list_of_words, results))
+
+SERVICE_ENDPOINTS = {
+    '/cases_by_state': serve_cases_by_state,
+    '/percent_by_state_containing': serve_percent_by_state,
+    '/cases_containing': serve_cases_containing,
+    '/freq_by_time': serve_freq_by_time,
+}
+
+def service_metrics():
+    # What /metrics adds to the service's own request counts and latencies. (It runs on the request's
+    # own thread, not a query worker, so it doesn't touch the database.)
+    with TIMERS.lock:
+        timers = {name: {'calls': calls, 'total_seconds': total, 'max_seconds': longest}
+            for name, (calls, total, self_time, longest) in TIMERS.stats.items() if name.startswith('query:')}
+    return {
+        'query_cache': dict(QUERY_CACHE.stats, hit_rate=QUERY_CACHE.hit_rate(), entries=len(QUERY_CACHE.entries)),
+        'query_timers': timers,
+    }
+
+def serve(port=SERVE_PORT, workers=SERVE_WORKERS, timeout=SERVE_TIMEOUT):
+    # answers JSON requests for the query helpers on localhost until it's interrupted (see service.py)
+    from service import QueryService # only needed here
+    import scanengine
+    # Several queries run at once, on threads, and forking a scan's worker processes while other
+    # threads are running can copy a lock one of them holds into the child, so scans run in-process.
+    scanengine.MAX_WORKERS = 1
+    service = QueryService(SERVICE_ENDPOINTS, port, workers, timeout, service_metrics)
+    print("Serving {} (and /metrics) at {}; Ctrl-C stops it.".format(", ".join(SERVICE_ENDPOINTS), service.url))
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopped.")
+
 ''' Add interactive functionality '''
 
+STARTUP_SCRIPT = '''
+import time
+start = time.perf_counter()
+import capapi
+imported = time.perf_counter()
+capapi.get_cases_by_state()
+queried = time.perf_counter()
+print(imported - start, queried - imported)
+'''
+
+def measure_startup(runs=5):
+    # Times, in fresh interpreters, how long 'import capapi' takes and then how long the first
+    # read-only query (get_cases_by_state) takes, i.e. how long until the prompt is useful.
+    # Also prints the slowest imports, from python's -X importtime.
+    directory = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([directory] + os.environ.get('PYTHONPATH', '').split(os.pathsep)))
+    timings = []
+    for i in range(runs):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], cwd=os.getcwd(), check=True,
+            stdout=subprocess.PIPE, env=env, universal_newlines=True).stdout
+        total = time.perf_counter() - start
+        import_time, query_time = [float(value) for value in output.split()]
+        timings.append((total, import_time, query_time))
+
+    print("{:<30} {:>10} {:>10}".format("", "median s", "max s"))
+    labels = ["process start to first query", "import capapi", "first query"]
+    for i in range(3):
+        values = sorted([timing[i] for timing in timings])
+        print("{:<30} {:>10.3f} {:>10.3f}".format(labels[i], values[len(values) // 2], values[-1]))
+
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", "import capapi"], cwd=os.getcwd(),
+        stderr=subprocess.PIPE, env=env, universal_newlines=True).stderr
+    imports = []
+    for line in stderr.splitlines()[1:]: # the first line is a header
+        fields = line.split("|")
+        imports.append((int(fields[1]), fields[2].strip()))
+    print("\nSlowest imports (cumulative microseconds):")
+    for cumulative, name in sorted(imports, reverse=True)[:10]:
+        print("{:>10} {}".format(cumulative, name))
+
+    return timings
+
+def print_stats():
+    print("\nTimings (self time excludes the phases nested inside, e.g. a command's queries):")
+    for line in TIMERS.report():
+        print(line)
+
+    print("\nQuery cache: {:.0%} hit rate ({} hits, {} from disk, {} misses)".format(QUERY_CACHE.hit_rate(),
+        QUERY_CACHE.stats['hits'], QUERY_CACHE.stats['disk_hits'], QUERY_CACHE.stats['misses']))
+    lookups = FIGURE_CACHE.stats['hits'] + FIGURE_CACHE.stats['misses']
+    print("Figure cache: {:.0%} hit rate ({} hits, {} misses)".format(FIGURE_CACHE.stats['hits'] / max(1, lookups),
+        FIGURE_CACHE.stats['hits'], FIGURE_CACHE.stats['misses']))
+
+    if SQL_TRACE.enabled or SQL_TRACE.stats:
+        print("\nSlowest SQL statements{}:".format("" if SQL_TRACE.enabled else " (tracing is off now)"))
+        for line in SQL_TRACE.report():
+            print(line)
+
+OPTION_NAMES = {'--from': 'date_min', '--to': 'date_max', '--by': 'granularity'}
+
+def parse_options(words):
+    # Pulls the '--from <date>', '--to <date>' and '--by <week|month|year>' options out of a
+    # command's words. Returns (options dict, the other words); raises ValueError if one is bad.
+    options = {'date_min': None, 'date_max': None, 'granularity': 'day'}
+    other_words = []
+    i = 0
+    while i < len(words):
+        if words[i] in OPTION_NAMES:
+            if i + 1 == len(words):
+                raise ValueError("The '{}' option needs a value.".format(words[i]))
+            options[OPTION_NAMES[words[i]]] = words[i + 1]
+            i += 2
+        else:
+            other_words.append(words[i])
+            i += 1
+
+    for name in ['date_min', 'date_max']:
+        if options[name] is not None:
+            try:
+                options[name] = day_to_date(date_to_day(options[name]))
+            except ValueError:
+                raise ValueError("'{}' isn't a date (use YYYY-MM-DD).".format(options[name]))
+    check_granularity(options['granularity'])
+    return (options, other_words)
+
+JOB_COMMANDS = {'all_cases', 'cases_matching', 'next', 'prev', 'export', 'map_matching', 'time_plot'}
+
+def run_command(command, words, options, table):
+    # Runs one of JOB_COMMANDS (on the JOBS worker thread, unless BACKGROUND_COMMANDS is off). table
+    # is where the cases_matching table is up to: its word and dates, the after value of each page
+    # shown so far (the last one is the current page), and the after value of the next page.
+    dates = (options['date_min'], options['date_max'])
+
+    if command == "all_cases":
+        print("\nCreating a map of all federal district court cases by state in a browser window...")
+        make_map_of_cases(*dates)
+
+    elif command == "cases_matching":
+        if len(words) > 1:
+            word = words[1]
+            print("\nCreating a table of federal district court cases containing \'{}\'...".format(word))
+            next_after = make_table_with_word(word, 0, 1, *dates)
+            # (only once the page is shown, so a failed or cancelled command leaves the old table as it was)
+            table.update(word=word, dates=dates, pages=[0], next=next_after)
+        else:
+            print("\nThe 'cases_matching' command must be used with a word (e.g., 'cases_matching woman').")
+
+    elif command == "next":
+        if table['next'] is None:
+            print("\nThere are no more cases to show (use 'cases_matching <word>' to start a new table).")
+        else:
+            print("\nShowing the next page of cases containing \'{}\'...".format(table['word']))
+            next_after = make_table_with_word(table['word'], table['next'], len(table['pages']) + 1, *table['dates'])
+            table.update(pages=table['pages'] + [table['next']], next=next_after)
+
+    elif command == "prev":
+        if len(table['pages']) < 2:
+            print("\nThere is no previous page to show.")
+        else:
+            print("\nShowing the previous page of cases containing \'{}\'...".format(table['word']))
+            pages = table['pages'][:-1]
+            next_after = make_table_with_word(table['word'], pages[-1], len(pages), *table['dates'])
+            table.update(pages=pages, next=next_after)
+
+    elif command == "export":
+        if table['word'] is None or len(words) < 2:
+            print("\nThe 'export' command must be used with a file name, after a 'cases_matching' command (e.g., 'export cases.csv').")
+        else:
+            count = export_cases_containing(table['word'], words[1], *table['dates'])
+            print("\nSaved {} cases containing \'{}\' to {}.".format(count, table['word'], words[1]))
+
+    elif command == "map_matching":
+        if len(words) > 2:
+            list_of_words = words[1:]
+            print("\nCreating maps displaying percentage of federal district court cases by state containing each of the specified words...")
+            make_maps_of_words(list_of_words, *dates)
+        elif len(words) > 1:
+            word = words[1]
+            print("\nCreating a map displaying percentage of federal district court cases by state containing \'{}\'...".format(word))
+            make_map_of_word(word, *dates)
+        else:
+            print("\nThe 'map_matching' command must be used with a word (e.g., 'map_matching woman').")
+
+    elif command == "time_plot":
+        if len(words) == 1:
+            print("\nThe 'time_plot' command must be used with one or more words (e.g., 'time_plot woman women gender').")
+        else:
+            list_of_words = words[1:]
+            print("\nCreating a line chart displaying the frequency of the specified words over time...")
+            make_line_chart_for_list(list_of_words, options['granularity'], *dates)
+
+def submit_command(action, command, words, options, table):
+    # queues a command for the JOBS worker thread; without BACKGROUND_COMMANDS, waits for it too
+    def timed_command():
+        with TIMERS.timer("command:{}".format(command)):
+            run_command(command, words, options, table)
+
+    func = timed_command
+    if JOB_PROFILER is not None:
+        # cProfile only sees the thread it's enabled in, so the worker thread's commands get their own
+        func = lambda: JOB_PROFILER.runcall(timed_command)
+
+    queued = JOBS.pending()
+    job = JOBS.submit(action, func)
+    if not BACKGROUND_COMMANDS:
+        wait_for_jobs()
+    elif queued:
+        print("\nQueued as job {}, behind {} other command(s) ('jobs' lists them).".format(job.id, queued))
+    else:
+        print("\nRunning as job {} ('jobs' shows its progress, 'cancel' stops it).".format(job.id))
+
+def report_job(job):
+    # JOBS calls this from its worker thread as each command finishes
+    if job.state == 'done' and not BACKGROUND_COMMANDS:
+        return
+    print("\n{}".format(job.describe()))
+
+def wait_for_jobs():
+    # waits for the queued commands to finish, showing the running one's progress; Ctrl-C cancels it
+    while True:
+        try:
+            if JOBS.wait(PROGRESS_INTERVAL):
+                break
+            job = JOBS.running()
+            if job is not None and job.total_rows:
+                print("\r" + job.describe(), end="", flush=True)
+        except KeyboardInterrupt:
+            job = JOBS.cancel()
+            if job is not None:
+                print("\nCancelling job {}...".format(job.id))
+
 def play():
 
     option = ""
     base_prompt = "Enter command (or 'help' for options): "
     feedback = ""
 
+    table = {'word': None, 'dates': (None, None), 'pages': [], 'next': None} # see run_command()
+
     while True:
-        action = input(feedback + "\n" + base_prompt)
+        try:
+            action = input(feedback + "\n" + base_prompt)
+        except KeyboardInterrupt:
+            job = JOBS.cancel()
+            if job is None:
+                print("\nExiting...\n")
+                JOBS.stop()
+                return
+            print("\nCancelling job {} ({}).".format(job.id, job.text))
+            continue
         feedback = ""
-        words = action.split()
+        try:
+            options, words = parse_options(action.split())
+        except ValueError as e:
+            print("\n{}".format(e))
+            continue
 
         if len(words) > 0:
             command = words[0]
         else:
             command = None
 
-        if command == "exit":
-            print("\nExiting...\n")
-            return
+        if command in JOB_COMMANDS:
+            submit_command(action, command, words, options, table)
+            continue
+
+        with TIMERS.timer("command:{}".format(command)):
+            if command == "exit":
+                print("\nExiting...\n")
+                JOBS.stop()
+                return
 
-        elif command == "help":
-            print( '''
+            elif command == "help":
+                print( '''
                 all_cases
                     creates a map of the United States that presents the number
                     of district/territorial court cases from each state (that
@@ -634,55 +1973,143 @@ def play():
                     comprising the state).
 
                 cases_matching <word>
-                     creates a table displaying all court cases containing a
-                     particular word or phrase, specified by the user.
+                     creates a table displaying the court cases containing a
+                     particular word or phrase, specified by the user, one
+                     page at a time.
 
-                map_matching <word>
+                next / prev
+                     shows the next or previous page of the cases_matching
+                     table.
+
+                export <file.csv or file.jsonl>
+                     saves all of the cases from the last cases_matching
+                     command to a CSV or JSON Lines file.
+
+                map_matching <word or list of words>
                     creates a map of the United States that presents the
                     percentage of court cases containing a particular
-                    word or phrase, specified by the user, by state.
+                    word or phrase, specified by the user, by state. Given
+                    more than one word, shows one small map per word, side
+                    by side and on the same scale.
 
                 time_plot <word or list of words>
                     creates a line chart showing the frequency of one or more
-                    words, specified by the user, over time.
+                    words, specified by the user, over time. Add '--by week',
+                    '--by month' or '--by year' to plot one point per period.
+
+                --from <YYYY-MM-DD> / --to <YYYY-MM-DD>
+                    limits all_cases, cases_matching, map_matching or
+                    time_plot to the cases decided in that range (e.g.,
+                    'time_plot woman --by month --from 2016-01-01').
+
+                jobs
+                    lists the commands running or queued in the background,
+                    with how far along the running one is and (for scans)
+                    about how long it has left.
+
+                cancel [job #]
+                    stops the running command (or the queued one with that
+                    number). Ctrl-C at the prompt also stops the running one.
+
+                wait
+                    waits for the queued commands to finish, showing their
+                    progress.
 
                 exit
-                    exits the program
+                    exits the program (cancelling any commands still running)
 
-                help
-                    lists available commands (these instructions)''')
+                stats
+                    shows how long commands and each of their phases have
+                    taken so far, cache hit rates, and (with 'trace on') the
+                    slowest SQL statements and their query plans.
 
-        elif command == "all_cases":
-            print("\nCreating a map of all federal district court cases by state in a browser window...")
-            make_map_of_cases()
+                trace on / trace off
+                    starts or stops timing every SQL statement.
 
-        elif command == "cases_matching":
-            if len(words) > 1:
-                word = words[1]
-                print("\nCreating a table of all federal district court cases containing \'{}\'...".format(word))
-                make_table_with_word(word)
-            else:
-                print("\nThe 'cases_matching' command must be used with a word (e.g., 'cases_matching woman').")
+                help
+                    lists available commands (these instructions)''')
 
-        elif command == "map_matching":
-            if len(words) > 1:
-                word = words[1]
-                print("\nCreating a map displaying percentage of federal district court cases by state containing \'{}\'...".format(word))
-                make_map_of_word(word)
-            else:
-                print("\nThe 'map_matching' command must be used with a word (e.g., 'map_matching woman').")
+            elif command == "jobs":
+                lines = JOBS.jobs_report()
+                print("\n" + "\n".join(lines) if lines else "\nNo commands have run in the background yet.")
+
+            elif command == "cancel":
+                if len(words) > 1 and not words[1].isdigit():
+                    print("\nThe 'cancel' command takes a job number, if anything (e.g., 'cancel 3').")
+                else:
+                    job = JOBS.cancel(int(words[1]) if len(words) > 1 else None)
+                    if job is None:
+                        print("\nThere's no such command running or queued.")
+                    else:
+                        print("\nCancelling job {} ({}).".format(job.id, job.text))
+
+            elif command == "wait":
+                wait_for_jobs()
+
+            elif command == "stats":
+                print_stats()
+
+            elif command == "trace":
+                if len(words) > 1 and words[1] in ("on", "off"):
+                    SQL_TRACE.enabled = (words[1] == "on")
+                    print("\nSQL tracing is {}.".format(words[1]))
+                else:
+                    print("\nThe 'trace' command must be used with 'on' or 'off' (e.g., 'trace on').")
 
-        elif command == "time_plot":
-            if len(words) == 1:
-                print("\nThe 'time_plot' command must be used with one or more words (e.g., 'time_plot woman women gender').")
             else:
-                list_of_words = words[1:]
-                print("\nCreating a line chart displaying the frequency of the specified words over time...")
-                make_line_chart_for_list(list_of_words)
+                print("\nPlease enter a valid command, or type 'help' to view a list of available commands.")
 
-        else:
-            print("\nPlease enter a valid command, or type 'help' to view a list of available commands.")
+def main(args):
+    # create_db()
+    if len(args) > 0 and args[0] == "sync":
+        sync_db()
+    elif len(args) > 0 and args[0] == "compress":
+        codec = args[1] if len(args) > 1 else 'zlib'
+        compress_db(None if codec == 'none' else codec)
+    elif len(args) > 0 and args[0] == "compression_report":
+        compression_report(get_connection(DBNAME))
+    elif len(args) > 0 and args[0] == "startup_time":
+        measure_startup()
+    elif len(args) > 0 and args[0] == "serve":
+        upgrade_db()
+        serve(int(args[1]) if len(args) > 1 else SERVE_PORT)
+    elif len(args) > 0 and args[0] == "snapshot":
+        from snapshot import export_snapshot # needs numpy, which nothing else does
+        directory = args[1] if len(args) > 1 else SNAPSHOT_DIR
+        upgrade_db()
+        conn = connect(DBNAME)
+        manifest = export_snapshot(conn, directory)
+        conn.close()
+        print("Saved a snapshot of {} cases and {} terms to {}".format(manifest['cases'], manifest['terms'], directory))
+    else:
+        upgrade_db()
+        play()
+
+def profile_main(args):
+    # runs main() under cProfile, saves the data to PROFILE_FNAME and prints the top functions
+    # (including the prompt's commands, which run on the JOBS worker thread)
+    global JOB_PROFILER
+    profiler = cProfile.Profile()
+    JOB_PROFILER = cProfile.Profile()
+    try:
+        profiler.runcall(main, args)
+    finally:
+        JOBS.stop() # so no command is still adding to JOB_PROFILER
+        stats = pstats.Stats(profiler)
+        JOB_PROFILER.create_stats()
+        if JOB_PROFILER.stats: # (empty if no command ran)
+            stats.add(JOB_PROFILER)
+        JOB_PROFILER = None
+        stats.dump_stats(PROFILE_FNAME)
+        print("\ncProfile data saved to {} (top 25 functions by cumulative time):".format(PROFILE_FNAME))
+        pstats.Stats(PROFILE_FNAME).sort_stats("cumulative").print_stats(25)
 
 if __name__=="__main__":
-    # create_db()
-    play()
+    # flags: --profile (run under cProfile) and --trace (start with SQL tracing on)
+    args = [arg for arg in sys.argv[1:] if arg not in ("--profile", "--trace")]
+    if "--trace" in sys.argv:
+        SQL_TRACE.enabled = True
+    if "--profile" in sys.argv:
+        profile_main(args)
+    else:
+        main(args)
@@ -1,5 +1,27 @@
 import unittest
+import unittest.mock
+import tempfile
+import random
+import math
+import io
+import multiprocessing
+import importlib.util
+import capapi
 from capapi import *
+import scanengine
+from scanengine import split_id_range
+import benchmark
+import mockcap
+from profiling import TracingConnection
+from dates import period_end, period_sql
+from tokenizer import stem, has_phrase, index_text
+from compression import compress_body, decompress_body
+from courts import REFERENCE_KEY, parse_courts, load_courts
+from jobs import JobRunner, Cancelled, advance
+from database import get_connection
+from service import QueryService
+import urllib.request
+import urllib.error
 
 '''
 You must write unit tests to show that the data access, storage, and processing components of your project are working correctly.
@@ -9,6 +31,38 @@ You must create at least 3 test cases and use at least 15 assertions or calls to
 Your tests should show that you are able to access data from all of your sources, that your database is correctly constructed and can satisfy queries that are necessary for your program, and that your data processing produces the results and data structures you need for presentation.
 '''
 
+class TempDatabase:
+    # For tests that build their own law.db (mixed into a TestCase): setUp points capapi at a database
+    # and a cache in a temporary directory, with benchmark.py's courts, and tearDown puts it all back.
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.saved = (capapi.DBNAME, capapi.STATESCSV, capapi.CACHE, capapi.CAPAPI_URL, capapi.CAP_BACKOFF)
+        capapi.STATESCSV = os.path.abspath(STATESCSV)
+        capapi.DBNAME = self.path("law.db")
+        capapi.CACHE = CacheStore(self.path("cache.db"))
+        capapi.CAP_BACKOFF = 0.01
+        self.courts = benchmark.make_courts(random.Random(0), capapi.STATESCSV)
+        QUERY_CACHE.clear()
+
+    def tearDown(self):
+        capapi.CACHE.close()
+        capapi.DBNAME, capapi.STATESCSV, capapi.CACHE, capapi.CAPAPI_URL, capapi.CAP_BACKOFF = self.saved
+        QUERY_CACHE.clear()
+        self.tmpdir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    def make_cases(self, n, seed=1):
+        return list(benchmark.iter_cases(n, self.courts, random.Random(seed), 100))
+
+    def build_db(self, cases, name="law.db", **kwargs):
+        # builds capapi.DBNAME (name, in the temporary directory) from cases, with create_db()
+        capapi.DBNAME = self.path(name)
+        QUERY_CACHE.clear()
+        create_db(cases=cases, courts=self.courts, **kwargs)
+
 class TestAccess(unittest.TestCase):
 
     def test_cap_api(self):
@@ -25,6 +79,817 @@ class TestAccess(unittest.TestCase):
         self.assertEqual(type(result[0]), tuple)
         self.assertEqual(len(result), 94)
 
+class TestCourts(unittest.TestCase):
+
+    def make_page(self, courts):
+        # a page shaped like Wikipedia's court list: another table first, then the courts (with footnotes)
+        rows = "".join("<tr><td><a href='#'>{}</a><sup class='reference'>[{}]</sup></td><td>{}</td><td>{}</td>"
+            "<td>{}</td><td>{}</td></tr>\n".format(court[1], i, court[2], court[3], court[4], court[5])
+            for i, court in enumerate(courts))
+        return ("<html><body><table class='infobox'><tr><td>Not this</td></tr></table>"
+            '<table class="wikitable sortable"><tr><th>Court</th><th>Citation</th><th>Appeals</th>'
+            "<th>Established</th><th>Judges</th></tr>\n" + rows + "</table><p>After</p></body></html>")
+
+    def test_parse_courts(self):
+        # (the synthetic territorial courts all have the citation "D. ", so they're left out)
+        courts = [court for court in benchmark.make_courts(random.Random(0), STATESCSV) if court[2] != "D. "]
+        state_names = get_state_names()
+        with tempfile.TemporaryDirectory() as tmp:
+            store = CacheStore(os.path.join(tmp, "cache.db"))
+            html = self.make_page(courts)
+
+            self.assertEqual(parse_courts(html), courts)
+            self.assertEqual(load_courts(store, html, state_names), courts)
+            self.assertEqual(store[REFERENCE_KEY]['courts'][0], list(courts[0]))
+
+            # unchanged page: the saved courts are used, not parsed again
+            saved = store[REFERENCE_KEY]
+            saved['courts'] = saved['courts'][:3]
+            store[REFERENCE_KEY] = saved
+            self.assertEqual(load_courts(store, html, state_names), courts[:3])
+
+            # changed page: parsed again
+            self.assertEqual(load_courts(store, self.make_page(courts[:10]), state_names), courts[:10])
+
+            # bad rows are left out, a court in a state state_table.csv doesn't have is kept
+            atlantis = ("Atlantis", "District of Atlantis", "D. Atl.", "1st", "1789", "1")
+            no_judges = ("Ohio", "Western District of Ohio", "W.D. Oh.", "6th", "1855", "vacant")
+            repeated = courts[0][:2] + (courts[1][2],) + courts[0][3:]
+            with unittest.mock.patch('builtins.print'):
+                loaded = load_courts(store, self.make_page(courts[1:] + [atlantis, no_judges, repeated]), state_names)
+            self.assertEqual(loaded, courts[1:] + [atlantis])
+
+            # nothing that looks like a court
+            with unittest.mock.patch('builtins.print'), self.assertRaises(ValueError):
+                load_courts(store, self.make_page([no_judges]), state_names)
+            store.close()
+
+class TestCourtsTable(TempDatabase, unittest.TestCase):
+
+    def test_courts_linked_to_states(self):
+        self.build_db([])
+        conn = sqlite.connect(capapi.DBNAME)
+        statement = '''
+        SELECT States.Abbr
+        FROM DistrictCourts
+        LEFT JOIN States
+        ON DistrictCourts.StateId = States.Id
+        WHERE DistrictCourts.CourtName = "District of Columbia"
+        '''
+        self.assertEqual(conn.execute(statement).fetchall(), [("DC",)])
+        statement = "SELECT COUNT(*) FROM DistrictCourts WHERE StateId IS NULL"
+        self.assertEqual(conn.execute(statement).fetchone()[0], 0)
+        conn.close()
+
+class TestCache(unittest.TestCase):
+
+    def test_cache_store(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = CacheStore(os.path.join(tmp, "cache.db"))
+            self.assertTrue(store.is_empty())
+
+            store["http://example.com/?page=1"] = {"next": None, "results": []}
+            self.assertIn("http://example.com/?page=1", store)
+            self.assertNotIn("http://example.com/?page=2", store)
+            self.assertEqual(store["http://example.com/?page=1"]["results"], [])
+            store.close()
+
+    def test_import_json_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            json_fname = os.path.join(tmp, "cache.json")
+            with open(json_fname, 'w') as f:
+                f.write(json.dumps({"a": "<html></html>", "b": {"next": None}}))
+
+            store = CacheStore(os.path.join(tmp, "cache.db"))
+            self.assertEqual(import_json_cache(json_fname, store), 2)
+            self.assertEqual(len(store), 2)
+            self.assertEqual(store["a"], "<html></html>")
+            store.close()
+
+    def test_query_cache(self):
+        cache = QueryCache(max_entries=2)
+        calls = []
+        stamp = ["law.db", "generation-1"]
+
+        @cache.cached(lambda: stamp)
+        def square(n):
+            calls.append(n)
+            return [n * n]
+
+        self.assertEqual(square(3), [9])
+        self.assertEqual(square(3), [9])
+        self.assertEqual(calls, [3]) # second call came from the cache
+        self.assertEqual(cache.stats['hits'], 1)
+
+        square(4)
+        square(5) # evicts 3
+        square(3)
+        self.assertEqual(calls, [3, 4, 5, 3])
+
+        stamp[1] = "generation-2" # the data changed
+        square(3)
+        self.assertEqual(calls, [3, 4, 5, 3, 3])
+
+    def test_secrets_file(self):
+        saved = (capapi.SECRETS_FNAME, capapi.SECRETS)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            capapi.SECRETS_FNAME = os.path.join(tmpdir, "secrets.py")
+            capapi.SECRETS = None
+            try:
+                self.assertEqual(get_secret("CAPAPI_KEY"), "") # no secrets.py is fine
+
+                with open(capapi.SECRETS_FNAME, "w") as f:
+                    f.write('CAPAPI_KEY = "abc"\n')
+                capapi.SECRETS = None
+                self.assertEqual(get_secret("CAPAPI_KEY"), "abc")
+                self.assertEqual(get_secret("PLOTLY_API_KEY"), "") # missing keys are empty
+            finally:
+                capapi.SECRETS_FNAME, capapi.SECRETS = saved
+
+    def test_figure_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = FigureCache(tmpdir, max_figures=1)
+            calls = []
+
+            def build():
+                calls.append(1)
+                return dict(data=[dict(type='scatter', x=[1, 2], y=[3, 4])], layout=dict(title='Test'))
+
+            path = cache.show('test', 'key-1', build, auto_open=False)
+            self.assertTrue(os.path.exists(path))
+            self.assertTrue(os.path.exists(os.path.join(tmpdir, 'plotly.min.js'))) # shared, not embedded
+
+            self.assertEqual(cache.show('test', 'key-1', build, auto_open=False), path)
+            self.assertEqual(len(calls), 1) # second call opened the cached file
+
+            cache.show('test', 'key-2', build, auto_open=False)
+            self.assertEqual(len(calls), 2)
+            self.assertFalse(os.path.exists(path)) # pruned, only one figure is kept
+
+class TestCrawler(unittest.TestCase):
+
+    def test_make_windows(self):
+        windows = make_windows("2016-01-01", "2016-01-31", 10)
+
+        self.assertEqual(len(windows), 4)
+        self.assertEqual(windows[0], ("2016-01-01", "2016-01-10"))
+        self.assertEqual(windows[-1], ("2016-01-31", "2016-01-31"))
+
+    def test_cap_urls(self):
+        urls = get_cap_urls(date_min="2016-01-01", date_max="2016-01-31", window_days=10)
+
+        self.assertEqual(len(urls), 4)
+        self.assertIn("decision_date_min=2016-01-11&decision_date_max=2016-01-20", urls[1])
+        self.assertEqual(len(get_cap_urls()), 1) # no windows means a single open-ended query
+
+class TestMockCap(unittest.TestCase):
+
+    def test_crawl_through_faults(self):
+        cases = mockcap.synthetic_cases(250, median_words=20)
+        saved = (capapi.CAPAPI_URL, capapi.CACHE, capapi.CAP_BACKOFF)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with mockcap.MockCapServer(cases, error_rate=0.2, malformed_rate=0.2, seed=3) as server:
+                capapi.CAPAPI_URL = server.url
+                capapi.CACHE = CacheStore(os.path.join(tmpdir, "cache.db"))
+                capapi.CAP_BACKOFF = 0.01
+                try:
+                    result = get_cap_data(max_pages=None)
+                finally:
+                    capapi.CACHE.close()
+                    capapi.CAPAPI_URL, capapi.CACHE, capapi.CAP_BACKOFF = saved
+
+        self.assertEqual(len(result), 250) # every page, despite the 429s and malformed pages
+        self.assertEqual(len(set(case[5] for case in result)), 250) # and no page twice
+        self.assertGreater(server.stats['too_many_requests'], 0)
+        self.assertGreater(server.stats['malformed'], 0)
+
+class TestSync(TempDatabase, unittest.TestCase):
+    # create_db() and sync_db() against a mockcap server whose cases change between crawls
+
+    def setUp(self):
+        super().setUp()
+        self.cases = mockcap.synthetic_cases(350, median_words=20) # the first 250 by date, then 100 more
+        self.cases.sort(key=lambda case: (case['decision_date'], case['id']))
+        self.server = mockcap.MockCapServer(self.cases[:250]).start()
+        self.addCleanup(self.server.stop)
+        capapi.CAPAPI_URL = self.server.url
+        self.build_db(None) # crawled from the server
+
+    def query(self, statement):
+        conn = sqlite.connect(capapi.DBNAME)
+        try:
+            return conn.execute(statement).fetchall()
+        finally:
+            conn.close()
+
+    def assertMatchesServer(self):
+        self.assertEqual(self.query("SELECT CapId, Name FROM Cases ORDER BY CapId"),
+            sorted((case['id'], case['name']) for case in self.server.cases))
+        self.assertEqual(self.query("SELECT Value FROM Meta WHERE Key = 'high_water_mark'"),
+            [(self.server.cases[-1]['decision_date'],)])
+        self.assertEqual(self.query("SELECT Value FROM Meta WHERE Key LIKE 'cursor:%' AND Value IS NOT NULL"), [])
+
+    def test_sync_twice(self):
+        self.assertMatchesServer()
+        self.assertEqual(sync_db(), 0) # nothing new on the server
+
+        self.server.cases = self.cases
+        self.assertEqual(sync_db(), 100)
+        self.assertMatchesServer()
+        self.assertEqual(self.query("SELECT SUM(Count) FROM StateCounts"), self.query('''
+            SELECT COUNT(*) FROM Cases JOIN DistrictCourts ON Cases.CourtId = DistrictCourts.Id
+            WHERE DistrictCourts.StateId IS NOT NULL'''))
+
+    def test_resume_after_interruption(self):
+        self.server.cases = self.cases
+        written = []
+        def upsert_one_page(*args, **kwargs):
+            if written:
+                raise KeyboardInterrupt() # while handling the second page
+            written.append(upsert_cases(*args, **kwargs))
+            return written[-1]
+        with unittest.mock.patch('capapi.upsert_cases', upsert_one_page):
+            with self.assertRaises(KeyboardInterrupt):
+                sync_db()
+        # the first page was committed with the cursor for the second, but the mark hasn't moved
+        self.assertEqual(self.query("SELECT COUNT(*) FROM Meta WHERE Key LIKE 'cursor:%' AND Value IS NOT NULL"), [(1,)])
+        self.assertEqual(self.query("SELECT Value FROM Meta WHERE Key = 'high_water_mark'"),
+            [(self.cases[249]['decision_date'],)])
+
+        self.server.reset_stats()
+        self.assertEqual(written[0] + sync_db(), 100)
+        self.assertMatchesServer()
+        # the second sync started from the saved cursor, not the first page
+        mark = self.cases[249]['decision_date']
+        pages = math.ceil(len([case for case in self.cases if case['decision_date'] >= mark]) / mockcap.PAGE_SIZE)
+        self.assertEqual(self.server.stats['pages'], pages - 1)
+
+    def test_upsert_changes_case(self):
+        case = self.server.cases[-1] # on the high-water mark's date, so the sync sees it again
+        case['name'] = "Changed v. Case"
+        case['court']['name_abbreviation'] = self.courts[0][2]
+        case['casebody']['data']['opinions'][0]['text'] = "quokka " * 5
+        self.assertEqual(sync_db(), 1)
+        self.assertMatchesServer()
+        self.assertEqual([row[2] for row in get_list_of_cases_containing("quokka")], ["Changed v. Case"])
+        self.assertEqual(self.query("SELECT SUM(Count) FROM TermCounts WHERE Token = 'quokka'"), [(5,)])
+        # the old text's tokens were taken back out of the term index
+        tokens = sum(len(index_text(text).split()) for text, in self.query("SELECT CaseBody FROM Cases"))
+        self.assertEqual(self.query("SELECT SUM(Count) FROM TermCounts"), [(tokens,)])
+        self.assertEqual(self.query("SELECT SUM(Total) FROM DateTotals"), [(tokens,)])
+        self.assertEqual(self.query("SELECT Count FROM StateCounts WHERE StateId = (SELECT StateId FROM DistrictCourts WHERE Id = 1)"),
+            self.query("SELECT COUNT(*) FROM Cases JOIN DistrictCourts ON Cases.CourtId = DistrictCourts.Id WHERE StateId = (SELECT StateId FROM DistrictCourts WHERE Id = 1)"))
+
+    def test_adopt_legacy_cases(self):
+        # a database from before CapId: the synced cases update its rows instead of being added again
+        conn = sqlite.connect(capapi.DBNAME)
+        conn.execute("DROP INDEX CasesCapId")
+        conn.execute("ALTER TABLE Cases DROP COLUMN CapId")
+        conn.execute("DELETE FROM Meta WHERE Key = 'high_water_mark'")
+        conn.commit()
+        conn.close()
+
+        self.assertEqual(sync_db(), 0)
+        self.assertMatchesServer()
+        self.assertEqual(self.query("SELECT COUNT(*) FROM Cases WHERE CapId IS NULL"), [(0,)])
+
+class TestScanEngine(unittest.TestCase):
+
+    def test_split_id_range(self):
+        ranges = split_id_range(1, 10, 3)
+
+        self.assertEqual(ranges, [(1, 4), (5, 8), (9, 10)])
+        self.assertEqual(split_id_range(5, 5, 4), [(5, 5)])
+        self.assertEqual(split_id_range(None, None, 4), []) # empty table
+
+    def test_merge_partials(self):
+        partials = [({"2016-01-01": 10}, {("women", "2016-01-01"): 2}),
+            ({"2016-01-01": 5, "2016-01-02": 7}, {("women", "2016-01-02"): 1})]
+        date_totals, word_counts = merge_token_counts(partials)
+
+        self.assertEqual(date_totals, {"2016-01-01": 15, "2016-01-02": 7})
+        self.assertEqual(word_counts[("women", "2016-01-01")], 2)
+
+        partials = [{"women": {"MA": 1}}, {"women": {"MA": 2, "NY": 1}}]
+        self.assertEqual(merge_state_counts(partials), {"women": {"MA": 3, "NY": 1}})
+
+class TestParallelScans(TempDatabase, unittest.TestCase):
+    # enough cases for run_scan() to split them between worker processes
+
+    def setUp(self):
+        super().setUp()
+        self.build_db(self.make_cases(2 * scanengine.MIN_CHUNK_ROWS + 100), fts=False, term_index=False)
+
+    def test_serving_scans_in_process(self):
+        # while serving (MAX_WORKERS = 1), no scan forks worker processes, whatever it's asked for
+        args = (["woman", "the"], get_tokenizer_name(get_connection(capapi.DBNAME).cursor()))
+        with unittest.mock.patch('scanengine.MAX_WORKERS', 1):
+            with unittest.mock.patch('multiprocessing.Pool', side_effect=AssertionError("forked a pool")):
+                partials = run_scan(capapi.DBNAME, count_states_in_rows, args, 4)
+        self.assertEqual(partials, [count_states_in_rows(capapi.DBNAME, *args)])
+
+    def test_multi_word_scan_matches_single_words(self):
+        # several words counted in one pass over the text = each word's own (SQL) count, for the same rows
+        words = ["woman", "Court", "the court", "motion to", "quokka"]
+        for tokenizer in ['words', 'words+stem', 'split']:
+            for rows in [(None, None, None, None), (date_to_day("2016-03-01"), date_to_day("2016-08-31"), 500, 2500)]:
+                together = count_states_in_rows(capapi.DBNAME, words, tokenizer, *rows)
+                for word in words:
+                    alone = count_states_in_rows(capapi.DBNAME, [word], tokenizer, *rows)
+                    self.assertEqual(together[word], alone[word], (tokenizer, rows, word))
+                self.assertEqual(together["quokka"], {})
+                self.assertGreater(sum(together["woman"].values()), 0)
+
+    def test_pool_matches_one_process(self):
+        # each scan split between worker processes merges to the same result as one scan
+        self.assertGreater(get_connection(capapi.DBNAME).execute("SELECT COUNT(*) FROM Cases").fetchone()[0],
+            2 * scanengine.MIN_CHUNK_ROWS)
+        day_min, day_max = date_to_day("2016-02-10"), date_to_day("2016-11-20")
+        scans = [
+            (count_words_in_rows, ({"the", "woman", "court"}, 'words', day_min, day_max), merge_token_counts),
+            (count_states_in_rows, (["woman", "the court"], 'words', None, None), merge_state_counts),
+            (find_cases_in_rows, ("woman", 'words', day_min, None), merge_matching_cases),
+        ]
+        for scan, args, merge in scans:
+            one_process = merge(run_scan(capapi.DBNAME, scan, args, 1))
+            with unittest.mock.patch('multiprocessing.Pool', wraps=multiprocessing.Pool) as pool:
+                partials = run_scan(capapi.DBNAME, scan, args, 4)
+            pool.assert_called_once()
+            self.assertGreater(len(partials), 1)
+            self.assertEqual(merge(partials), one_process, scan.__name__)
+
+class TestProfiling(unittest.TestCase):
+
+    def test_timers(self):
+        timers = Timers()
+        with timers.timer("command:test"):
+            with timers.timer("query:test"):
+                time.sleep(0.01)
+
+        calls, total, self_time, longest = timers.stats["command:test"]
+        self.assertEqual(calls, 1)
+        self.assertGreaterEqual(total, 0.01)
+        self.assertLess(self_time, 0.01) # the nested query's time isn't the command's own
+        self.assertGreaterEqual(timers.stats["query:test"][2], 0.01)
+
+    def test_sql_trace(self):
+        conn = sqlite.connect(":memory:", factory=TracingConnection)
+        conn.execute("CREATE TABLE Numbers (N INTEGER PRIMARY KEY)")
+        conn.executemany("INSERT INTO Numbers VALUES (?)", [(n,) for n in range(10)])
+
+        SQL_TRACE.reset()
+        SQL_TRACE.enabled = True
+        try:
+            rows = conn.execute("SELECT N FROM Numbers WHERE N > ?", (4,)).fetchall()
+        finally:
+            SQL_TRACE.enabled = False
+
+        self.assertEqual(len(rows), 5)
+        calls, seconds, traced_rows, plan = SQL_TRACE.stats["SELECT N FROM Numbers WHERE N > ?"]
+        self.assertEqual((calls, traced_rows), (1, 5))
+        self.assertIn("SEARCH", plan[0]) # uses the primary key
+        self.assertEqual(len(SQL_TRACE.stats), 1) # nothing was traced while it was off
+
+    def test_profile_includes_commands(self):
+        # the prompt's commands run on the JOBS worker thread, which --profile has to profile too
+        def command_to_profile(*args):
+            time.sleep(0.01)
+        def main_with_command(args):
+            submit_command("time_plot woman", "time_plot", ["time_plot", "woman"], {}, {})
+            wait_for_jobs()
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, "capapi.prof")
+            with unittest.mock.patch.multiple(capapi, JOBS=JobRunner(), PROFILE_FNAME=fname, BACKGROUND_COMMANDS=False,
+                    run_command=command_to_profile, main=main_with_command):
+                with unittest.mock.patch('sys.stdout', new_callable=io.StringIO):
+                    profile_main([])
+            functions = [function for file, line, function in pstats.Stats(fname).stats]
+        self.assertIn('command_to_profile', functions)
+        self.assertIn('main_with_command', functions)
+
+class TestJobs(unittest.TestCase):
+
+    def test_queue_and_failures(self):
+        finished = []
+        runner = JobRunner(on_finish=finished.append)
+        runner.submit("first", lambda: time.sleep(0.1))
+        queued = runner.submit("second", lambda: 1 / 0)
+        skipped = runner.submit("third", lambda: None)
+        self.assertEqual(runner.cancel(skipped.id), skipped) # cancelled while it's still queued
+        self.assertTrue(runner.wait(10))
+        runner.stop()
+
+        self.assertEqual([job.text for job in finished], ["first", "second", "third"])
+        self.assertEqual([job.state for job in finished], ['done', 'failed', 'cancelled'])
+        self.assertIn("ZeroDivisionError", queued.error)
+
+    def test_cancel_scan_and_query(self):
+        def scan():
+            while True: # like a scan loop over rows that never ends
+                advance()
+
+        def query():
+            statement = "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n) SELECT MAX(i) FROM n"
+            get_connection(path).execute(statement).fetchone()
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "empty.db")
+            sqlite.connect(path).close()
+            runner = JobRunner()
+            for func in [scan, query]:
+                job = runner.submit(func.__name__, func)
+                while job.state == 'queued':
+                    time.sleep(0.01)
+                time.sleep(0.1)
+                self.assertEqual(runner.cancel(), job)
+                self.assertTrue(runner.wait(10))
+                self.assertEqual(job.state, 'cancelled')
+            runner.stop()
+
+    def test_failed_command_keeps_table(self):
+        # a cases_matching, next or prev that fails (or is cancelled) leaves the table where it was
+        table = {'word': "woman", 'dates': (None, None), 'pages': [0, 25], 'next': 50}
+        options = {'date_min': "2016-02-01", 'date_max': None}
+        with unittest.mock.patch('capapi.make_table_with_word', side_effect=Cancelled()):
+            for words in [["cases_matching", "gender"], ["next"], ["prev"]]:
+                with self.assertRaises(Cancelled):
+                    run_command(words[0], words, options, table)
+        self.assertEqual(table, {'word': "woman", 'dates': (None, None), 'pages': [0, 25], 'next': 50})
+
+        with unittest.mock.patch('capapi.make_table_with_word', return_value=None) as make_table:
+            run_command("cases_matching", ["cases_matching", "gender"], options, table)
+        make_table.assert_called_once_with("gender", 0, 1, "2016-02-01", None)
+        self.assertEqual(table, {'word': "gender", 'dates': ("2016-02-01", None), 'pages': [0], 'next': None})
+
+class TestService(TempDatabase, unittest.TestCase):
+
+    def get(self, url):
+        try:
+            with urllib.request.urlopen(url) as response:
+                return (response.status, json.loads(response.read()))
+        except urllib.error.HTTPError as e:
+            return (e.code, json.loads(e.read()))
+
+    def test_endpoints(self):
+        self.build_db(self.make_cases(200, seed=2))
+        with QueryService(SERVICE_ENDPOINTS, workers=2, timeout=30, metrics=service_metrics) as service:
+            status, body = self.get(service.url + "/cases_by_state?from=2016-02-01")
+            self.assertEqual(status, 200)
+            self.assertEqual([list(state.values()) for state in body['result']],
+                [list(state) for state in get_cases_by_state("2016-02-01")])
+
+            status, body = self.get(service.url + "/freq_by_time?word=the&word=woman&by=month")
+            self.assertEqual(body['result']['woman'], get_freq_by_time_for(["woman"], granularity='month')[0])
+
+            status, body = self.get(service.url + "/cases_containing?word=woman")
+            self.assertEqual(len(body['result']), len(get_list_of_cases_containing("woman")))
+
+            self.assertEqual(self.get(service.url + "/percent_by_state_containing")[0], 400) # no word
+            self.assertEqual(self.get(service.url + "/cases_by_state?to=2016-02-30")[0], 400)
+            self.assertEqual(self.get(service.url + "/cases")[0], 404)
+
+            metrics = self.get(service.url + "/metrics")[1]
+            self.assertEqual(metrics['endpoints']['/cases_by_state']['requests'], 2)
+            self.assertEqual(metrics['endpoints']['/cases_by_state']['errors'], 1)
+            self.assertGreater(metrics['query_cache']['misses'], 0)
+
+    def test_timeout(self):
+        def endless(params):
+            statement = "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n) SELECT MAX(i) FROM n"
+            return get_connection(path).execute(statement).fetchone()
+
+        path = self.path("empty.db")
+        sqlite.connect(path).close()
+        endpoints = {'/endless': endless, '/quick': lambda params: params}
+        with QueryService(endpoints, workers=1, timeout=0.2) as service:
+            self.assertEqual(self.get(service.url + "/endless")[0], 504)
+            # the query was cancelled, so the only worker is free again
+            self.assertEqual(self.get(service.url + "/quick?a=1"), (200, {'result': {'a': ['1']}, 'seconds': unittest.mock.ANY}))
+            self.assertEqual(self.get(service.url + "/metrics")[1]['endpoints']['/endless']['timeouts'], 1)
+
+class TestDates(unittest.TestCase):
+
+    def test_periods(self):
+        day = date_to_day("2016-03-15")
+        self.assertEqual(day_to_date(day), "2016-03-15")
+        self.assertEqual(day_to_date(period_start(day, 'week')), "2016-03-14") # a Monday
+        self.assertEqual(day_to_date(period_start(day, 'month')), "2016-03-01")
+        self.assertEqual(day_to_date(period_end(day, 'month')), "2016-03-31")
+        self.assertEqual(day_to_date(period_end(date_to_day("2016-12-05"), 'month')), "2016-12-31")
+        self.assertEqual(day_to_date(period_start(day, 'year')), "2016-01-01")
+
+        # SQLite puts days in the same periods
+        conn = sqlite.connect(":memory:")
+        for granularity in ['week', 'month', 'year']:
+            statement = "SELECT {} FROM (SELECT ? AS Day)".format(period_sql(granularity, "Day"))
+            for day in range(date_to_day("2015-12-20"), date_to_day("2016-03-10")):
+                self.assertEqual(conn.execute(statement, (day,)).fetchone()[0], period_start(day, granularity))
+
+    def test_split_day_range(self):
+        first, last = date_to_day("2016-02-10"), date_to_day("2016-09-03")
+        buckets, edges = split_day_range(first, last, 'month')
+        self.assertEqual([day_to_date(day) for day in buckets], ["2016-03-01", "2016-08-31"])
+        self.assertEqual(edges, [(first, date_to_day("2016-02-29")), (date_to_day("2016-09-01"), last)])
+
+        self.assertEqual(split_day_range(first, first + 3, 'month'), (None, [(first, first + 3)])) # all in February
+        self.assertEqual(split_day_range(None, None, 'year'), ((None, None), []))
+
+class TestTokenizer(unittest.TestCase):
+
+    def test_tokenize(self):
+        text = "The Court's order: the WOMAN, and two women's claims (see U.S.C. 1983)."
+        self.assertEqual(tokenize(text), ["the", "court", "order", "the", "woman", "and", "two", "women", "claims",
+            "see", "u", "s", "c", "1983"])
+        self.assertEqual(tokenize("Don't"), ["don't"])
+        self.assertEqual(tokenize(text, 'split')[:2], ["The", "Court's"])
+
+        self.assertEqual([stem(word) for word in ["courts", "policies", "statutes", "class", "corpus", "is"]],
+            ["court", "policy", "statute", "class", "corpus", "is"])
+        self.assertIn("claim", tokenize(text, 'words+stem'))
+
+        self.assertTrue(has_phrase(text, "Woman"))
+        self.assertTrue(has_phrase(text, "two women"))
+        self.assertFalse(has_phrase(text, "man"))
+        self.assertFalse(has_phrase(text, "women two"))
+        self.assertEqual(index_text("A, b; C."), "a b c")
+
+class TestNormalizedQueries(TempDatabase, unittest.TestCase):
+
+    def test_queries_share_normalization(self):
+        # the same answers with and without the full-text index, and for words typed differently
+        courts = self.courts
+        cases = [
+            ("A v. B", "A", "2016-01-04", courts[0][2], "The Woman's motion, to dismiss is granted.", 1),
+            ("C v. D", "C", "2016-01-05", courts[1][2], "Motion to dismiss denied; the woman appeals.", 2),
+            ("E v. F", "E", "2016-01-05", courts[2][2], "Nothing about a womanly concern here.", 3),
+        ]
+        for fts in [True, False]:
+            self.build_db(cases, "fts.db" if fts else "scan.db", fts=fts, term_index=fts)
+
+            self.assertEqual(len(get_list_of_cases_containing("woman")), 2)
+            self.assertEqual(len(get_list_of_cases_containing("WOMAN,")), 2)
+            self.assertEqual(len(get_list_of_cases_containing("motion to dismiss")), 2)
+            by_date = get_freq_by_time_for(["woman", "Woman,"])
+            self.assertEqual(by_date[0], by_date[1])
+            self.assertEqual(by_date[0]["2016-01-04"], 1 / 7)
+
+    def test_fts_apostrophes_match_scan(self):
+        # FTS5 keeps the apostrophes tokenize() keeps, so "o" isn't a word of "O'Connor" in either
+        courts = self.courts
+        cases = [
+            ("A v. B", "A", "2016-01-04", courts[0][2], "The court didn't rule for O'Connor.", 1),
+            ("C v. D", "C", "2016-01-05", courts[1][2], "Connor did not appeal, or didn rule.", 2),
+        ]
+        queries = ["connor", "o", "didn", "o'connor", "didn't", "O’Connor"]
+        results = {}
+        for fts in [True, False]:
+            self.build_db(cases, "fts.db" if fts else "scan.db", fts=fts, term_index=False)
+            results[fts] = [sorted(get_list_of_cases_containing(query)) for query in queries]
+        for query, with_fts, scanned in zip(queries, results[True], results[False]):
+            self.assertEqual(with_fts, scanned, query)
+        self.assertEqual([len(result) for result in results[True]], [1, 0, 1, 1, 1, 1])
+
+        # an index from before FTS_TOKENIZE is rebuilt by upgrade_db()
+        capapi.DBNAME = self.path("fts.db")
+        conn = sqlite.connect(capapi.DBNAME)
+        conn.execute("DROP TABLE CasesFts")
+        conn.execute("CREATE VIRTUAL TABLE CasesFts USING fts5(CaseBody, content='Cases', content_rowid='Id')")
+        conn.execute("INSERT INTO CasesFts(CasesFts) VALUES ('rebuild')")
+        conn.commit()
+        conn.close()
+        QUERY_CACHE.clear()
+        self.assertEqual(len(get_list_of_cases_containing("o")), 1)
+        with unittest.mock.patch('builtins.print'):
+            upgrade_db()
+        QUERY_CACHE.clear()
+        self.assertEqual(len(get_list_of_cases_containing("o")), 0)
+
+    def test_fts_matches_scan(self):
+        # whole words and phrases: the full-text index finds the same cases as the scan fallback
+        cases = self.make_cases(200)
+        queries = ["woman", "Court", "the court", "of the", "motion to", "court the", "quokka"]
+        results = {}
+        for fts in [True, False]:
+            self.build_db(cases, "fts.db" if fts else "scan.db", fts=fts, term_index=False)
+            self.assertEqual(has_fts_index(get_connection(capapi.DBNAME).cursor()), fts)
+            results[fts] = [(sorted(get_list_of_cases_containing(query)),
+                sorted(get_list_of_cases_containing(query, "2016-03-01", "2016-06-30")),
+                get_percent_by_state_containing(query)) for query in queries]
+
+        for query, with_fts, scanned in zip(queries, results[True], results[False]):
+            self.assertEqual(with_fts, scanned, query)
+        counts = {query: len(result[0]) for query, result in zip(queries, results[True])}
+        self.assertGreater(counts["the court"], 0)
+        self.assertLess(counts["the court"], counts["Court"]) # a phrase, not both words anywhere
+        self.assertEqual(counts["quokka"], 0)
+
+    def test_term_index_matches_scan(self):
+        # the term index holds the same per-date counts as tokenizing every case, so time_plot gives
+        # the same frequencies with it as without it, including for a word that's in no case
+        cases = self.make_cases(200)
+        words = ["the", "woman", "Court", "judgment", "quokka"]
+        self.build_db(cases, "index.db", fts=False, term_index=True)
+        conn = get_connection(capapi.DBNAME)
+        tokens = {word.lower() for word in words}
+        date_totals, word_counts = count_words_in_rows(capapi.DBNAME, tokens)
+        self.assertEqual(dict(conn.execute("SELECT DecisionDate, Total FROM DateTotals")), date_totals)
+        statement = "SELECT Token, DecisionDate, Count FROM TermCounts WHERE Token IN ({})".format(",".join("?" * len(tokens)))
+        self.assertEqual({(token, date): count for token, date, count in conn.execute(statement, list(tokens))}, word_counts)
+        self.assertNotIn("quokka", {word for word, date in word_counts})
+
+        ranges = [(None, None), ("2016-02-10", "2016-11-20")]
+        indexed = [get_freq_by_time_for(words, granularity=granularity, date_min=date_min, date_max=date_max)
+            for granularity in GRANULARITIES for date_min, date_max in ranges]
+        self.build_db(cases, "scan.db", fts=False, term_index=False)
+        scanned = [get_freq_by_time_for(words, granularity=granularity, date_min=date_min, date_max=date_max)
+            for granularity in GRANULARITIES for date_min, date_max in ranges]
+        for indexed_dicts, scanned_dicts in zip(indexed, scanned):
+            for word, indexed_dict, scanned_dict in zip(words, indexed_dicts, scanned_dicts):
+                self.assertEqual(list(indexed_dict), list(scanned_dict), word)
+                for date in indexed_dict:
+                    self.assertAlmostEqual(indexed_dict[date], scanned_dict[date])
+        self.assertEqual(set(indexed[0][-1].values()), {0})
+
+@unittest.skipIf(importlib.util.find_spec('numpy') is None, "the snapshot needs numpy")
+class TestSnapshot(TempDatabase, unittest.TestCase):
+
+    def test_snapshot_matches_queries(self):
+        import numpy
+        from snapshot import export_snapshot, load_snapshot
+        self.build_db(self.make_cases(300))
+        conn = sqlite.connect(capapi.DBNAME)
+        manifest = export_snapshot(conn, self.path("snapshot"))
+        snap = load_snapshot(self.path("snapshot"))
+
+        self.assertEqual(manifest['cases'], 300)
+        self.assertIsInstance(snap.indices, numpy.memmap) # mapped, not read in
+        self.assertTrue(snap.is_current(conn.cursor()))
+
+        self.assertEqual(snap.cases_by_state(), {state[0]: state[2] for state in get_cases_by_state()})
+        self.assertEqual(snap.cases_by_state("2016-03-01", "2016-05-31"),
+            {state[0]: state[2] for state in get_cases_by_state("2016-03-01", "2016-05-31")})
+        percents = snap.percent_by_state_containing("woman")
+        for abbr, percent in get_percent_by_state_containing("woman"):
+            self.assertAlmostEqual(percents[abbr], percent)
+
+        for granularity in GRANULARITIES:
+            expected = get_freq_by_time_for(["the", "woman"], granularity=granularity, date_min="2016-02-10", date_max="2016-11-20")
+            result = snap.freq_by_time(["the", "woman"], granularity, "2016-02-10", "2016-11-20")
+            for word_dict, expected_dict in zip(result, expected):
+                self.assertEqual(list(word_dict), list(expected_dict))
+                for date in word_dict:
+                    self.assertAlmostEqual(word_dict[date], expected_dict[date])
+        conn.close()
+
+class TestCompression(TempDatabase, unittest.TestCase):
+
+    def test_round_trip(self):
+        text = "The court's order — § 1983, naïve café.\n" * 20
+        codecs = [None, 'zlib'] + (['zstd'] if importlib.util.find_spec('zstandard') else [])
+        for codec in codecs:
+            value = compress_body(text, codec)
+            self.assertIsInstance(value, str if codec is None else bytes)
+            self.assertEqual(decompress_body(value), text)
+        self.assertIsNone(decompress_body(compress_body(None, 'zlib')))
+        with self.assertRaises(ValueError):
+            compress_body(text, 'lzma')
+
+    def test_compress_db_keeps_results(self):
+        # the same answers after compress_db(), through the full-text index and through the scans
+        cases = self.make_cases(150)
+        for fts in [True, False]:
+            self.build_db(cases, "fts.db" if fts else "scan.db", fts=fts, term_index=fts)
+            def search():
+                QUERY_CACHE.clear()
+                return (get_list_of_cases_containing("woman"), get_list_of_cases_containing("the woman"),
+                    get_percent_by_state_containing_all(["woman", "court"]), get_freq_by_time_for(["woman"], granularity='month'))
+            before = search()
+
+            compress_db('zlib')
+            conn = sqlite.connect(capapi.DBNAME)
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM Cases WHERE typeof(CaseBody) != 'blob'").fetchone()[0], 0)
+            conn.close()
+            self.assertEqual(search(), before)
+            self.assertGreater(len(before[0]), 0)
+
+class TestCaseTable(TempDatabase, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.build_db(self.make_cases(200))
+
+    def test_estimate_counts_listed_cases(self):
+        # a case in a court with no state isn't listed, so it isn't counted either
+        conn = connect(capapi.DBNAME)
+        conn.execute("INSERT INTO DistrictCourts (CourtName, Citation) VALUES ('District of Nowhere', 'D. Nowh.')")
+        upsert_cases(conn.cursor(), [("X v. Y", "X v. Y", "2016-05-02", "D. Nowh.", "the woman", 9999)], get_court_ids(conn.cursor()))
+        conn.commit()
+        conn.close()
+        QUERY_CACHE.clear()
+        self.assertEqual(estimate_count_of_cases_containing("woman"), (len(get_list_of_cases_containing("woman")), True))
+
+    def test_figure_cache_hit_skips_page_query(self):
+        drawn = {}
+        def show_figure(name, key_args, build): # a figure cache that draws each figure once
+            key = json.dumps(key_args)
+            if key not in drawn:
+                drawn[key] = build()
+        with unittest.mock.patch.multiple(capapi, show_figure=show_figure, build_table_of_cases=lambda *args: args[1]), \
+                unittest.mock.patch('capapi.get_page_of_cases_containing', wraps=get_page_of_cases_containing) as page_query:
+            first = make_table_with_word("woman")
+            self.assertEqual(page_query.call_count, 1)
+            self.assertIsNotNone(first)
+            self.assertEqual(make_table_with_word("Woman"), first) # drawn already
+            self.assertEqual(page_query.call_count, 1)
+
+            QUERY_CACHE.clear() # e.g. a new session, with the figure still on disk
+            self.assertEqual(make_table_with_word("woman"), first)
+            self.assertEqual(page_query.call_count, 2)
+        self.assertEqual(len(drawn), 1)
+
+class TestRollups(TempDatabase, unittest.TestCase):
+
+    def assertRollupsMatch(self, cur):
+        # the rollup against the same counts taken straight from Cases (rows counted down to 0 stay)
+        rollup = "SELECT StateId, Count FROM StateCounts WHERE Count != 0"
+        expected = '''
+        SELECT DistrictCourts.StateId, COUNT(*)
+        FROM Cases
+        JOIN DistrictCourts
+        ON Cases.CourtId = DistrictCourts.Id
+        WHERE DistrictCourts.StateId IS NOT NULL
+        GROUP BY DistrictCourts.StateId
+        '''
+        self.assertEqual(sorted(cur.execute(rollup).fetchall()), sorted(cur.execute(expected).fetchall()))
+
+    def test_triggers_keep_rollups_current(self):
+        cases = self.make_cases(300)
+        self.build_db(cases[:200])
+        conn = connect(capapi.DBNAME)
+        cur = conn.cursor()
+        court_ids = get_court_ids(cur)
+        self.assertRollupsMatch(cur)
+
+        self.assertEqual(upsert_cases(cur, cases[200:], court_ids), 100) # inserts
+        self.assertRollupsMatch(cur)
+
+        # updates, moving cases to another court (in another state) and another date
+        changed = [case[:2] + ("2016-12-30", self.courts[3][2]) + case[4:] for case in cases[:50]]
+        self.assertEqual(upsert_cases(cur, changed, court_ids), 50)
+        self.assertRollupsMatch(cur)
+
+        cur.execute("DELETE FROM Cases WHERE Id % 3 = 0")
+        self.assertRollupsMatch(cur)
+        conn.close()
+
+    def test_unread_rollups_dropped(self):
+        # rollups earlier versions kept go when the rollups are rebuilt
+        self.build_db(self.make_cases(20))
+        conn = connect(capapi.DBNAME)
+        conn.execute("CREATE TABLE CircuitCounts (Circuit TEXT PRIMARY KEY, Count INTEGER)")
+        create_rollups(conn)
+        self.assertEqual([table for table in ['CourtCounts', 'CircuitCounts', 'MonthCounts', 'PeriodCounts']
+            if has_table(conn.cursor(), table)], [])
+        conn.close()
+
+    def test_upsert_batch_under_variable_limit(self):
+        # a full INSERT_BATCH_SIZE batch, with SQLite limited to 999 variables like before 3.32
+        cases = self.make_cases(capapi.INSERT_BATCH_SIZE)
+        self.build_db(cases[:10])
+        conn = connect(capapi.DBNAME)
+        conn.setlimit(sqlite.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+        self.assertEqual(upsert_cases(conn.cursor(), cases, get_court_ids(conn.cursor())), len(cases) - 10)
+        self.assertRollupsMatch(conn.cursor())
+        conn.close()
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_synthetic_corpus(self):
+        rng = random.Random(1)
+        courts = benchmark.make_courts(rng, STATESCSV)
+        self.assertEqual(len(courts), 94) # same as the real list of district courts
+
+        cases = list(benchmark.iter_cases(10, courts, rng, median_words=50))
+        self.assertEqual(len(cases), 10)
+        self.assertEqual(len(cases[0]), 6) # (name, name_abbr, date, court, text, cap_id)
+
+    def test_ordinal(self):
+        self.assertEqual([benchmark.ordinal(n) for n in ["1", "2", "3", "4", "11", "12", "13", "21", "111", "DC"]],
+            ["1st", "2nd", "3rd", "4th", "11th", "12th", "13th", "21st", "111th", "DC"])
+
+    def test_benchmark_run(self):
+        results = benchmark.run_one(200, median_words=50)
+
+        self.assertEqual(results['cases'], 200)
+        self.assertGreater(results['ingest'], 0)
+        self.assertIn('get_freq_by_time_for (cached)', results)
+        self.assertEqual(DBNAME, 'law.db') # put back afterwards
+
+        baseline = dict(results, ingest=1.0)
+        self.assertEqual(benchmark.check_baseline([baseline], [baseline], 1.5), [])
+        slower = dict(results, ingest=2.0)
+        self.assertEqual(len(benchmark.check_baseline([slower], [baseline], 1.5)), 1)
+
 class TestStorage(unittest.TestCase):
 
     def test_states_table(self):
@@ -112,6 +977,20 @@ class TestProcessing(unittest.TestCase):
         self.assertIs(type(null_result), list) # still a list...
         self.assertEqual(len(null_result),0) # but no tuples in it
 
+    def test_pages_of_cases_with_word(self):
+        common_word = "has"
+        case_list, next_after = get_page_of_cases_containing(common_word, page_size=5)
+
+        self.assertEqual(len(case_list), 5)
+        self.assertIs(len(case_list[0]), 6) # same tuples as get_list_of_cases_containing
+        self.assertIsNotNone(next_after)
+
+        next_case_list, next_after = get_page_of_cases_containing(common_word, next_after, 5)
+        self.assertNotIn(next_case_list[0], case_list) # pages don't overlap
+
+        all_cases = list(iter_cases_containing(common_word, batch_size=7))
+        self.assertEqual(sorted(all_cases), sorted(get_list_of_cases_containing(common_word)))
+
     def test_freq_of_words_by_time(self):
         list_of_words = ["the", "women", "arn4389fd"]
 
@@ -130,4 +1009,12 @@ class TestProcessing(unittest.TestCase):
         for date in result[2]:
             self.assertEqual(result[2][date], 0) # that nonsense word shouldn't show up on any day!
 
+    def test_freq_of_words_by_period(self):
+        by_day = get_freq_by_time_for(["the"])[0]
+        by_month = get_freq_by_time_for(["the"], granularity='month')[0]
+        self.assertEqual(sorted(by_month), sorted(set(date[:8] + "01" for date in by_day)))
+
+        first = min(by_day)
+        self.assertEqual(get_freq_by_time_for(["the"], date_min=first, date_max=first), [{first: by_day[first]}])
+
 unittest.main(verbosity=2)
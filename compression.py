@@ -0,0 +1,192 @@
+import hashlib
+import sqlite3 as sqlite
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+'''
+Optional compression for Cases.CaseBody.
+
+Full opinion text is most of the bytes in law.db. A compressed body is stored as a
+BLOB that starts with a one-byte codec tag; an uncompressed body is stored as TEXT,
+same as always, so a database can hold a mix of both while it's being migrated.
+
+  b'\x01' + zlib stream
+  b'\x02' + 8-byte dictionary key + zstd frame (needs the 'zstandard' package)
+
+zstd compresses short legal opinions much better with a dictionary trained on
+a sample of them. Dictionaries are kept in the CompressionDicts table, keyed by
+a hash of their contents, so a key means the same dictionary in any database.
+
+Every connection that reads or writes Cases should call register_functions(),
+which adds the SQL function body_text(CaseBody). It returns the plain text
+whatever the storage format, and only decompresses the rows a query asks for.
+'''
+
+ZLIB = b'\x01'
+ZSTD = b'\x02'
+NO_DICT = b'\x00' * 8
+
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 9
+ZSTD_DICT_SIZE = 112640 # bytes, zstd's own default
+
+DICTS = {} # dictionary key -> zstandard.ZstdCompressionDict
+COMPRESSORS = {}
+DECOMPRESSORS = {}
+
+def require_zstd():
+    if zstandard is None:
+        raise RuntimeError("zstd compression needs the 'zstandard' package (pip install zstandard)")
+
+def create_dict_table(cur):
+    statement = '''
+    CREATE TABLE IF NOT EXISTS CompressionDicts (
+    Key BLOB PRIMARY KEY,
+    Dict BLOB,
+    Created TEXT
+    );
+    '''
+    cur.execute(statement)
+
+def train_dict(conn, samples, size=ZSTD_DICT_SIZE):
+    # trains a zstd dictionary on a list of texts, stores it, and returns its key
+    require_zstd()
+    data = zstandard.train_dictionary(size, [text.encode('utf-8') for text in samples])
+    raw = data.as_bytes()
+    key = hashlib.sha1(raw).digest()[:8]
+
+    cur = conn.cursor()
+    create_dict_table(cur)
+    statement = "INSERT OR IGNORE INTO CompressionDicts (Key, Dict, Created) VALUES (?, ?, datetime('now'))"
+    cur.execute(statement, (key, raw))
+    conn.commit()
+    DICTS[key] = data
+    return key
+
+def latest_dict_key(conn):
+    statement = "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'CompressionDicts'"
+    if conn.execute(statement).fetchone() is None:
+        return NO_DICT
+    result = conn.execute("SELECT Key FROM CompressionDicts ORDER BY Created DESC, rowid DESC LIMIT 1").fetchone()
+    if result is None:
+        return NO_DICT
+    return bytes(result[0])
+
+def get_dict(conn, key):
+    if key == NO_DICT:
+        return None
+    if key not in DICTS:
+        result = conn.execute("SELECT Dict FROM CompressionDicts WHERE Key = ?", (key,)).fetchone()
+        if result is None:
+            raise ValueError("CaseBody was compressed with a zstd dictionary that isn't in this database")
+        DICTS[key] = zstandard.ZstdCompressionDict(bytes(result[0]))
+    return DICTS[key]
+
+def compress_body(text, codec, conn=None, key=None):
+    # codec is None (store as plain text), 'zlib' or 'zstd' (uses the dictionary key, or else the
+    # newest dictionary in conn, if any; callers compressing many rows look key up once for them all)
+    if codec is None or text is None:
+        return text
+    data = text.encode('utf-8')
+    if codec == 'zlib':
+        return ZLIB + zlib.compress(data, ZLIB_LEVEL)
+    if codec == 'zstd':
+        require_zstd()
+        if key is None:
+            key = latest_dict_key(conn) if conn is not None else NO_DICT
+        if key not in COMPRESSORS:
+            COMPRESSORS[key] = zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=get_dict(conn, key))
+        return ZSTD + key + COMPRESSORS[key].compress(data)
+    raise ValueError("Unknown CaseBody compression: {}".format(codec))
+
+def decompress_body(value, conn=None):
+    if not isinstance(value, bytes):
+        return value # plain text (or NULL)
+    tag = value[:1]
+    if tag == ZLIB:
+        return zlib.decompress(value[1:]).decode('utf-8')
+    if tag == ZSTD:
+        require_zstd()
+        key = value[1:9]
+        if key not in DECOMPRESSORS:
+            DECOMPRESSORS[key] = zstandard.ZstdDecompressor(dict_data=get_dict(conn, key))
+        return DECOMPRESSORS[key].decompress(value[9:]).decode('utf-8')
+    raise ValueError("Unknown CaseBody format")
+
+def register_functions(conn):
+    conn.create_function('body_text', 1, lambda value: decompress_body(value, conn), deterministic=True)
+    return conn
+
+''' Space and speed trade-offs '''
+
+def compression_report(conn, sample_size=1000):
+    # Compresses a sample of case bodies with each available codec and prints the resulting size,
+    # compression/decompression throughput, and how long a LIKE scan over the sample takes.
+    statement = '''
+    SELECT body_text(CaseBody)
+    FROM Cases
+    ORDER BY RANDOM()
+    LIMIT ?
+    '''
+    samples = [row[0] for row in conn.execute(statement, (sample_size,)) if row[0]]
+    if not samples:
+        print("No cases to sample.")
+        return []
+
+    raw_bytes = sum(len(text.encode('utf-8')) for text in samples)
+    codecs = ['zlib']
+    if zstandard is not None:
+        codecs.append('zstd')
+
+    # a throwaway in-memory table holding the sample in each format
+    scratch = register_functions(sqlite.connect(':memory:'))
+    scratch.execute("CREATE TABLE Cases (Id INTEGER PRIMARY KEY, CaseBody)")
+    if zstandard is not None:
+        train_dict(scratch, samples[:max(10, len(samples) // 2)])
+        codecs.append('zstd+dict')
+
+    report = []
+    for codec in [None] + codecs:
+        if codec == 'zstd':
+            compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+            encode = lambda text: ZSTD + NO_DICT + compressor.compress(text.encode('utf-8'))
+        elif codec == 'zstd+dict':
+            encode = lambda text: compress_body(text, 'zstd', scratch)
+        else:
+            encode = lambda text: compress_body(text, codec)
+
+        start = time.perf_counter()
+        encoded = [encode(text) for text in samples]
+        compress_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for value in encoded:
+            decompress_body(value, scratch)
+        decompress_time = time.perf_counter() - start
+
+        scratch.execute("DELETE FROM Cases")
+        scratch.executemany("INSERT INTO Cases (CaseBody) VALUES (?)", [(value,) for value in encoded])
+        start = time.perf_counter()
+        scratch.execute("SELECT COUNT(*) FROM Cases WHERE body_text(CaseBody) LIKE '%plaintiff%'").fetchone()
+        scan_time = time.perf_counter() - start
+
+        stored_bytes = sum(len(value.encode('utf-8')) if isinstance(value, str) else len(value) for value in encoded)
+        report.append((codec or 'none', stored_bytes / raw_bytes, raw_bytes / 1e6 / max(compress_time, 1e-9),
+            raw_bytes / 1e6 / max(decompress_time, 1e-9), scan_time))
+
+    scratch.close()
+
+    print("Sample of {} cases, {:.1f} MB of text".format(len(samples), raw_bytes / 1e6))
+    print("{:<10} {:>8} {:>14} {:>16} {:>12}".format("codec", "ratio", "compress MB/s", "decompress MB/s", "LIKE scan s"))
+    for row in report:
+        if row[0] == 'none':
+            print("{:<10} {:>8.3f} {:>14} {:>16} {:>12.4f}".format(row[0], row[1], "-", "-", row[4]))
+        else:
+            print("{:<10} {:>8.3f} {:>14.1f} {:>16.1f} {:>12.4f}".format(*row))
+
+    return report
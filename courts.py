@@ -0,0 +1,160 @@
+import hashlib
+import re
+from html.parser import HTMLParser
+
+'''
+The district court list, as reference data.
+
+get_courts_data() used to parse Wikipedia's whole list of courts with
+BeautifulSoup every time the database was rebuilt. The page rarely changes, so
+now it's parsed once per version of the page: load_courts() keeps the parsed,
+validated court tuples in the cache under REFERENCE_KEY, along with a checksum
+of the HTML they came from and COURTS_FORMAT, and only parses the page again if
+it (or the parser, which bumps COURTS_FORMAT) changes. Validating the courts
+drops the rows that don't look like courts (printing them) and checks that
+each one's state is in state_table.csv, under its own name or an alias in
+STATE_ALIASES, so create_db() can match courts to states with a dict lookup.
+
+The parser is html.parser from the standard library, fed only the court table
+(from its opening tag until that table closes), not the rest of the page.
+'''
+
+REFERENCE_KEY = "reference:district_courts"
+COURTS_FORMAT = 1 # bump when parse_courts() or court_state() change what they produce
+
+TABLE_CLASSES = {'wikitable', 'sortable'}
+FOOTNOTE = re.compile(r"\[\w+\]") # e.g. "[3]", in case the reference markup is missed
+
+# state names in the court list -> the names state_table.csv uses for them
+STATE_ALIASES = {
+    "District of Columbia": "Washington DC",
+    "Virgin Islands": "U.S. Virgin Islands",
+}
+
+class CourtTableParser(HTMLParser):
+    # collects the text of each cell in each row of the first table with TABLE_CLASSES,
+    # skipping footnote references
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.rows = []
+        self.depth = 0 # tables open inside (and including) the court table
+        self.done = False
+        self.row = None
+        self.cell = None
+        self.skipping = 0 # open <sup> tags, whose text is a footnote mark
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if tag == 'table':
+            classes = set((dict(attrs).get('class') or "").split())
+            if self.depth > 0 or TABLE_CLASSES <= classes:
+                self.depth += 1
+        elif self.depth != 1:
+            return
+        elif tag == 'tr':
+            self.row = []
+        elif tag in ('td', 'th') and self.row is not None:
+            self.cell = [] if tag == 'td' else None
+        elif tag == 'sup':
+            self.skipping += 1
+        elif tag == 'br' and self.cell is not None:
+            self.cell.append(" ")
+
+    def handle_endtag(self, tag):
+        if self.done or self.depth == 0:
+            return
+        if tag == 'table':
+            self.depth -= 1
+            self.done = self.depth == 0
+        elif self.depth != 1:
+            return
+        elif tag in ('td', 'th'):
+            if self.cell is not None:
+                self.row.append("".join(self.cell))
+            self.cell = None
+        elif tag == 'tr':
+            if self.row:
+                self.rows.append(self.row)
+            self.row = None
+        elif tag == 'sup' and self.skipping:
+            self.skipping -= 1
+
+    def handle_data(self, data):
+        if self.cell is not None and not self.skipping and self.depth == 1:
+            self.cell.append(data)
+
+def find_table(html):
+    # the position of the court table's opening tag (or 0 if it can't be found, to parse it all)
+    for match in re.finditer(r'<table\b[^>]*\bclass="([^"]*)"', html):
+        if TABLE_CLASSES <= set(match.group(1).split()):
+            return match.start()
+    return 0
+
+def parse_courts(html, chunk_size=65536):
+    # Wikipedia's list of district courts -> (state, name, cite, appeals, estd, judges) for each court
+    parser = CourtTableParser()
+    start = find_table(html)
+    # fed a piece at a time, so nothing after the table is parsed
+    for i in range(start, len(html), chunk_size):
+        parser.feed(html[i:i + chunk_size])
+        if parser.done:
+            break
+    parser.close()
+
+    list_of_courts = []
+    for row in parser.rows:
+        if len(row) < 5:
+            continue # a header row, or one split by a rowspan
+        name, cite, appeals, estd, judges = [" ".join(FOOTNOTE.sub("", cell).split()) for cell in row[:5]]
+        list_of_courts.append((court_state(name), name, cite, appeals, estd, judges))
+    return list_of_courts
+
+def court_state(name):
+    # the state (or territory) a court is in, from its name: "Eastern District of New York" -> "New York"
+    if name.endswith("District of Columbia"):
+        state = "District of Columbia"
+    else:
+        state = name.rpartition("District of ")[2]
+        if state.startswith("the "):
+            state = state[len("the "):]
+    return state
+
+def validate_courts(list_of_courts, state_names):
+    # The courts that look right, printing the ones that don't: a court with no citation (or another
+    # court's), or a number of judges that isn't a number, is left out, and one in a state that
+    # state_table.csv doesn't have is kept (create_db() leaves its StateId NULL). Raises ValueError
+    # only if no courts are left, e.g. because the page's layout changed.
+    valid = []
+    cites = set()
+    for court in list_of_courts:
+        state, name, cite, appeals, estd, judges = court
+        if not cite or cite in cites:
+            print("Skipping court '{}': missing or repeated citation '{}'".format(name, cite))
+            continue
+        if not judges.isdigit():
+            print("Skipping court '{}': number of judges isn't a number: '{}'".format(name, judges))
+            continue
+        if STATE_ALIASES.get(state, state).lower() not in state_names:
+            print("Court '{}' is in a state that isn't in the state table: '{}'".format(name, state))
+        cites.add(cite)
+        valid.append(court)
+    if not valid:
+        raise ValueError("No courts found in the court list")
+    return valid
+
+def checksum(html):
+    return hashlib.sha256(html.encode('utf-8')).hexdigest()
+
+def load_courts(cache, html, state_names):
+    # The court tuples for html: the ones saved in cache if they were parsed from the same html by
+    # this version of the parser, otherwise parsed, validated against state_names (lowercased), and saved.
+    digest = checksum(html)
+    saved = cache.get(REFERENCE_KEY)
+    if saved is not None and saved['checksum'] == digest and saved['format'] == COURTS_FORMAT:
+        return [tuple(court) for court in saved['courts']]
+
+    list_of_courts = validate_courts(parse_courts(html), state_names)
+    cache[REFERENCE_KEY] = {'checksum': digest, 'format': COURTS_FORMAT, 'courts': list_of_courts}
+    return list_of_courts
@@ -0,0 +1,197 @@
+import datetime
+import json
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+A concurrent, rate-limited crawler for the CAP API 'cases' endpoint.
+
+The CAP API paginates with a 'next' cursor, so the pages of a single query can
+only be fetched one after another. To go faster, the requested date range is
+split into independent decision_date_min/decision_date_max windows, and each
+window's cursor chain is followed on its own worker thread. All workers share
+one keep-alive session and one token bucket, so the total request rate stays
+under the limit no matter how many windows there are.
+
+Pages are cached by url. An open-ended crawl (one with no decision_date_max,
+like a sync's) has to be made with refresh=True: the same url asked again later
+can have more cases behind it.
+
+requests is only imported when a Crawler is created, so importing this module
+(for make_windows, say) stays cheap.
+'''
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+class TokenBucket:
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate # tokens added per second
+        self.capacity = capacity if capacity else max(1, rate)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+def make_windows(date_min, date_max, window_days):
+    # splits [date_min, date_max] (inclusive, 'YYYY-MM-DD' strings) into windows of window_days days
+    start = datetime.date.fromisoformat(date_min)
+    end = datetime.date.fromisoformat(date_max)
+    step = datetime.timedelta(days=window_days)
+    windows = []
+    while start <= end:
+        window_end = min(end, start + step - datetime.timedelta(days=1))
+        windows.append((start.isoformat(), window_end.isoformat()))
+        start = window_end + datetime.timedelta(days=1)
+    return windows
+
+class Crawler:
+
+    def __init__(self, cache, api_key="", rate=5.0, workers=8, max_retries=5, backoff=1.0, timeout=60, refresh=False):
+        self.cache = cache
+        self.refresh = refresh # fetch every page again (and update the cache) instead of reading the cache
+        self.api_key = api_key
+        self.bucket = TokenBucket(rate)
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff = backoff # seconds before the first retry, doubled on each one after that
+        self.timeout = timeout
+
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.requests = requests
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        if api_key:
+            self.session.headers['Authorization'] = "Token " + api_key
+
+        self.stats = {'fetched': 0, 'cached': 0, 'retries': 0, 'malformed': 0}
+        self.stats_lock = threading.Lock()
+
+    def _count(self, key):
+        with self.stats_lock:
+            self.stats[key] += 1
+
+    def _get(self, url):
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            try:
+                resp = self.session.get(url, timeout=self.timeout)
+            except self.requests.exceptions.RequestException:
+                if attempt >= self.max_retries:
+                    raise
+                resp = None
+
+            if resp is not None and resp.status_code not in RETRY_STATUSES:
+                resp.raise_for_status()
+                return resp.text
+            if attempt >= self.max_retries:
+                resp.raise_for_status()
+
+            # back off (or do what the server asked) before trying again
+            self._wait(attempt, resp)
+            attempt += 1
+
+    def _wait(self, attempt, resp=None):
+        wait = self.backoff * (2 ** attempt) * (1 + random.random() / 2)
+        if resp is not None and resp.headers.get('Retry-After', '').isdigit():
+            wait = int(resp.headers['Retry-After'])
+        self._count('retries')
+        time.sleep(wait)
+
+    def fetch(self, url):
+        if not self.refresh and url in self.cache:
+            self._count('cached')
+            return self.cache[url]
+
+        # a page that doesn't parse (e.g. cut off mid-response) is fetched again, and never cached
+        attempt = 0
+        while True:
+            try:
+                resp_dict = json.loads(self._get(url))
+                if isinstance(resp_dict, dict) and 'results' in resp_dict and 'next' in resp_dict:
+                    break
+                error = ValueError("Malformed page (no 'results' or 'next'): {}".format(url))
+            except ValueError as e: # includes json.JSONDecodeError
+                error = e
+            self._count('malformed')
+            if attempt >= self.max_retries:
+                raise error
+            self._wait(attempt)
+            attempt += 1
+
+        self.cache[url] = resp_dict
+        self._count('fetched')
+        return resp_dict
+
+    def crawl_window(self, url, max_pages=None, on_page=None):
+        # follows one window's 'next' cursor until it runs out (or max_pages is reached)
+        page = 0
+        while url and (max_pages is None or page < max_pages):
+            resp_dict = self.fetch(url)
+            if on_page(url, resp_dict) is False:
+                return
+            url = resp_dict['next']
+            page += 1
+
+    def iter_pages(self, start_urls, max_pages=None, resume=None):
+        # Yields (start url, page dict) for every page of every window. Pages from different windows
+        # arrive in whatever order they're fetched, but each window's pages come in cursor order.
+        # resume maps a window's start url to the cursor to pick it up from, for interrupted crawls.
+        if resume is None:
+            resume = {}
+        pages = queue.Queue(maxsize=self.workers * 2)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def run(start_url):
+            try:
+                url = resume.get(start_url, start_url)
+                self.crawl_window(url, max_pages, on_page=lambda url, resp_dict: put((start_url, resp_dict)))
+            except Exception as e:
+                put(e)
+            finally:
+                put(done)
+
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            for url in start_urls:
+                executor.submit(run, url)
+            remaining = len(start_urls)
+            while remaining > 0:
+                item = pages.get()
+                if item is done:
+                    remaining -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            stop.set()
+            executor.shutdown(wait=True)
@@ -0,0 +1,117 @@
+import atexit
+import os
+import pathlib
+import sqlite3 as sqlite
+import threading
+import compression
+import tokenizer
+from profiling import TracingConnection
+
+'''
+Shared access to law.db.
+
+The query helpers used to open a new connection on every call and never close
+it. Instead, each thread now gets one long-lived, read-only connection per
+database file, tuned for reading (memory-mapped I/O and a bigger page cache)
+and with a larger prepared-statement cache, so repeated queries skip both the
+connect and the parse. Everything opened here is closed at exit.
+
+Writers (create_db, sync_db, ...) use connect(), which returns an ordinary
+read-write connection; the database is switched to WAL mode so they don't
+block readers.
+
+All of these connections are TracingConnections, so their statements show up
+in profiling.SQL_TRACE whenever it's turned on.
+
+A thread can also give its read connections a cancel event (set_cancel_event,
+which jobs.py does for the command it's running): once the event is set, the
+statement they're running stops with an 'interrupted' OperationalError.
+'''
+
+READ_PRAGMAS = {
+    'mmap_size': 1 << 30, # map up to 1GB of the file instead of copying pages through read()
+    'cache_size': -65536, # negative means KiB, so 64MB
+    'temp_store': 'MEMORY',
+}
+STATEMENT_CACHE_SIZE = 256
+PROGRESS_STEPS = 1000 # SQLite VM instructions between checks of the thread's cancel event
+
+local = threading.local()
+open_connections = []
+open_connections_lock = threading.Lock()
+
+def register_functions(conn):
+    # the SQL functions the schema and the queries use: body_text() (see compression.py), and
+    # has_phrase() and index_text() (see tokenizer.py)
+    compression.register_functions(conn)
+    return tokenizer.register_functions(conn)
+
+def apply_pragmas(conn, pragmas):
+    for pragma in pragmas:
+        conn.execute("PRAGMA {} = {}".format(pragma, pragmas[pragma]))
+
+def track(conn):
+    with open_connections_lock:
+        open_connections.append(conn)
+    return conn
+
+def connect(dbname):
+    # a new read-write connection (the caller closes it)
+    conn = sqlite.connect(dbname, cached_statements=STATEMENT_CACHE_SIZE, factory=TracingConnection)
+    return register_functions(conn)
+
+def enable_wal(conn):
+    # WAL mode is stored in the database file, so this only needs doing once per database
+    conn.execute("PRAGMA journal_mode = WAL")
+
+def get_meta(cur, key, default=None):
+    # a value from the Meta table (see capapi.create_meta_table)
+    result = cur.execute("SELECT Value FROM Meta WHERE Key = ?", (key,)).fetchone()
+    if result is None:
+        return default
+    return result[0]
+
+def set_meta(cur, key, value):
+    if value is None:
+        cur.execute("DELETE FROM Meta WHERE Key = ?", (key,))
+    else:
+        cur.execute("INSERT OR REPLACE INTO Meta (Key, Value) VALUES (?, ?)", (key, value))
+
+def set_cancel_event(event):
+    # event (a threading.Event, or None) cancels this thread's reads when it's set
+    local.cancel_event = event
+
+def is_cancelled():
+    # the progress handler: a true value makes SQLite stop the statement
+    event = getattr(local, 'cancel_event', None)
+    return event is not None and event.is_set()
+
+def open_read_connection(dbname):
+    uri = "{}?mode=ro".format(pathlib.Path(os.path.abspath(dbname)).as_uri())
+    # check_same_thread is off only so that close_all() can close it; it's still used by one thread
+    conn = sqlite.connect(uri, uri=True, cached_statements=STATEMENT_CACHE_SIZE, check_same_thread=False,
+        factory=TracingConnection)
+    apply_pragmas(conn, READ_PRAGMAS)
+    conn.set_progress_handler(is_cancelled, PROGRESS_STEPS)
+    return track(register_functions(conn))
+
+def get_connection(dbname):
+    # This thread's read-only connection to dbname, opened the first time it's asked for.
+    # (A forked child process doesn't reuse its parent's connections; it opens its own.)
+    if getattr(local, 'pid', None) != os.getpid():
+        local.pid = os.getpid()
+        local.connections = {}
+
+    path = os.path.abspath(dbname)
+    if path not in local.connections:
+        local.connections[path] = open_read_connection(dbname)
+    return local.connections[path]
+
+def close_all():
+    with open_connections_lock:
+        for conn in open_connections:
+            conn.close()
+        del open_connections[:]
+    local.connections = {}
+
+atexit.register(close_all)
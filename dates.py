@@ -0,0 +1,113 @@
+import datetime
+
+'''
+Decision dates as integer day numbers.
+
+Cases.DecisionDate (and the date columns of the term index) hold day ordinals,
+datetime.date.toordinal(): 1 is 0001-01-01, and each day after that is one more.
+They take less room than ISO strings, compare and index as plain integers, and
+turn into SQLite julian day numbers by adding JULIAN_DAY_OFFSET, so SQL can still
+use date() and its modifiers on them.
+
+Time buckets ('week', 'month', 'year') are named by the day ordinal of the day
+they start on: weeks start on Mondays, months and years on their first day.
+'''
+
+GRANULARITIES = ('day', 'week', 'month', 'year')
+
+JULIAN_DAY_OFFSET = 1721424.5 # julianday('0001-01-01') - 1
+
+def date_to_day(date):
+    # ISO date string (or a date, or a day number already) -> day number; None stays None
+    if date is None or isinstance(date, int):
+        return date
+    if isinstance(date, str):
+        date = datetime.date.fromisoformat(date[:10])
+    return date.toordinal()
+
+def day_to_date(day):
+    # day number -> ISO date string
+    if day is None:
+        return None
+    return datetime.date.fromordinal(day).isoformat()
+
+def check_granularity(granularity):
+    if granularity not in GRANULARITIES:
+        raise ValueError("Unknown granularity: {} (use one of {})".format(granularity, ", ".join(GRANULARITIES)))
+
+def period_start(day, granularity):
+    # the first day of the bucket that day falls in
+    if granularity == 'day':
+        return day
+    if granularity == 'week':
+        return day - (day + 6) % 7
+    date = datetime.date.fromordinal(day)
+    if granularity == 'month':
+        return date.replace(day=1).toordinal()
+    if granularity == 'year':
+        return date.replace(month=1, day=1).toordinal()
+    check_granularity(granularity)
+
+def period_end(day, granularity):
+    # the last day of the bucket that day falls in
+    start = period_start(day, granularity)
+    if granularity == 'day':
+        return start
+    if granularity == 'week':
+        return start + 6
+    date = datetime.date.fromordinal(start)
+    if granularity == 'month':
+        if date.month == 12:
+            return date.replace(year=date.year + 1, month=1).toordinal() - 1
+        return date.replace(month=date.month + 1).toordinal() - 1
+    return date.replace(year=date.year + 1).toordinal() - 1
+
+def period_sql(granularity, column):
+    # SQL for the first day of the bucket that the day number in column falls in
+    if granularity == 'day':
+        return column
+    if granularity == 'week':
+        return "({0} - ({0} + 6) % 7)".format(column)
+    check_granularity(granularity)
+    return "CAST(julianday(date({} + {}, 'start of {}')) - {} AS INTEGER)".format(column, JULIAN_DAY_OFFSET,
+        granularity, JULIAN_DAY_OFFSET)
+
+def day_sql(column):
+    # SQL converting an ISO date string in column to a day number (for migrating old databases)
+    return "CAST(julianday({}) - {} AS INTEGER)".format(column, JULIAN_DAY_OFFSET)
+
+def day_condition(day_min=None, day_max=None, column="Cases.DecisionDate"):
+    # a WHERE condition (and its parameters) for day_min <= column <= day_max, either end optional
+    conditions = []
+    params = ()
+    if day_min is not None:
+        conditions.append("{} >= ?".format(column))
+        params += (day_min,)
+    if day_max is not None:
+        conditions.append("{} <= ?".format(column))
+        params += (day_max,)
+    if not conditions:
+        return ("1", ())
+    return (" AND ".join(conditions), params)
+
+def split_day_range(day_min, day_max, granularity):
+    # Splits [day_min, day_max] (either end None for unbounded) into the part made of whole buckets,
+    # which can be read from per-bucket totals, and the leftover days at either end, which have to be
+    # read day by day: returns ((first bucket, last bucket) or None, [(first day, last day), ...])
+    if granularity == 'day':
+        return (None, [(day_min, day_max)])
+    first = day_min
+    if day_min is not None and period_start(day_min, granularity) != day_min:
+        first = period_end(day_min, granularity) + 1
+    last = day_max
+    if day_max is not None and period_end(day_max, granularity) != day_max:
+        last = period_start(day_max, granularity) - 1
+    if first is not None and last is not None and first > last:
+        return (None, [(day_min, day_max)])
+
+    edges = []
+    if first != day_min:
+        edges.append((day_min, first - 1))
+    if last != day_max:
+        edges.append((last + 1, day_max))
+    return ((first, last), edges)
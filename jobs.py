@@ -0,0 +1,226 @@
+import contextlib
+import queue
+import sqlite3 as sqlite
+import threading
+import time
+import database
+
+'''
+Running the prompt's commands in the background.
+
+A long time_plot or map_matching used to block the prompt until it finished,
+with nothing to show how far it had got, and Ctrl-C was the only way to stop it
+(taking the whole session with it). Now play() hands those commands to a
+JobRunner, which runs them one at a time, in order, on a worker thread, while
+the prompt takes more commands: they're queued behind the one that's running.
+
+Cancelling a job is cooperative. Each job has a cancel event, which the
+worker thread makes its own while the job runs:
+
+  - database.py's read connections have an SQLite progress handler that checks
+    it every PROGRESS_STEPS VM instructions, so a cancelled job's query stops
+    with an 'interrupted' error, even in the middle of one long statement.
+  - the scan engine's loops call advance() as they go, which raises Cancelled,
+    and a scan split across worker processes is stopped by terminating them.
+
+advance() and set_progress() also record how many rows the current job has
+got through out of how many, from which jobs_report() estimates its time left.
+Outside a job (in the tests, or in a scan's worker processes) they do nothing.
+'''
+
+local = threading.local() # .job: the Job this thread is running
+
+class Cancelled(Exception):
+    pass
+
+class Job:
+
+    def __init__(self, job_id, text, func):
+        self.id = job_id
+        self.text = text # the command, as typed
+        self.func = func
+        self.state = 'queued' # then 'running', and 'done', 'failed' or 'cancelled'
+        self.cancel_event = threading.Event()
+        self.done_rows = 0
+        self.total_rows = None # unknown until a scan sets it
+        self.started = None
+        self.finished = None
+        self.error = None
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.perf_counter()) - self.started
+
+    def eta(self):
+        # seconds left, estimated from the rows done so far (None if there's nothing to go on)
+        if not self.total_rows or not self.done_rows or self.state != 'running':
+            return None
+        return self.elapsed() * (self.total_rows - self.done_rows) / self.done_rows
+
+    def describe(self):
+        line = "[{}] {:<9} {}".format(self.id, self.state, self.text)
+        if self.state == 'running':
+            line += " ({:.1f}s".format(self.elapsed())
+            if self.total_rows:
+                line += ", {:,} of {:,} rows".format(min(self.done_rows, self.total_rows), self.total_rows)
+            eta = self.eta()
+            if eta is not None:
+                line += ", about {:.0f}s left".format(eta)
+            line += ")"
+        elif self.finished is not None:
+            line += " ({:.1f}s)".format(self.elapsed())
+        if self.error is not None:
+            line += ": {}".format(self.error)
+        return line
+
+@contextlib.contextmanager
+def running(job):
+    # makes job the one this thread is running, so its cancel event reaches the queries and scans
+    local.job = job
+    database.set_cancel_event(job.cancel_event)
+    try:
+        yield job
+    finally:
+        local.job = None
+        database.set_cancel_event(None)
+
+def current_job():
+    return getattr(local, 'job', None)
+
+def check_cancelled():
+    # raises Cancelled if the job this thread is running has been cancelled
+    job = current_job()
+    if job is not None and job.cancel_event.is_set():
+        raise Cancelled()
+
+def set_progress(done, total=None):
+    job = current_job()
+    if job is not None:
+        job.done_rows = done
+        if total is not None:
+            job.total_rows = total
+        check_cancelled()
+
+def advance(rows=1):
+    # adds rows to the current job's progress, and raises Cancelled if it's been cancelled
+    job = current_job()
+    if job is not None:
+        job.done_rows += rows
+        if job.cancel_event.is_set():
+            raise Cancelled()
+
+def was_interrupted(job, error):
+    # whether error is SQLite stopping a statement because job was cancelled
+    return isinstance(error, sqlite.OperationalError) and job.cancel_event.is_set() and "interrupted" in str(error)
+
+class JobRunner:
+
+    def __init__(self, on_finish=None, history=20):
+        self.on_finish = on_finish # called with each Job when it's done, failed or been cancelled
+        self.history = history # finished jobs kept for jobs_report()
+        self.jobs = []
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.idle = threading.Event()
+        self.idle.set()
+        self.thread = None
+
+    def submit(self, text, func):
+        # queues func (which takes no arguments) to run after the jobs already queued; returns its Job
+        with self.lock:
+            job = Job(self.next_id, text, func)
+            self.next_id += 1
+            self.jobs.append(job)
+            self.idle.clear()
+            self.queue.put(job) # (under the lock, so the worker can't see an empty queue and set idle first)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.work, name="capapi-jobs", daemon=True)
+                self.thread.start()
+        return job
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            if not job.cancel_event.is_set():
+                self.run(job)
+            else:
+                job.state = 'cancelled'
+                self.finish(job)
+            with self.lock:
+                if self.queue.empty():
+                    self.idle.set()
+
+    def run(self, job):
+        job.state = 'running'
+        job.started = time.perf_counter()
+        try:
+            with running(job):
+                job.func()
+            job.state = 'done'
+        except Cancelled:
+            job.state = 'cancelled'
+        except Exception as e:
+            if was_interrupted(job, e):
+                job.state = 'cancelled'
+            else:
+                job.state = 'failed'
+                job.error = "{}: {}".format(type(e).__name__, e)
+        finally:
+            job.finished = time.perf_counter()
+        self.finish(job)
+
+    def finish(self, job):
+        with self.lock:
+            finished = [j for j in self.jobs if j.state in ('done', 'failed', 'cancelled')]
+            for old in finished[:-self.history]:
+                self.jobs.remove(old)
+        if self.on_finish is not None:
+            self.on_finish(job)
+
+    def running(self):
+        with self.lock:
+            return next((job for job in self.jobs if job.state == 'running'), None)
+
+    def pending(self):
+        # the number of jobs queued or running
+        with self.lock:
+            return len([job for job in self.jobs if job.state in ('queued', 'running')])
+
+    def cancel(self, job_id=None):
+        # cancels job job_id, or (by default) the running one; returns the Job, or None if there's no such job
+        with self.lock:
+            for job in self.jobs:
+                if job.state not in ('queued', 'running'):
+                    continue
+                if job.id == job_id or (job_id is None and job.state == 'running'):
+                    job.cancel()
+                    return job
+        return None
+
+    def cancel_all(self):
+        with self.lock:
+            for job in self.jobs:
+                job.cancel()
+
+    def wait(self, timeout=None):
+        # blocks until every queued job has finished; returns False if timeout ran out first
+        return self.idle.wait(timeout)
+
+    def jobs_report(self):
+        with self.lock:
+            return [job.describe() for job in self.jobs]
+
+    def stop(self):
+        # cancels everything and waits for the worker thread to finish
+        self.cancel_all()
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,311 @@
+import argparse
+import base64
+import http.server
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import benchmark
+from cachestore import CacheStore
+from crawler import Crawler, make_windows
+
+'''
+A local stand-in for the CAP API 'cases' endpoint, and a load test for the crawler.
+
+MockCapServer serves pages shaped like api.case.law's: {"count", "next",
+"previous", "results"}, filtered by decision_date_min/decision_date_max and
+paginated with an opaque 'cursor' in the 'next' url. The cases come from a
+fixture (a JSON file holding a list of cases, a saved page, or one case per line)
+or from benchmark.py's synthetic corpus.
+
+To test the failure handling, the server can add latency, answer with 429s
+(with a Retry-After header) or 503s, and send malformed pages: JSON cut off
+partway through, or a JSON error object with no results.
+
+Point capapi at a running server with the CAPAPI_URL environment variable:
+
+    python mockcap.py serve --port 8000 --cases 5000 --error-rate 0.05
+    CAPAPI_URL=http://127.0.0.1:8000/v1/cases/ python capapi.py sync
+
+The load test crawls the whole mock corpus with different numbers of worker
+threads and reports throughput, retries, and how long the cache writes took:
+
+    python mockcap.py loadtest --workers 1 4 8 16 --latency 0.05 --error-rate 0.05
+'''
+
+PAGE_SIZE = 100
+PATH = "/v1/cases/"
+
+def synthetic_cases(n, seed=benchmark.SEED, median_words=benchmark.MEDIAN_WORDS):
+    # n CAP-shaped case dicts, from benchmark.py's synthetic corpus
+    rng = random.Random(seed)
+    states_csv = os.path.join(os.path.dirname(os.path.abspath(__file__)), "state_table.csv")
+    courts = benchmark.make_courts(rng, states_csv)
+    cases = []
+    for name, name_abbr, date, court, text, cap_id in benchmark.iter_cases(n, courts, rng, median_words):
+        cases.append({
+            'id': cap_id,
+            'name': name,
+            'name_abbreviation': name_abbr,
+            'decision_date': date,
+            'court': {'name_abbreviation': court},
+            'casebody': {'status': 'ok', 'data': {'opinions': [{'type': 'majority', 'text': text}]}},
+        })
+    return cases
+
+def load_fixture(fname):
+    # a JSON list of cases, a saved page ({"results": [...]}), or JSON Lines with one case per line
+    with open(fname, encoding='utf-8') as f:
+        text = f.read()
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+    if isinstance(data, dict):
+        return data['results']
+    return data
+
+def encode_cursor(offset):
+    return base64.urlsafe_b64encode(json.dumps({'offset': offset}).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))['offset']
+
+class MockCapServer:
+
+    def __init__(self, cases, page_size=PAGE_SIZE, latency=0.0, error_rate=0.0, server_error_rate=0.0,
+            malformed_rate=0.0, retry_after=0, seed=1, port=0):
+        self.cases = sorted(cases, key=lambda case: (case['decision_date'], case['id']))
+        self.page_size = page_size
+        self.latency = latency # mean seconds added to each response (uniform between 0 and twice this)
+        self.error_rate = error_rate # share of requests answered with 429 Too Many Requests
+        self.server_error_rate = server_error_rate # share answered with 503 Service Unavailable
+        self.malformed_rate = malformed_rate # share answered with a page that doesn't parse
+        self.retry_after = retry_after # seconds, sent with 429s and 503s
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'pages': 0, 'too_many_requests': 0, 'server_errors': 0, 'malformed': 0}
+
+        mock = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                mock.handle(self)
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}{}".format(self.httpd.server_port, PATH)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def reset_stats(self):
+        with self.lock:
+            for key in self.stats:
+                self.stats[key] = 0
+
+    def handle(self, request):
+        self.count('requests')
+        with self.lock:
+            roll = self.rng.random()
+            delay = self.rng.uniform(0, 2 * self.latency)
+        if delay:
+            time.sleep(delay)
+
+        parsed = urllib.parse.urlparse(request.path)
+        if parsed.path != PATH:
+            return self.send(request, 404, {'detail': 'Not found.'})
+        if roll < self.error_rate:
+            self.count('too_many_requests')
+            return self.send(request, 429, {'detail': 'Request was throttled.'}, {'Retry-After': str(self.retry_after)})
+        roll -= self.error_rate
+        if roll < self.server_error_rate:
+            self.count('server_errors')
+            return self.send(request, 503, {'detail': 'Service unavailable.'}, {'Retry-After': str(self.retry_after)})
+        roll -= self.server_error_rate
+
+        params = urllib.parse.parse_qs(parsed.query)
+        date_min = params.get('decision_date_min', [''])[0]
+        date_max = params.get('decision_date_max', [''])[0]
+        offset = decode_cursor(params['cursor'][0]) if 'cursor' in params else 0
+
+        # the cases in the date range (a bisect would be faster, but the corpus is small)
+        matching = [case for case in self.cases
+            if case['decision_date'] >= date_min and (not date_max or case['decision_date'] <= date_max)]
+        page = matching[offset:offset + self.page_size]
+
+        def page_url(new_offset):
+            query = [(key, value) for key, values in params.items() if key != 'cursor' for value in values]
+            query.append(('cursor', encode_cursor(new_offset)))
+            return self.url + "?" + urllib.parse.urlencode(query)
+
+        body = {
+            'count': len(matching),
+            'next': page_url(offset + self.page_size) if offset + self.page_size < len(matching) else None,
+            'previous': page_url(max(0, offset - self.page_size)) if offset > 0 else None,
+            'results': page,
+        }
+
+        if roll < self.malformed_rate:
+            self.count('malformed')
+            if roll < self.malformed_rate / 2:
+                data = json.dumps(body).encode('utf-8')
+                return self.send_bytes(request, 200, data[:len(data) // 2]) # cut off partway through
+            return self.send(request, 200, {'detail': 'Internal error.'}) # valid JSON, but not a page
+
+        self.count('pages')
+        self.send(request, 200, body)
+
+    def send(self, request, status, body, headers=None):
+        self.send_bytes(request, status, json.dumps(body).encode('utf-8'), headers)
+
+    def send_bytes(self, request, status, data, headers=None):
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(data)))
+        for key in headers or {}:
+            request.send_header(key, headers[key])
+        request.end_headers()
+        request.wfile.write(data)
+
+''' Load test '''
+
+class TimedCacheStore(CacheStore):
+    # a CacheStore that keeps track of how long its writes take (including waiting for the lock)
+
+    def __init__(self, fname):
+        CacheStore.__init__(self, fname)
+        self.write_times = []
+        self.write_bytes = 0
+
+    def __setitem__(self, key, value):
+        start = time.perf_counter()
+        CacheStore.__setitem__(self, key, value)
+        self.write_times.append(time.perf_counter() - start)
+        self.write_bytes += len(json.dumps(value))
+
+def start_urls(server, window_days):
+    # one url per window_days of the corpus's date range, like capapi.get_cap_urls()
+    base_url = server.url + "?full_case=true&jurisdiction=us"
+    date_min = server.cases[0]['decision_date']
+    date_max = server.cases[-1]['decision_date']
+    return [base_url + "&decision_date_min={}&decision_date_max={}".format(window[0], window[1])
+        for window in make_windows(date_min, date_max, window_days)]
+
+def load_test(server, workers_list=(1, 4, 8), window_days=30, rate=1000.0, backoff=0.01):
+    # Crawls the whole mock corpus once for each number of workers (each time with an empty
+    # cache) and returns a list of result dicts, one per run.
+    urls = start_urls(server, window_days)
+    all_results = []
+    for workers in workers_list:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = TimedCacheStore(os.path.join(tmpdir, "cache.db"))
+            crawler = Crawler(cache, rate=rate, workers=workers, max_retries=8, backoff=backoff)
+            server.reset_stats()
+
+            ids = set()
+            pages = 0
+            start = time.perf_counter()
+            for start_url, resp_dict in crawler.iter_pages(urls):
+                pages += 1
+                ids.update(case['id'] for case in resp_dict['results'])
+            elapsed = time.perf_counter() - start
+            cache.close()
+
+        write_times = sorted(cache.write_times)
+        all_results.append({
+            'workers': workers,
+            'pages': pages,
+            'cases': len(ids),
+            'complete': len(ids) == len(server.cases),
+            'seconds': elapsed,
+            'pages_per_s': pages / elapsed,
+            'cases_per_s': len(ids) / elapsed,
+            'requests': server.stats['requests'],
+            'retries': crawler.stats['retries'],
+            'throttled': server.stats['too_many_requests'],
+            'server_errors': server.stats['server_errors'],
+            'malformed': crawler.stats['malformed'],
+            'cache_write_ms_mean': 1000 * sum(write_times) / max(1, len(write_times)),
+            'cache_write_ms_p95': 1000 * write_times[int(0.95 * (len(write_times) - 1))] if write_times else 0,
+            'cache_write_share': sum(write_times) / elapsed, # of the crawl's wall-clock time
+            'cache_mb': cache.write_bytes / 1e6,
+        })
+    return all_results
+
+def report(all_results):
+    columns = ['workers', 'pages', 'cases', 'complete', 'seconds', 'pages_per_s', 'cases_per_s', 'requests', 'retries',
+        'throttled', 'server_errors', 'malformed', 'cache_write_ms_mean', 'cache_write_ms_p95', 'cache_write_share']
+    for column in columns:
+        values = []
+        for results in all_results:
+            value = results[column]
+            values.append("{:>12.3f}".format(value) if isinstance(value, float) else "{:>12}".format(str(value)))
+        print("{:<22}".format(column) + "".join(values))
+
+def main():
+    parser = argparse.ArgumentParser(description="A local stand-in for the CAP API, and a crawler load test")
+    parser.add_argument("mode", choices=["serve", "loadtest"])
+    parser.add_argument("--port", type=int, default=8000, help="(serve) port to listen on")
+    parser.add_argument("--fixture", help="JSON file of cases to serve (default: synthetic cases)")
+    parser.add_argument("--cases", type=int, default=2000, help="number of synthetic cases")
+    parser.add_argument("--median-words", type=int, default=300, help="median words per synthetic case")
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE)
+    parser.add_argument("--latency", type=float, default=0.0, help="mean seconds added to each response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--server-error-rate", type=float, default=0.0, help="share answered with 503")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="share answered with a malformed page")
+    parser.add_argument("--retry-after", type=int, default=0, help="Retry-After seconds sent with 429s and 503s")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8], help="(loadtest) crawler threads to try")
+    parser.add_argument("--window-days", type=int, default=30, help="(loadtest) days per crawl window")
+    parser.add_argument("--rate", type=float, default=1000.0, help="(loadtest) crawler requests per second")
+    parser.add_argument("--save", help="(loadtest) write the results to this JSON file")
+    args = parser.parse_args()
+
+    cases = load_fixture(args.fixture) if args.fixture else synthetic_cases(args.cases, median_words=args.median_words)
+    server = MockCapServer(cases, args.page_size, args.latency, args.error_rate, args.server_error_rate,
+        args.malformed_rate, args.retry_after, port=args.port if args.mode == "serve" else 0)
+
+    if args.mode == "serve":
+        print("Serving {} cases at {}".format(len(cases), server.url))
+        try:
+            server.httpd.serve_forever()
+        except KeyboardInterrupt:
+            server.httpd.server_close()
+        return 0
+
+    with server:
+        all_results = load_test(server, args.workers, args.window_days, args.rate)
+    report(all_results)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(all_results, f, indent=2)
+    return 0 if all(results['complete'] for results in all_results) else 1
+
+if __name__=="__main__":
+    sys.exit(main())
@@ -0,0 +1,193 @@
+import contextlib
+import functools
+import re
+import sqlite3 as sqlite
+import threading
+import time
+
+'''
+Lightweight instrumentation, cheap enough to leave on all the time.
+
+Timers keeps a running count, total, and maximum for each named phase (a REPL
+command, a query helper, building or rendering a figure). Phases nest, so each
+one also records its "self" time: its total minus the time spent in the phases
+inside it. A command that spends most of its self time in a 'query:' phase is
+waiting on the database; one that spends it in 'render:' is waiting on plotly.
+
+SqlTrace is off by default. When it's on, every statement run through a
+TracingConnection (see database.py) is timed, including fetching its rows, and
+the first time a SELECT is seen its EXPLAIN QUERY PLAN is saved too. When it's
+off, a TracingConnection hands out ordinary cursors, so tracing costs nothing.
+'''
+
+class Timers:
+
+    def __init__(self):
+        self.stats = {} # name -> [calls, total seconds, self seconds, max seconds]
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        children = [0.0] # time spent in phases nested inside this one
+        stack.append(children)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            stack.pop()
+            if stack:
+                stack[-1][0] += elapsed
+            self.record(name, elapsed, elapsed - children[0])
+
+    def record(self, name, elapsed, self_time):
+        with self.lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = [0, 0.0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] += self_time
+            stats[3] = max(stats[3], elapsed)
+
+    def timed(self, phase):
+        # decorator: times each call as '<phase>:<function name>'
+        def decorator(func):
+            name = "{}:{}".format(phase, func.__name__)
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def reset(self):
+        with self.lock:
+            self.stats.clear()
+
+    def report(self):
+        lines = ["{:<44} {:>7} {:>10} {:>10} {:>10} {:>10}".format("phase", "calls", "total s", "self s", "mean s", "max s")]
+        with self.lock:
+            items = sorted(self.stats.items(), key=lambda item: item[1][1], reverse=True)
+        for name, (calls, total, self_time, longest) in items:
+            lines.append("{:<44} {:>7} {:>10.4f} {:>10.4f} {:>10.4f} {:>10.4f}".format(name[:44], calls, total,
+                self_time, total / calls, longest))
+        return lines
+
+''' SQL statement tracing '''
+
+def normalize_sql(sql):
+    return re.sub(r"\s+", " ", sql).strip()
+
+class SqlTrace:
+
+    def __init__(self):
+        self.enabled = False
+        self.stats = {} # statement -> [calls, seconds, rows, query plan]
+        self.lock = threading.Lock()
+
+    def record(self, conn, sql, parameters, seconds, rows, calls):
+        sql = normalize_sql(sql)
+        with self.lock:
+            stats = self.stats.get(sql)
+            new = stats is None
+            if new:
+                stats = self.stats[sql] = [0, 0.0, 0, None]
+            stats[0] += calls
+            stats[1] += seconds
+            stats[2] += rows
+        if new and conn is not None and sql.upper().startswith(("SELECT", "WITH")):
+            stats[3] = explain(conn, sql, parameters)
+
+    def reset(self):
+        with self.lock:
+            self.stats.clear()
+
+    def report(self, limit=10):
+        lines = []
+        with self.lock:
+            items = sorted(self.stats.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+        for sql, (calls, seconds, rows, plan) in items:
+            lines.append("{:>7} calls {:>10.4f} s {:>9} rows  {}".format(calls, seconds, rows, sql[:100]))
+            for step in plan or []:
+                lines.append("{:>40}{}".format("", step))
+        return lines
+
+def explain(conn, sql, parameters):
+    # the statement's query plan, as indented lines (or the error, if it can't be explained)
+    try:
+        rows = sqlite.Cursor(conn).execute("EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+    except sqlite.Error as e:
+        return ["(no plan: {})".format(e)]
+    depth = {0: 0}
+    plan = []
+    for node, parent, unused, detail in rows:
+        depth[node] = depth.get(parent, 0) + 1
+        plan.append("  " * (depth[node] - 1) + detail)
+    return plan
+
+SQL_TRACE = SqlTrace()
+
+class TracingCursor(sqlite.Cursor):
+
+    def execute(self, sql, parameters=()):
+        self.trace_sql = sql
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            SQL_TRACE.record(self.connection, sql, parameters, time.perf_counter() - start, 0, 1)
+
+    def executemany(self, sql, seq_of_parameters):
+        self.trace_sql = sql
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            SQL_TRACE.record(None, sql, (), time.perf_counter() - start, 0, 1)
+
+    def fetched(self, start, rows):
+        if getattr(self, 'trace_sql', None) is not None:
+            SQL_TRACE.record(None, self.trace_sql, (), time.perf_counter() - start, rows, 0)
+
+    def __next__(self):
+        start = time.perf_counter()
+        row = super().__next__()
+        self.fetched(start, 1)
+        return row
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self.fetched(start, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self.fetched(start, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self.fetched(start, len(rows))
+        return rows
+
+class TracingConnection(sqlite.Connection):
+    # hands out TracingCursors while SQL_TRACE is on, ordinary cursors otherwise
+
+    def cursor(self, factory=None):
+        if factory is None:
+            factory = TracingCursor if SQL_TRACE.enabled else sqlite.Cursor
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
@@ -0,0 +1,106 @@
+import collections
+import functools
+import json
+import threading
+from cachestore import CacheStore
+
+'''
+An LRU cache for query results, so that repeating a command in the interactive
+prompt doesn't repeat the work.
+
+Keys are built from the function name and its (normalized) arguments, plus a
+"stamp" that identifies the data being queried: the database file and its
+generation, which create_db() and sync_db() change whenever the data does.
+Entries from an older generation are never returned again; they just age out.
+
+Optionally, entries are also written to a second, on-disk tier (a CacheStore),
+so results survive from one session to the next. The file is only opened the
+first time it's needed.
+'''
+
+def make_key(*parts):
+    # keys are JSON strings, so they're hashable and work as disk-tier keys too
+    return json.dumps(parts)
+
+def copy_result(result):
+    # copies the mutable parts (lists and dicts) of a query result; tuples and strings are shared
+    if isinstance(result, list):
+        return [copy_result(item) for item in result]
+    if isinstance(result, dict):
+        return {key: copy_result(result[key]) for key in result}
+    return result
+
+class QueryCache:
+
+    def __init__(self, max_entries=128, disk_fname=None):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.disk_fname = disk_fname
+        self.disk = None
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0}
+
+    def disk_store(self):
+        # the on-disk tier (None if there isn't one), opened on first use
+        if self.disk is None and self.disk_fname:
+            with self.lock:
+                if self.disk is None:
+                    self.disk = CacheStore(self.disk_fname, serializer='pickle')
+        return self.disk
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return self.entries[key]
+
+        disk = self.disk_store()
+        if disk is not None:
+            value = disk.get(key, default)
+            if value is not default:
+                self.stats['disk_hits'] += 1
+                self.put(key, value, disk=False)
+                return value
+
+        with self.lock:
+            self.stats['misses'] += 1
+        return default
+
+    def put(self, key, value, disk=True):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        if disk and self.disk_store() is not None:
+            self.disk[key] = value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def hit_rate(self):
+        lookups = self.stats['hits'] + self.stats['disk_hits'] + self.stats['misses']
+        if lookups == 0:
+            return 0
+        return (self.stats['hits'] + self.stats['disk_hits']) / lookups
+
+    def cached(self, stamp, normalize=None):
+        # Decorator factory. stamp() returns something JSON-serializable that changes whenever the
+        # underlying data does; normalize(args) maps equivalent (positional) arguments to the same
+        # key. Keyword arguments are part of the key as they are.
+        # Callers get a copy of the cached result, so changing it can't corrupt the cache.
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                key_args = normalize(args) if normalize else args
+                key = make_key(stamp(), func.__name__, key_args, sorted(kwargs.items()))
+                missing = object()
+                result = self.get(key, missing)
+                if result is missing:
+                    result = func(*args, **kwargs)
+                    self.put(key, result)
+                return copy_result(result)
+            return wrapper
+        return decorator
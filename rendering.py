@@ -0,0 +1,78 @@
+import glob
+import hashlib
+import os
+import pathlib
+import webbrowser
+
+'''
+Local rendering of plotly figures, with a cache of what has been rendered.
+
+plotly.plotly.plot() uploads every figure to the plot.ly cloud, which needs an
+account and a network round trip for each one. Figures are written to local
+files instead: self-contained HTML pages (or static images, which need plotly's
+'orca' tool). The HTML pages load plotly.js from a single plotly.min.js next to
+them rather than each embedding their own 3MB copy.
+
+Each figure file is named after a hash of the inputs it was drawn from, so
+asking for the same figure again just opens the file that's already there,
+without querying the database or building the figure.
+
+plotly itself is only imported when a figure actually has to be written.
+'''
+
+IMAGE_FORMATS = ('png', 'jpeg', 'webp', 'svg', 'pdf')
+
+class FigureCache:
+
+    def __init__(self, directory='figures', max_figures=200):
+        self.directory = directory
+        self.max_figures = max_figures
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def path_for(self, name, key, fmt='html'):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.directory, "{}-{}.{}".format(name, digest, fmt))
+
+    def show(self, name, key, build, fmt='html', auto_open=True):
+        # Opens the figure for key (a string identifying everything the figure depends on),
+        # calling build() to make it first if it isn't in the cache. Returns the file's path.
+        path = self.path_for(name, key, fmt)
+        if os.path.exists(path):
+            self.stats['hits'] += 1
+            os.utime(path) # most recently used, as far as prune() is concerned
+        else:
+            self.stats['misses'] += 1
+            os.makedirs(self.directory, exist_ok=True)
+            write_figure(build(), path, fmt)
+            self.prune()
+
+        if auto_open:
+            webbrowser.open(pathlib.Path(os.path.abspath(path)).as_uri())
+        return path
+
+    def figures(self):
+        paths = []
+        for fmt in ('html',) + IMAGE_FORMATS:
+            paths.extend(glob.glob(os.path.join(self.directory, "*." + fmt)))
+        return paths
+
+    def prune(self):
+        # deletes the least recently used figures, beyond max_figures
+        paths = sorted(self.figures(), key=os.path.getmtime)
+        for path in paths[:max(0, len(paths) - self.max_figures)]:
+            os.remove(path)
+
+def write_figure(fig, path, fmt='html'):
+    # written under a temporary name and then renamed, so an interrupted write never leaves
+    # a half-written file in the cache
+    partial_path = path + ".partial." + fmt
+    if fmt == 'html':
+        import plotly.offline
+        # 'directory' puts one shared copy of plotly.min.js in the same directory
+        plotly.offline.plot(fig, filename=partial_path, include_plotlyjs='directory', auto_open=False)
+    elif fmt in IMAGE_FORMATS:
+        import plotly.io
+        plotly.io.write_image(fig, partial_path, format=fmt)
+    else:
+        raise ValueError("Unknown figure format: {}".format(fmt))
+    os.replace(partial_path, path)
@@ -0,0 +1,216 @@
+import collections
+import multiprocessing
+from compression import decompress_body
+from database import get_connection
+from dates import day_condition
+from jobs import advance, check_cancelled, set_progress
+from tokenizer import tokenize, normalize_phrase, contains_phrase, match_condition
+
+'''
+Parallel full scans of the Cases table.
+
+Queries that no index can answer (a LIKE over the full text, or tokenizing every
+case) have to read every row, and a single SQLite cursor or Python loop only keeps
+one core busy. run_scan() splits Cases into contiguous Id ranges and scans each one
+in a pool of worker processes. Every worker opens its own read-only connection
+(see database.get_connection), so nothing is shared but the database file.
+
+A scan function takes (dbname, *args, first_id, last_id) and returns a partial
+aggregate for the rows in that range (all rows, if first_id is None). Every scan
+also takes a range of decision days (day_min, day_max, see dates.py), so a
+date-limited query only aggregates the cases decided in that range, and the
+scans that look at words take the name of the database's tokenizer, so they
+split the text the same way its indexes did (see tokenizer.py). The partials
+come back in Id order, and the merge_* function for that kind of aggregate
+combines them into the same result a single scan would have produced.
+
+Scans report their progress, in rows (Ids, really), to the command running them
+and stop when it's cancelled (see jobs.py): a scan in this process checks after
+every row, and run_scan() checks between chunks from the worker processes, and
+terminates them if the command has been cancelled.
+'''
+
+CHUNKS_PER_WORKER = 4 # more chunks than workers, so one slow chunk doesn't leave the others idle
+MIN_CHUNK_ROWS = 2000 # smaller than this, a chunk isn't worth handing to another process
+POLL_SECONDS = 0.2 # how often run_scan() checks whether its command was cancelled while it waits for a chunk
+MAX_WORKERS = None # caps every scan's worker processes, if set (capapi.py's serve() sets it to 1)
+
+# ASCII-only lowercasing, to match the case-insensitivity of SQLite's LIKE ('split' databases)
+ASCII_LOWER = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ", "abcdefghijklmnopqrstuvwxyz")
+
+def split_id_range(first_id, last_id, n):
+    # splits [first_id, last_id] into (at most) n contiguous, inclusive (first, last) ranges
+    if first_id is None:
+        return []
+    size = (last_id - first_id) // n + 1
+    return [(start, min(start + size - 1, last_id)) for start in range(first_id, last_id + 1, size)]
+
+def run_scan(dbname, scan, args, workers=1):
+    # Runs scan over all of Cases and returns the list of partial aggregates, in Id order.
+    # Small tables (or workers=1) are scanned in this process, in one piece.
+    conn = get_connection(dbname)
+    first_id, last_id = conn.execute("SELECT MIN(Id), MAX(Id) FROM Cases").fetchone()
+
+    set_progress(0, 0 if first_id is None else last_id - first_id + 1)
+
+    if MAX_WORKERS is not None:
+        workers = min(workers, MAX_WORKERS)
+    chunks = 1
+    if first_id is not None and workers > 1:
+        chunks = min(workers * CHUNKS_PER_WORKER, (last_id - first_id + 1) // MIN_CHUNK_ROWS)
+    if chunks <= 1:
+        return [scan(dbname, *args)]
+
+    ranges = split_id_range(first_id, last_id, chunks)
+    partials = []
+    # (leaving the with block terminates the workers, so raising Cancelled stops them too)
+    with multiprocessing.Pool(min(workers, len(ranges))) as pool:
+        results = pool.imap(call_scan, [(scan, (dbname,) + tuple(args) + id_range) for id_range in ranges], chunksize=1)
+        for first, last in ranges:
+            while True:
+                try:
+                    partials.append(results.next(POLL_SECONDS))
+                    break
+                except multiprocessing.TimeoutError:
+                    check_cancelled()
+            advance(last - first + 1)
+    return partials
+
+def call_scan(scan_and_args):
+    scan, args = scan_and_args
+    return scan(*args)
+
+def id_condition(first_id, last_id, column="Cases.Id"):
+    if first_id is None:
+        return ("1", ())
+    return ("{} BETWEEN ? AND ?".format(column), (first_id, last_id))
+
+''' Per-date token counts (time_plot) '''
+
+def count_words_in_rows(dbname, words, tokenizer='words', day_min=None, day_max=None, first_id=None, last_id=None):
+    # Streams (date, full text) rows from the Cases table (all of them, or the ones with Ids in
+    # [first_id, last_id]) and returns the total # of tokens per date and the # of times each of
+    # the words appears per date: ({date: total}, {(word, date): count})
+    conn = get_connection(dbname)
+    condition, params = id_condition(first_id, last_id, "Id")
+    days, day_params = day_condition(day_min, day_max, "DecisionDate")
+    statement = '''
+    SELECT DecisionDate, CaseBody
+    FROM Cases
+    WHERE {} AND {}
+    '''.format(condition, days)
+    params += day_params
+
+    date_totals = {}
+    word_counts = {}
+    for date, text in conn.execute(statement, params):
+        advance()
+        tokens = tokenize(decompress_body(text, conn), tokenizer)
+        date_totals[date] = date_totals.get(date, 0) + len(tokens)
+        for token, count in collections.Counter(filter(words.__contains__, tokens)).items():
+            key = (token, date)
+            word_counts[key] = word_counts.get(key, 0) + count
+
+    return (date_totals, word_counts)
+
+def merge_token_counts(partials):
+    date_totals = {}
+    word_counts = {}
+    for partial_totals, partial_counts in partials:
+        for date in partial_totals:
+            date_totals[date] = date_totals.get(date, 0) + partial_totals[date]
+        for key in partial_counts:
+            word_counts[key] = word_counts.get(key, 0) + partial_counts[key]
+    return (date_totals, word_counts)
+
+''' Per-state counts of matching cases (map_matching) '''
+
+def count_states_in_rows(dbname, list_of_words, tokenizer='words', day_min=None, day_max=None, first_id=None, last_id=None):
+    # Returns {word: {state abbr: # of district court cases containing word}}. One word is a
+    # single query; several words are all looked for in a single pass over the case text.
+    conn = get_connection(dbname)
+    condition, params = id_condition(first_id, last_id)
+    days, day_params = day_condition(day_min, day_max)
+    condition += " AND " + days
+    params += day_params
+
+    if len(list_of_words) == 1:
+        match = match_condition(list_of_words[0], tokenizer)
+        statement = '''
+        SELECT States.Abbr, COUNT(*)
+        FROM Cases
+        JOIN DistrictCourts
+        ON Cases.CourtId = DistrictCourts.Id
+        JOIN States
+        ON DistrictCourts.StateId = States.Id
+        WHERE {} AND {}
+        GROUP BY States.Abbr
+        '''.format(condition, match[0])
+        results = conn.execute(statement, params + (match[1],))
+        return {list_of_words[0]: dict(results.fetchall())}
+
+    lowered_words = [(word, word.translate(ASCII_LOWER)) for word in list_of_words]
+    phrases = [(word, normalize_phrase(word, tokenizer)) for word in list_of_words]
+    matching_dicts = {}
+    for word in list_of_words:
+        matching_dicts[word] = {}
+
+    statement = '''
+    SELECT States.Abbr, body_text(Cases.CaseBody)
+    FROM Cases
+    JOIN DistrictCourts
+    ON Cases.CourtId = DistrictCourts.Id
+    JOIN States
+    ON DistrictCourts.StateId = States.Id
+    WHERE {}
+    '''.format(condition)
+    for abbr, text in conn.execute(statement, params):
+        advance()
+        if tokenizer == 'split':
+            text = text.translate(ASCII_LOWER)
+            found = [word for word, lowered in lowered_words if lowered in text]
+        else:
+            tokens = tokenize(text, tokenizer)
+            token_set = set(tokens)
+            found = [word for word, phrase in phrases if phrase and phrase[0] in token_set and contains_phrase(tokens, phrase)]
+        for word in found:
+            matching_dict = matching_dicts[word]
+            matching_dict[abbr] = matching_dict.get(abbr, 0) + 1
+
+    return matching_dicts
+
+def merge_state_counts(partials):
+    matching_dicts = {}
+    for partial in partials:
+        for word in partial:
+            matching_dict = matching_dicts.setdefault(word, {})
+            for abbr in partial[word]:
+                matching_dict[abbr] = matching_dict.get(abbr, 0) + partial[word][abbr]
+    return matching_dicts
+
+''' Lists of matching cases (cases_matching) '''
+
+def find_cases_in_rows(dbname, word, tokenizer='words', day_min=None, day_max=None, first_id=None, last_id=None):
+    # the district court cases containing word, in Id order:
+    # list of tuples: (state abbr, state name, case name, case abbr, court name, court abbr)
+    conn = get_connection(dbname)
+    condition, params = id_condition(first_id, last_id)
+    days, day_params = day_condition(day_min, day_max)
+    condition += " AND " + days
+    params += day_params
+    match = match_condition(word, tokenizer)
+    statement = '''
+    SELECT States.Abbr, States.Name, Cases.Name, Cases.NameAbbr, DistrictCourts.CourtName, DistrictCourts.Citation
+    FROM Cases
+    JOIN DistrictCourts
+    ON Cases.CourtId = DistrictCourts.Id
+    JOIN States
+    ON DistrictCourts.StateId = States.Id
+    WHERE {} AND {}
+    ORDER BY Cases.Id
+    '''.format(condition, match[0])
+    return conn.execute(statement, params + (match[1],)).fetchall()
+
+def merge_matching_cases(partials):
+    # sorted by state, and by Id within each state (sorted() is stable)
+    return sorted([case for partial in partials for case in partial], key=lambda case: case[0])
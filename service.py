@@ -0,0 +1,177 @@
+import collections
+import concurrent.futures
+import http.server
+import json
+import threading
+import time
+import urllib.parse
+from jobs import Cancelled, Job, running, was_interrupted
+
+'''
+A long-lived local HTTP service for the query helpers.
+
+Every 'python capapi.py' run pays for starting Python, opening the database and
+filling the query cache from nothing. QueryService keeps one process running
+instead, and answers GET requests on localhost with JSON, so any number of
+clients (dashboards, scripts, notebooks) share its warm connections and caches.
+
+Each endpoint is a function of the request's query parameters ({name: [values]})
+that returns something JSON-serializable; capapi.py's serve() maps them onto
+the query helpers. The HTTP threads only parse requests and write responses: the
+queries run on a fixed pool of worker threads, each with its own long-lived
+read-only connection (see database.get_connection), so the number of open
+connections doesn't grow with the number of clients.
+
+Each request runs as a jobs.Job. If it hasn't finished within the timeout, the
+client gets a 504 and the job is cancelled, which stops its query or scan (see
+jobs.py) and frees the worker for the next request. /metrics reports request
+counts, errors, timeouts and latencies per endpoint, plus whatever the
+service's metrics function adds (capapi.py adds the cache hit rates and timers).
+'''
+
+LATENCY_SAMPLES = 1000 # recent latencies kept per endpoint, for the percentiles in /metrics
+
+class QueryService:
+
+    def __init__(self, endpoints, port=0, workers=8, timeout=30.0, metrics=None):
+        self.endpoints = endpoints # path -> function(params) -> JSON-serializable result
+        self.workers = workers
+        self.timeout = timeout # seconds a request may take, including waiting for a worker
+        self.metrics = metrics # function() -> dict of more metrics, or None
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="capapi-query")
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.in_flight = 0
+        self.next_id = 1
+        self.stats = {} # path -> {'requests', 'errors', 'timeouts', 'latencies' (recent seconds), 'total_seconds'}
+
+        service = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                service.handle(self)
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.httpd.server_port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def serve_forever(self):
+        try:
+            self.httpd.serve_forever()
+        finally:
+            self.close()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.close()
+
+    def close(self):
+        self.httpd.server_close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def handle(self, request):
+        parsed = urllib.parse.urlparse(request.path)
+        path = parsed.path.rstrip("/") or "/"
+        if path == "/metrics":
+            return self.send(request, 200, self.metrics_report())
+        if path not in self.endpoints:
+            return self.send(request, 404, {'error': "No such endpoint (try one of: {})".format(
+                ", ".join(sorted(self.endpoints) + ["/metrics"]))})
+
+        params = urllib.parse.parse_qs(parsed.query)
+        start = time.perf_counter()
+        with self.lock:
+            job = Job(self.next_id, request.path, lambda: self.endpoints[path](params))
+            self.next_id += 1
+            self.in_flight += 1
+        try:
+            future = self.executor.submit(self.run, job)
+            try:
+                status, body = 200, {'result': future.result(self.timeout)}
+            except concurrent.futures.TimeoutError:
+                job.cancel() # stops the query (or, if it hasn't started yet, keeps it from starting)
+                status, body = 504, {'error': "The query took longer than {:g} seconds".format(self.timeout)}
+            except ValueError as e:
+                status, body = 400, {'error': str(e)}
+            except Exception as e:
+                status, body = 500, {'error': "{}: {}".format(type(e).__name__, e)}
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+        elapsed = time.perf_counter() - start
+        body['seconds'] = round(elapsed, 6)
+        self.record(path, status, elapsed)
+        self.send(request, status, body)
+
+    def run(self, job):
+        # on a worker thread: runs job's query, unless it was cancelled while it waited
+        if job.cancel_event.is_set():
+            raise Cancelled()
+        try:
+            with running(job):
+                return job.func()
+        except Exception as e:
+            if was_interrupted(job, e):
+                raise Cancelled()
+            raise
+
+    def record(self, path, status, elapsed):
+        with self.lock:
+            stats = self.stats.get(path)
+            if stats is None:
+                stats = self.stats[path] = {'requests': 0, 'errors': 0, 'timeouts': 0, 'total_seconds': 0.0,
+                    'latencies': collections.deque(maxlen=LATENCY_SAMPLES)}
+            stats['requests'] += 1
+            stats['errors'] += status != 200 and status != 504
+            stats['timeouts'] += status == 504
+            stats['total_seconds'] += elapsed
+            stats['latencies'].append(elapsed)
+
+    def metrics_report(self):
+        with self.lock:
+            endpoints = {}
+            for path, stats in sorted(self.stats.items()):
+                latencies = sorted(stats['latencies'])
+                endpoints[path] = {
+                    'requests': stats['requests'],
+                    'errors': stats['errors'],
+                    'timeouts': stats['timeouts'],
+                    'mean_seconds': stats['total_seconds'] / stats['requests'],
+                    'p50_seconds': latencies[int(0.5 * (len(latencies) - 1))],
+                    'p95_seconds': latencies[int(0.95 * (len(latencies) - 1))],
+                    'max_seconds': latencies[-1],
+                }
+            report = {
+                'uptime_seconds': round(time.time() - self.started, 3),
+                'workers': self.workers,
+                'timeout_seconds': self.timeout,
+                'in_flight': self.in_flight,
+                'endpoints': endpoints,
+            }
+        if self.metrics is not None:
+            report.update(self.metrics())
+        return report
+
+    def send(self, request, status, body):
+        data = json.dumps(body).encode('utf-8')
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
@@ -0,0 +1,234 @@
+import collections
+import json
+import os
+import shutil
+import time
+import numpy as np
+from compression import decompress_body
+from database import get_meta
+from dates import check_granularity, date_to_day, day_to_date
+from tokenizer import tokenize, normalize_phrase
+
+'''
+A columnar snapshot of law.db, for analysis in numpy.
+
+Exploring the corpus beyond the REPL commands used to mean pulling every row out
+of SQLite as Python tuples. export_snapshot() writes the numbers instead, once,
+as plain .npy files in a directory:
+
+  cases.npy      one row per case, in Id order: (Id, decision day, court id,
+                 state id), int64, with -1 for a missing date, court or state
+  indptr.npy     the case x term count matrix, in CSR form: the counts for case i
+  indices.npy    are data[indptr[i]:indptr[i + 1]], for the terms with ids
+  data.npy       indices[indptr[i]:indptr[i + 1]]
+  terms.npy      the vocabulary, as UTF-8 bytes one after another (uint8), with
+  term_ptr.npy   term i at terms[term_ptr[i]:term_ptr[i + 1]]
+  snapshot.json  the database's generation and tokenizer, the counts, and the
+                 states' abbreviations by id
+
+Terms come from the database's own tokenizer, so they're the same tokens the
+term index counts. load_snapshot() memory-maps every array (nothing is read
+until it's used, and nothing is copied), and the Snapshot it returns has
+vectorized versions of the per-state and per-date aggregations.
+
+This module needs numpy; capapi.py only imports it for the 'snapshot' command.
+'''
+
+CASE_COLUMNS = ('id', 'day', 'court_id', 'state_id')
+EPOCH_DAY = 719163 # datetime.date(1970, 1, 1).toordinal(), day 0 for numpy's datetime64[D]
+
+def export_snapshot(conn, directory, batch_size=1000):
+    # Writes the snapshot of the database on conn to directory (replacing any that's there) and
+    # returns its manifest. It's written to a temporary directory first, so an interrupted export
+    # leaves the old snapshot as it was.
+    cur = conn.cursor()
+    partial = directory.rstrip(os.sep) + ".partial"
+    shutil.rmtree(partial, ignore_errors=True)
+    os.makedirs(partial)
+
+    tokenizer = get_meta(cur, 'tokenizer', 'split')
+    statement = '''
+    SELECT Cases.Id, IFNULL(Cases.DecisionDate, -1), IFNULL(Cases.CourtId, -1), IFNULL(DistrictCourts.StateId, -1), Cases.CaseBody
+    FROM Cases
+    LEFT JOIN DistrictCourts
+    ON Cases.CourtId = DistrictCourts.Id
+    ORDER BY Cases.Id
+    '''
+
+    # the matrix is streamed to raw files a batch at a time, and only given its .npy header once
+    # its size is known, so the whole corpus is never in memory at once
+    term_ids = {}
+    cases = []
+    indptr = [0]
+    with open(os.path.join(partial, "indices.raw"), 'wb') as indices_file, \
+            open(os.path.join(partial, "data.raw"), 'wb') as data_file:
+        results = cur.execute(statement)
+        while True:
+            batch = results.fetchmany(batch_size)
+            if not batch:
+                break
+            indices = []
+            data = []
+            for case_id, day, court_id, state_id, body in batch:
+                cases.append((case_id, day, court_id, state_id))
+                counts = collections.Counter(tokenize(decompress_body(body, conn) or "", tokenizer))
+                for term, count in counts.items():
+                    term_id = term_ids.get(term)
+                    if term_id is None:
+                        term_id = term_ids[term] = len(term_ids)
+                    indices.append(term_id)
+                    data.append(count)
+                indptr.append(indptr[-1] + len(counts))
+            np.array(indices, dtype=np.int32).tofile(indices_file)
+            np.array(data, dtype=np.int32).tofile(data_file)
+
+    for name in ['indices', 'data']:
+        raw_to_npy(os.path.join(partial, name + ".raw"), os.path.join(partial, name + ".npy"), np.int32)
+    np.save(os.path.join(partial, "cases.npy"), np.array(cases, dtype=np.int64).reshape(-1, len(CASE_COLUMNS)))
+    np.save(os.path.join(partial, "indptr.npy"), np.array(indptr, dtype=np.int64))
+
+    encoded = [term.encode('utf-8') for term in term_ids] # dicts keep insertion order, i.e. term id order
+    np.save(os.path.join(partial, "terms.npy"), np.frombuffer(b"".join(encoded), dtype=np.uint8))
+    np.save(os.path.join(partial, "term_ptr.npy"), np.cumsum([0] + [len(term) for term in encoded], dtype=np.int64))
+
+    manifest = {
+        'generation': get_meta(cur, 'generation'),
+        'tokenizer': tokenizer,
+        'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'cases': len(cases),
+        'terms': len(term_ids),
+        'nonzeros': indptr[-1],
+        'case_columns': CASE_COLUMNS,
+        'states': dict(cur.execute("SELECT Id, Abbr FROM States").fetchall()),
+    }
+    with open(os.path.join(partial, "snapshot.json"), 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(partial, directory)
+    return manifest
+
+def raw_to_npy(raw_path, npy_path, dtype):
+    # puts an .npy header in front of a file of raw values, then deletes the raw file
+    count = os.path.getsize(raw_path) // np.dtype(dtype).itemsize
+    with open(npy_path, 'wb') as f, open(raw_path, 'rb') as raw:
+        header = {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False, 'shape': (count,)}
+        np.lib.format.write_array_header_1_0(f, header)
+        shutil.copyfileobj(raw, f)
+    os.remove(raw_path)
+
+def load_snapshot(directory):
+    return Snapshot(directory)
+
+class Snapshot:
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "snapshot.json")) as f:
+            self.manifest = json.load(f)
+        self.states = {int(state_id): abbr for state_id, abbr in self.manifest['states'].items()}
+
+        def load(name):
+            return np.load(os.path.join(directory, name + ".npy"), mmap_mode='r')
+
+        self.cases = load("cases")
+        self.case_ids, self.days, self.court_ids, self.state_ids = [self.cases[:, i] for i in range(len(CASE_COLUMNS))]
+        self.indptr = load("indptr")
+        self.indices = load("indices")
+        self.data = load("data")
+        self.terms = load("terms")
+        self.term_ptr = load("term_ptr")
+        self.term_ids = None # built from terms the first time a word is looked up
+
+    def is_current(self, cur):
+        # whether the database on cur still has the data this snapshot was taken from
+        return get_meta(cur, 'generation') == self.manifest['generation']
+
+    def term(self, term_id):
+        return bytes(self.terms[self.term_ptr[term_id]:self.term_ptr[term_id + 1]]).decode('utf-8')
+
+    def term_id(self, word):
+        # the id of word, normalized the way the snapshot's text was (None if it's not in any case)
+        tokens = normalize_phrase(word, self.manifest['tokenizer'])
+        if len(tokens) != 1:
+            raise ValueError("The snapshot counts single words, and '{}' isn't one".format(word))
+        if self.term_ids is None:
+            text = bytes(self.terms).decode('utf-8')
+            # offsets are in bytes; a text with only ASCII in it can be sliced by them directly
+            if len(text) == len(self.terms):
+                bounds = self.term_ptr.tolist()
+                self.term_ids = {text[bounds[i]:bounds[i + 1]]: i for i in range(len(bounds) - 1)}
+            else:
+                self.term_ids = {self.term(i): i for i in range(len(self.term_ptr) - 1)}
+        return self.term_ids.get(tokens[0])
+
+    def day_mask(self, date_min=None, date_max=None):
+        # which cases were decided from date_min to date_max (ISO dates, either one optional)
+        mask = np.ones(len(self.days), dtype=bool)
+        if date_min is not None:
+            mask &= self.days >= date_to_day(date_min)
+        if date_max is not None:
+            mask &= self.days <= date_to_day(date_max)
+        return mask
+
+    def term_counts(self, word):
+        # (row of each case containing word, # of times it's in that case), in row order
+        term_id = self.term_id(word)
+        if term_id is None:
+            return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32))
+        positions = np.flatnonzero(self.indices == term_id)
+        rows = np.searchsorted(self.indptr, positions, side='right') - 1
+        return (rows, self.data[positions])
+
+    def state_counts(self, mask):
+        # {state abbr: # of cases in mask}, for the district court cases in mask
+        counts = np.bincount(self.state_ids[mask & (self.state_ids >= 0)], minlength=max(self.states, default=0) + 1)
+        return {self.states[state_id]: int(counts[state_id]) for state_id in sorted(self.states) if counts[state_id] > 0}
+
+    def cases_by_state(self, date_min=None, date_max=None):
+        # like capapi.get_state_totals(): {state abbr: # of district court cases}
+        return self.state_counts(self.day_mask(date_min, date_max))
+
+    def percent_by_state_containing(self, word, date_min=None, date_max=None):
+        # like capapi.get_percent_by_state_containing(), as {state abbr: fraction of its cases}
+        mask = self.day_mask(date_min, date_max)
+        totals = self.state_counts(mask)
+        contains = np.zeros(len(mask), dtype=bool)
+        contains[self.term_counts(word)[0]] = True
+        matching = self.state_counts(mask & contains)
+        return {abbr: matching.get(abbr, 0) / totals[abbr] for abbr in totals}
+
+    def freq_by_time(self, list_of_words, granularity='day', date_min=None, date_max=None):
+        # like capapi.get_freq_by_time_for(): one {ISO date: frequency} dict per word
+        check_granularity(granularity)
+        mask = self.day_mask(date_min, date_max) & (self.days >= 0) # undated cases aren't in any period
+        cumulative = np.concatenate([[0], np.cumsum(self.data, dtype=np.int64)])
+        tokens_per_case = cumulative[self.indptr[1:]] - cumulative[self.indptr[:-1]]
+
+        periods, period_of_case = np.unique(period_starts(self.days[mask], granularity), return_inverse=True)
+        totals = np.bincount(period_of_case, weights=tokens_per_case[mask], minlength=len(periods))
+        dates = [day_to_date(int(period)) for period in periods]
+
+        # period index of each case (-1 for cases outside the date range)
+        case_period = np.full(len(mask), -1, dtype=np.int64)
+        case_period[mask] = period_of_case
+
+        list_of_dicts = []
+        for word in list_of_words:
+            rows, counts = self.term_counts(word)
+            in_range = case_period[rows] >= 0
+            word_counts = np.bincount(case_period[rows][in_range], weights=counts[in_range], minlength=len(periods))
+            freqs = np.divide(word_counts, totals, out=np.zeros(len(periods)), where=totals > 0)
+            list_of_dicts.append(dict(zip(dates, freqs.tolist())))
+        return list_of_dicts
+
+def period_starts(days, granularity):
+    # dates.period_start(), for an array of day numbers
+    days = np.asarray(days, dtype=np.int64)
+    if granularity == 'day':
+        return days
+    if granularity == 'week':
+        return days - (days + 6) % 7
+    unit = 'M' if granularity == 'month' else 'Y'
+    dates = (days - EPOCH_DAY).astype('datetime64[D]')
+    return dates.astype('datetime64[{}]'.format(unit)).astype('datetime64[D]').astype(np.int64) + EPOCH_DAY
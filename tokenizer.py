@@ -0,0 +1,131 @@
+import functools
+import re
+
+'''
+Turning case text (and the words typed at the prompt) into tokens.
+
+Every index and every query helper has to split text the same way, or a word
+counted one way at ingest can't be found the other way at query time. The
+tokenizers, by name:
+
+  'split'       str.split(): case and punctuation are kept, so "Woman," and
+                "woman" are different tokens. What law.db used before it
+                recorded a tokenizer, so older databases keep using it.
+  'words'       lowercased runs of letters and digits: punctuation is dropped,
+                as is a trailing possessive "'s" ("court's" -> "court").
+  'words+stem'  'words', plus a light plural stemmer ("courts" -> "court",
+                "policies" -> "policy").
+
+create_db() records which one it used in the Meta table ('tokenizer'), and the
+term index, the full-text index and the scans all use that one.
+
+'words' is a few C-speed passes over the whole text (lower(), a regex for the
+possessives, str.translate() to turn punctuation into spaces, and split())
+rather than a regex findall(), which is about three times slower. Stems are
+memoized, since the vocabulary is much smaller than the text.
+'''
+
+TOKENIZERS = ('split', 'words', 'words+stem')
+
+POSSESSIVE = re.compile(r"['’]s\b")
+QUOTE = re.compile(r"\B'|'\B") # apostrophes that aren't inside a word, i.e. quote marks
+
+def punctuation_table():
+    # punctuation and symbols -> spaces, in ASCII, Latin-1 and the general punctuation blocks;
+    # apostrophes are kept (curly ones straightened), since they can be part of a word
+    table = {}
+    for block in (range(0x0300), range(0x2000, 0x2070), range(0x3000, 0x3040)):
+        for i in block:
+            ch = chr(i)
+            if not (ch.isalnum() or ch.isspace() or ch == "'"):
+                table[i] = ' '
+    table[ord('’')] = "'"
+    return str.maketrans(table)
+
+PUNCTUATION = punctuation_table()
+
+def check_tokenizer(name):
+    if name not in TOKENIZERS:
+        raise ValueError("Unknown tokenizer: {} (use one of {})".format(name, ", ".join(TOKENIZERS)))
+
+@functools.lru_cache(maxsize=65536)
+def stem(token):
+    # the "S" stemmer (Harman, 1991): only plural endings are removed, so stems are still words
+    if len(token) <= 3 or not token.endswith('s'):
+        return token
+    if token.endswith('ies') and not token.endswith(('eies', 'aies')):
+        return token[:-3] + 'y'
+    if token.endswith('es') and not token.endswith(('aes', 'ees', 'oes')):
+        return token[:-1]
+    if token.endswith(('us', 'ss')):
+        return token
+    return token[:-1]
+
+def tokenize(text, name='words'):
+    # text -> list of tokens, in order
+    if name == 'split':
+        return text.split()
+    text = POSSESSIVE.sub("", text.lower()).translate(PUNCTUATION)
+    if "'" in text:
+        text = QUOTE.sub(" ", text)
+    tokens = text.split()
+    if name == 'words+stem':
+        return [stem(token) for token in tokens]
+    check_tokenizer(name)
+    return tokens
+
+@functools.lru_cache(maxsize=1024)
+def normalize_phrase(phrase, name='words'):
+    # a word or phrase typed at the prompt -> its tuple of tokens, as they'd be found in the text
+    if name == 'split':
+        return (phrase,)
+    return tuple(tokenize(phrase, name))
+
+def contains_phrase(tokens, phrase_tokens):
+    # whether phrase_tokens appear in tokens, consecutively and in order
+    if not phrase_tokens:
+        return False
+    first = phrase_tokens[0]
+    if len(phrase_tokens) == 1:
+        return first in tokens
+    n = len(phrase_tokens)
+    i = 0
+    while True:
+        try:
+            i = tokens.index(first, i)
+        except ValueError:
+            return False
+        if tuple(tokens[i:i + n]) == phrase_tokens:
+            return True
+        i += 1
+
+def has_phrase(text, phrase, name='words'):
+    # whether text contains phrase, once both are tokenized
+    if text is None:
+        return False
+    phrase_tokens = normalize_phrase(phrase, name)
+    if not phrase_tokens:
+        return False
+    if name == 'words' and phrase_tokens[0].partition("'")[0] not in text.lower():
+        return False # can't be there (the text may have a curly apostrophe), so don't tokenize it all
+    return contains_phrase(tokenize(text, name), phrase_tokens)
+
+def index_text(text, name='words'):
+    # text rewritten as its tokens separated by spaces, for the full-text index
+    if text is None or name == 'split':
+        return text
+    return " ".join(tokenize(text, name))
+
+def match_condition(phrase, name, column="body_text(Cases.CaseBody)"):
+    # A WHERE condition (and its parameter) for the rows whose text in column contains phrase,
+    # without an index. 'split' databases keep the substring LIKE they've always used.
+    if name == 'split':
+        return ("{} LIKE ?".format(column), "%{}%".format(phrase))
+    check_tokenizer(name)
+    return ("has_phrase({}, ?, '{}')".format(column, name), phrase)
+
+def register_functions(conn):
+    # has_phrase(text, phrase, tokenizer) and index_text(text, tokenizer), for SQL
+    conn.create_function('has_phrase', 3, has_phrase, deterministic=True)
+    conn.create_function('index_text', 2, index_text, deterministic=True)
+    return conn